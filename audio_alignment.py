@@ -0,0 +1,101 @@
+import os
+
+import librosa
+import numpy as np
+import soundfile
+
+from audio_fingerprint import HOP_LENGTH, N_FFT, SAMPLE_RATE, load_audio
+from instrumentation import span
+
+# Envelope values at either end of the clip are padded by the STFT framing, so they are left out
+EDGE_FRAMES = N_FFT // HOP_LENGTH // 2
+MIN_CORRELATION = 0.6
+# Length of the clip waveform used for the sample-accurate pass, and how far around the
+# envelope estimate it searches, in seconds
+REFINE_SECONDS = 2.0
+REFINE_MARGIN = 0.1
+
+def audio_envelope(samples):
+	"""RMS envelope of audio loaded at SAMPLE_RATE, one value per HOP_LENGTH samples."""
+	if len(samples) == 0:
+		return np.empty(0, dtype=np.float32)
+	return librosa.feature.rms(y=samples, frame_length=N_FFT, hop_length=HOP_LENGTH)[0].astype(np.float32)
+
+def sliding_correlation(signal, template):
+	"""
+	Normalized cross-correlation of template at every offset where it fits inside signal.
+
+	The products for all offsets come from one FFT, and the per-offset normalization from
+	running sums, so the cost is O(n log n) in the length of signal.
+	"""
+	signal = np.asarray(signal, dtype=np.float64)
+	template = np.asarray(template, dtype=np.float64)
+	length = len(template)
+	if length == 0 or len(signal) < length:
+		return np.empty(0)
+	template = template - template.mean()
+	size = 1 << int(np.ceil(np.log2(len(signal) + length - 1)))
+	products = np.fft.irfft(np.fft.rfft(signal, size) * np.conj(np.fft.rfft(template, size)), size)[:len(signal) - length + 1]
+
+	sums = np.concatenate([[0.0], np.cumsum(signal)])
+	squares = np.concatenate([[0.0], np.cumsum(signal * signal)])
+	window_sums = sums[length:] - sums[:-length]
+	window_variances = squares[length:] - squares[:-length] - window_sums * window_sums / length
+	norms = np.sqrt(np.maximum(window_variances, 0) * np.dot(template, template))
+	return np.divide(products, norms, out=np.zeros_like(products), where=norms > 1e-12)
+
+def read_mono(wav_path, start=0, frames=-1):
+	"""Raw samples of a .wav at its own sample rate, channels averaged like librosa.load."""
+	samples, sample_rate = soundfile.read(wav_path, start=start, frames=frames, dtype='float32', always_2d=True)
+	return samples.mean(axis=1), sample_rate
+
+class AudioAligner:
+	"""
+	Finds where a query clip's audio starts inside a database video's audio track.
+
+	A coarse offset comes from cross-correlating the clip's RMS envelope with the envelope
+	stored for the video, and is then refined to the sample by cross-correlating the first
+	REFINE_SECONDS of the clip waveform with a short stretch of the video's waveform.
+	"""
+
+	def __init__(self, clip_wav):
+		self.clip_wav = clip_wav
+		envelope = audio_envelope(load_audio(clip_wav))
+		self.envelope = envelope[EDGE_FRAMES:len(envelope) - EDGE_FRAMES]
+		self.sample_rate = soundfile.info(clip_wav).samplerate
+		self.samples, _ = read_mono(clip_wav, frames=int(REFINE_SECONDS * self.sample_rate))
+
+	def coarse_offset(self, video_envelope):
+		"""Clip start in seconds at envelope resolution, or None if no offset correlates well enough."""
+		scores = sliding_correlation(video_envelope, self.envelope)
+		if not len(scores):
+			return None
+		best = int(np.argmax(scores))
+		if scores[best] < MIN_CORRELATION:
+			return None
+		return max(best - EDGE_FRAMES, 0) * HOP_LENGTH / SAMPLE_RATE
+
+	def refine(self, video_wav, approximate_seconds):
+		"""Sample-accurate clip start in seconds, searched within REFINE_MARGIN of approximate_seconds."""
+		if not os.path.exists(video_wav) or soundfile.info(video_wav).samplerate != self.sample_rate:
+			return approximate_seconds
+		margin = int(REFINE_MARGIN * self.sample_rate)
+		start = max(int(round(approximate_seconds * self.sample_rate)) - margin, 0)
+		video_samples, _ = read_mono(video_wav, start=start, frames=len(self.samples) + 2 * margin)
+		scores = sliding_correlation(video_samples, self.samples)
+		if not len(scores) or scores.max() < MIN_CORRELATION:
+			return approximate_seconds
+		return (start + int(np.argmax(scores))) / self.sample_rate
+
+	def align(self, video_wav, video_envelope):
+		"""
+		Start of the clip inside a database video's audio.
+
+		Returns:
+		float: Start time in seconds, or None when the clip's audio is not found in the video.
+		"""
+		with span('audio_alignment'):
+			approximate_seconds = self.coarse_offset(video_envelope)
+			if approximate_seconds is None:
+				return None
+			return self.refine(video_wav, approximate_seconds)
@@ -0,0 +1,138 @@
+import os
+
+import numpy as np
+
+from hash_index import bucket_positions
+
+SAMPLE_RATE = 11025
+N_FFT = 1024
+HOP_LENGTH = 256
+# Spectrogram neighbourhood (frequency bins, time frames) a peak must be the maximum of
+PEAK_NEIGHBORHOOD = (15, 15)
+MIN_PEAK_DB = -10.0
+# Every peak is paired with the next FAN_OUT peaks that start at most MAX_PAIR_DT frames later
+FAN_OUT = 5
+MAX_PAIR_DT = 63
+MIN_VOTES = 5
+
+def audio_path(video_path):
+	"""The .wav that sits next to a video or clip."""
+	return os.path.splitext(video_path)[0] + '.wav'
+
+def frames_to_seconds(frames):
+	return frames * HOP_LENGTH / SAMPLE_RATE
+
+def load_audio(wav_path, duration=None):
+	# librosa and scipy are imported on use, so opening a store or the CLI client does not load them
+	import librosa
+	samples, _ = librosa.load(wav_path, sr=SAMPLE_RATE, mono=True, duration=duration)
+	return samples
+
+def spectral_peaks(samples):
+	"""
+	Local maxima of the log spectrogram above MIN_PEAK_DB.
+
+	Returns:
+	Tuple: (time frame, frequency bin) of every peak, sorted by time then frequency.
+	"""
+	import librosa
+	from scipy.ndimage import maximum_filter
+	if len(samples) < N_FFT:
+		return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+	spectrogram = librosa.amplitude_to_db(np.abs(librosa.stft(samples, n_fft=N_FFT, hop_length=HOP_LENGTH)), ref=1.0)
+	is_peak = (maximum_filter(spectrogram, size=PEAK_NEIGHBORHOOD, mode='constant', cval=-np.inf) == spectrogram)
+	is_peak &= spectrogram > MIN_PEAK_DB
+	frequencies, times = np.nonzero(is_peak)
+	order = np.lexsort((frequencies, times))
+	return times[order], frequencies[order]
+
+def landmark_hashes(times, frequencies):
+	"""
+	Pairs every peak with the following FAN_OUT peaks and hashes each pair.
+
+	A hash packs the anchor frequency, the target frequency and their time difference
+	into a uint32: 10 bits each for the frequencies and 6 bits for the time difference.
+
+	Returns:
+	Tuple: (hashes, anchor time frames).
+	"""
+	hashes = []
+	anchor_times = []
+	for step in range(1, FAN_OUT + 1):
+		dt = times[step:] - times[:-step]
+		paired = (dt > 0) & (dt <= MAX_PAIR_DT)
+		anchors = np.flatnonzero(paired)
+		hashes.append((frequencies[anchors].astype(np.uint32) << 16)
+			| (frequencies[anchors + step].astype(np.uint32) << 6) | dt[anchors].astype(np.uint32))
+		anchor_times.append(times[anchors])
+	if not hashes:
+		return np.empty(0, dtype=np.uint32), np.empty(0, dtype=np.int32)
+	return np.concatenate(hashes), np.concatenate(anchor_times).astype(np.int32)
+
+def fingerprint_audio(wav_path, duration=None):
+	"""Landmark hashes and anchor times of a .wav file, empty if the file does not exist."""
+	if not wav_path or not os.path.exists(wav_path):
+		return np.empty(0, dtype=np.uint32), np.empty(0, dtype=np.int32)
+	return landmark_hashes(*spectral_peaks(load_audio(wav_path, duration)))
+
+class AudioFingerprintIndex:
+	"""
+	Inverted index from landmark hash to (video, anchor time).
+
+	The hashes of every video are one column of the signature store; the index is the
+	sorted copy of that column plus the row each sorted entry came from, so all entries
+	for a hash form a contiguous run found by binary search.
+	"""
+
+	def __init__(self, sorted_hashes, order, hash_offsets=None, anchor_times=None):
+		self.sorted_hashes = sorted_hashes
+		self.order = order
+		self.hash_offsets = None if hash_offsets is None else np.asarray(hash_offsets)
+		self.anchor_times = anchor_times
+
+	@classmethod
+	def build(cls, hashes, hash_offsets=None, anchor_times=None):
+		hashes = np.asarray(hashes, dtype=np.uint32)
+		order = np.argsort(hashes, kind='stable')
+		order = order.astype(np.uint32 if len(order) < (1 << 32) else np.int64)
+		return cls(hashes[order], order, hash_offsets, anchor_times)
+
+	@staticmethod
+	def exists(directory):
+		return os.path.exists(os.path.join(directory, 'audio_index_keys.npy'))
+
+	@classmethod
+	def load(cls, directory, hash_offsets, anchor_times):
+		"""Memory-map a saved index; hash_offsets and anchor_times are the store's audio columns."""
+		sorted_hashes = np.load(os.path.join(directory, 'audio_index_keys.npy'), mmap_mode='r')
+		order = np.load(os.path.join(directory, 'audio_index_order.npy'), mmap_mode='r')
+		return cls(sorted_hashes, order, hash_offsets, anchor_times)
+
+	def save(self, directory):
+		np.save(os.path.join(directory, 'audio_index_keys.npy'), self.sorted_hashes)
+		np.save(os.path.join(directory, 'audio_index_order.npy'), self.order)
+
+	def lookup(self, query_hashes, query_times):
+		"""
+		Votes for the (video, time offset) pair most query landmarks agree on.
+
+		Returns:
+		Tuple: (video index, offset in seconds, votes), or None with fewer than MIN_VOTES votes.
+		"""
+		if not len(query_hashes) or not len(self.sorted_hashes):
+			return None
+		low = np.searchsorted(self.sorted_hashes, query_hashes, side='left')
+		high = np.searchsorted(self.sorted_hashes, query_hashes, side='right')
+		counts = high - low
+		if not counts.sum():
+			return None
+		positions = bucket_positions(low, counts)
+		rows = np.asarray(self.order[positions]).astype(np.int64)
+		videos = np.searchsorted(self.hash_offsets, rows, side='right') - 1
+		offsets = np.asarray(self.anchor_times[rows]).astype(np.int64) - np.repeat(query_times, counts)
+
+		keys, votes = np.unique(np.stack([videos, offsets]), axis=1, return_counts=True)
+		best = int(np.argmax(votes))
+		if votes[best] < MIN_VOTES:
+			return None
+		return int(keys[0, best]), frames_to_seconds(int(keys[1, best])), int(votes[best])
@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+
+import argparse
+import csv
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import cv2
+
+from hash_index import rank_videos_batch
+from histogram_alignment import COMPACT_TOLERANCE
+from instrumentation import Trace
+from main_algorithim import adaptive_video_search, format_timestamp, match_before_ranking, preprocessing_directory
+from result_cache import CACHE_SIZE, QueryResultCache, clip_key
+from signature_store import SignatureStore
+
+def find_clip_pairs(paths):
+	"""
+	Expands the command line inputs into (clip.mp4, clip.rgb) pairs.
+
+	Each path can be a clip video (its .rgb sits next to it), a directory of clips, or a
+	text file listing one clip per line, optionally followed by its .rgb path.
+	"""
+	pairs = []
+	for path in paths:
+		if os.path.isdir(path):
+			for name in sorted(os.listdir(path)):
+				if name.endswith('.mp4') and os.path.exists(os.path.join(path, name[:-4] + '.rgb')):
+					pairs.append((os.path.join(path, name), os.path.join(path, name[:-4] + '.rgb')))
+		elif path.endswith('.mp4'):
+			pairs.append((path, os.path.splitext(path)[0] + '.rgb'))
+		else:
+			with open(path) as file:
+				for line in file:
+					fields = line.split()
+					if fields:
+						pairs.append((fields[0], fields[1] if len(fields) > 1 else os.path.splitext(fields[0])[0] + '.rgb'))
+	return pairs
+
+_worker_store = None
+_worker_cache = None
+
+def _init_worker(signature_directory, cache_size, cache_path):
+	global _worker_store, _worker_cache
+	# Every worker maps the same store files, so the page cache is shared between them
+	_worker_store = SignatureStore(signature_directory)
+	# Workers only read the saved cache; the parent adds the batch's new matches and saves them
+	_worker_cache = QueryResultCache(_worker_store.generation, cache_size, cache_path) if cache_path else None
+	cv2.setNumThreads(1)
+
+def _match_before_ranking(clip_pair, frame_threshold, rgb_check_frames):
+	with Trace('batch_query', record=False) as trace:
+		query, found, cached = match_before_ranking(_worker_store, *clip_pair, frame_threshold=frame_threshold,
+			rgb_check_frames=rgb_check_frames, cache=_worker_cache)
+	timings = {stage: trace.span_seconds(stage) for stage in ('audio', 'features', 'cache', 'histogram_index')}
+	return query, found, cached, timings
+
+def _localize(query, matching_videos, frame_threshold, compact_tolerance=COMPACT_TOLERANCE):
+	start_time = time.time()
+	video_path, start_frame = adaptive_video_search(matching_videos, query, _worker_store, frame_threshold, start_time,
+		compact_tolerance=compact_tolerance)
+	return video_path, start_frame, time.time() - start_time
+
+def run_batch(clip_pairs, signature_directory=None, workers=None, frame_threshold=0.95, rgb_check_frames=1,
+	compact_tolerance=COMPACT_TOLERANCE, cache_size=CACHE_SIZE, cache_path=None):
+	"""
+	Matches many clips against the library without opening the GUI.
+
+	Each clip first goes through the same audio, cache and histogram index stages as a
+	single query, in parallel. The clips none of them places are ranked in a single
+	vectorized pass over the library, and localization is spread over the same worker
+	pool. A start frame is confirmed by rgb_check_frames clip frames spread over the clip.
+
+	Returns:
+	list: One result dict per clip, in input order, with per-stage and total latency in seconds.
+	"""
+	if signature_directory is None:
+		signature_directory = os.path.join(preprocessing_directory, 'signatures')
+	workers = workers or os.cpu_count()
+	store = SignatureStore(signature_directory)
+	cache = QueryResultCache(store.generation, cache_size, cache_path) if cache_path else None
+
+	with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+			initargs=(signature_directory, cache_size, cache_path)) as executor:
+		matched = list(executor.map(_match_before_ranking, clip_pairs, [frame_threshold] * len(clip_pairs),
+			[rgb_check_frames] * len(clip_pairs)))
+		unplaced = [index for index, (_, found, _, _) in enumerate(matched) if found is None]
+		queries = [matched[index][0] for index in unplaced]
+
+		start_time = time.time()
+		rankings = rank_videos_batch([query.packed_hashes for query in queries], store.hash_library()) if queries else []
+		# The ranking pass is shared, so each ranked clip is charged an equal part of it
+		ranking_time = (time.time() - start_time) / max(len(queries), 1)
+
+		localized = dict(zip(unplaced, executor.map(_localize, queries, rankings, [frame_threshold] * len(queries),
+			[compact_tolerance] * len(queries))))
+		ranked = dict(zip(unplaced, rankings))
+		results = []
+		for index, ((clip_path, clip_rgb), (query, found, cached, timings)) in enumerate(zip(clip_pairs, matched)):
+			localization_time = 0.0
+			if found is not None:
+				video_path, start_frame = found
+			else:
+				video_path, start_frame, localization_time = localized[index]
+			found = video_path is not None and start_frame != -1
+			if found and cache is not None and query is not None and not cached:
+				cache.put(clip_key(query.packed_hashes, query.first_rgb_frame), video_path, start_frame, store.generation)
+			fps = store.fps(video_path) if found else None
+			ranking = ranked.get(index)
+			stage_time = sum(timings.values())
+			results.append({
+				'clip': clip_path,
+				'clip_rgb': clip_rgb,
+				'video': video_path if found else None,
+				'start_frame': start_frame if found else -1,
+				'timestamp': format_timestamp(start_frame / fps) if found else None,
+				'cached': cached,
+				'best_ranked': ranking[0][0] if ranking else None,
+				'audio_time': timings['audio'],
+				'features_time': timings['features'],
+				'cache_time': timings['cache'],
+				'histogram_index_time': timings['histogram_index'],
+				'ranking_time': ranking_time if index in ranked else 0.0,
+				'localization_time': localization_time,
+				'latency': stage_time + (ranking_time if index in ranked else 0.0) + localization_time,
+			})
+	if cache is not None:
+		cache.save()
+	return results
+
+def write_results(results, output_path):
+	"""Writes the results as CSV when output_path ends in .csv, as JSON otherwise."""
+	if output_path.endswith('.csv'):
+		with open(output_path, 'w', newline='') as file:
+			writer = csv.DictWriter(file, fieldnames=list(results[0]) if results else ['clip'])
+			writer.writeheader()
+			writer.writerows(results)
+	else:
+		with open(output_path, 'w') as file:
+			json.dump(results, file, indent=2)
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="Match many query clips against the library, without the GUI.")
+	parser.add_argument('inputs', nargs='+', help="clip .mp4 files, directories of clips, or files listing clip [rgb] pairs")
+	parser.add_argument('--output', default='batch_results.json', help="results file, .json or .csv")
+	parser.add_argument('--workers', type=int, default=None, help="worker processes, defaults to the number of cores")
+	parser.add_argument('--signatures', default=None, help="signature store directory")
+	parser.add_argument('--frame-threshold', type=float, default=0.95)
+	parser.add_argument('--compact-tolerance', type=float, default=COMPACT_TOLERANCE,
+		help="how far below the frame threshold a compact histogram bound may be and still be rescored")
+	parser.add_argument('--rgb-check-frames', type=int, default=1, help="clip frames, spread over the clip, a match must equal exactly")
+	parser.add_argument('--cache-file', default=None, help="query result cache shared with earlier runs and the query server")
+	parser.add_argument('--cache-size', type=int, default=CACHE_SIZE, help="results kept in the query cache")
+	args = parser.parse_args()
+
+	batch_results = run_batch(find_clip_pairs(args.inputs), args.signatures, args.workers, args.frame_threshold,
+		args.rgb_check_frames, args.compact_tolerance, args.cache_size, args.cache_file)
+	write_results(batch_results, args.output)
+	found = sum(result['video'] is not None for result in batch_results)
+	print(f"Matched {found} of {len(batch_results)} clips, results written to {args.output}")
@@ -0,0 +1,125 @@
+import multiprocessing
+import os
+import threading
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+import cv2
+
+from histogram_alignment import COMPACT_TOLERANCE
+from instrumentation import Trace, merge_into_active
+from signature_store import SignatureStore
+
+_worker_store = None
+_worker_generations = None
+_process_video = None
+
+class Cancellation:
+	"""
+	Cooperative cancellation flag of one search, readable from any worker process.
+
+	Every running search owns a slot of a shared array and remembers the slot's generation
+	when it started; bumping the generation cancels every task of that search at once,
+	including tasks still queued or running after the search has returned.
+	"""
+
+	def __init__(self, generations, slot, generation):
+		self.generations = generations
+		self.slot = slot
+		self.generation = generation
+
+	def is_set(self):
+		return self.generations[self.slot] != self.generation
+
+def _init_worker(signature_directory, generations):
+	global _worker_store, _worker_generations, _process_video
+	# Imported here because main_algorithim imports this module
+	from main_algorithim import process_video
+	# The store is memory-mapped, so every worker reads the same pages of the page cache
+	_worker_store = SignatureStore(signature_directory)
+	_worker_generations = generations
+	_process_video = process_video
+	cv2.setNumThreads(1)
+
+def _search_video(video, query, frame_threshold, compact_tolerance, store_generation, slot, generation):
+	global _worker_store
+	# The query's store was rebuilt or updated since this worker opened it
+	if store_generation is not None and _worker_store.generation != store_generation:
+		_worker_store = SignatureStore(_worker_store.directory)
+	# The worker's spans and counters are sent back so the query's trace covers them too
+	with Trace('candidate', record=False) as trace:
+		result = _process_video(video, query, _worker_store, frame_threshold, Cancellation(_worker_generations, slot, generation),
+			compact_tolerance)
+	return result, trace.snapshot()
+
+class CandidateScheduler:
+	"""
+	Searches ranked candidate videos in worker processes, best ranked first.
+
+	At most one task per worker is in flight, so the next candidate in rank order starts
+	as soon as a worker frees up rather than the whole ranking being queued at once. The
+	first match cancels the rest: queued tasks are dropped and running ones notice the
+	flag between shot segments.
+	"""
+
+	def __init__(self, signature_directory, workers=None, max_searches=64):
+		self.workers = workers or os.cpu_count()
+		# Spawned rather than forked: the query server is threaded, and forking it is not safe
+		context = multiprocessing.get_context('spawn')
+		self.generations = context.Array('q', max_searches)
+		self.free_slots = list(range(max_searches))
+		self.lock = threading.Lock()
+		self.executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=context, initializer=_init_worker,
+			initargs=(signature_directory, self.generations))
+
+	def _acquire_slot(self):
+		with self.lock:
+			if not self.free_slots:
+				raise RuntimeError("Too many concurrent searches")
+			return self.free_slots.pop()
+
+	def _release_slot(self, slot):
+		with self.generations.get_lock():
+			self.generations[slot] += 1
+		with self.lock:
+			self.free_slots.append(slot)
+
+	def search(self, videos, query, frame_threshold, compact_tolerance=COMPACT_TOLERANCE, store_generation=None):
+		"""
+		Localizes the clip in videos, given in rank order, with process_video's frame_threshold and compact_tolerance.
+		Workers whose store is not of store_generation reopen it first.
+
+		Returns:
+		Tuple: (video path, start frame) of the first match found, or (None, -1).
+		"""
+		slot = self._acquire_slot()
+		generation = self.generations[slot]
+		videos = iter(videos)
+		pending = deque()
+		try:
+			for video in videos:
+				pending.append(self.executor.submit(_search_video, video, query, frame_threshold, compact_tolerance, store_generation,
+					slot, generation))
+				if len(pending) >= self.workers:
+					break
+			while pending:
+				done, _ = wait(pending, return_when=FIRST_COMPLETED)
+				# Several tasks can finish together, the best ranked match among them wins
+				for future in [future for future in pending if future in done]:
+					pending.remove(future)
+					(video, start_frame, _), snapshot = future.result()
+					merge_into_active(snapshot)
+					if start_frame != -1:
+						return video, start_frame
+					for video in videos:
+						pending.append(self.executor.submit(_search_video, video, query, frame_threshold, compact_tolerance,
+							store_generation, slot, generation))
+						break
+			return None, -1
+		finally:
+			self._release_slot(slot)
+			for future in pending:
+				future.cancel()
+
+	def close(self):
+		self.executor.shutdown(cancel_futures=True)
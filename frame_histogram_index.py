@@ -0,0 +1,165 @@
+import os
+
+import numpy as np
+
+# Product quantization: how many subspaces a vector is split into, and the centroids of each
+PQ_SUBSPACES = 8
+PQ_CENTROIDS = 256
+KMEANS_ITERATIONS = 15
+TRAINING_ROWS = 65536
+MAX_LISTS = 4096
+# Inverted lists visited and library frames kept for every key frame of a query
+PROBES = 8
+NEIGHBOURS = 32
+# Key frames of a query looked up, spread evenly over the clip, and the fewest that must
+# agree on a start before it is a candidate
+MAX_KEY_FRAMES = 32
+MIN_VOTES = 3
+MAX_CANDIDATES = 8
+
+def squared_distances(vectors, centroids):
+	"""Squared L2 distance between every row of vectors and every row of centroids."""
+	return (np.einsum('ij,ij->i', vectors, vectors)[:, None] - 2 * vectors @ centroids.T
+		+ np.einsum('ij,ij->i', centroids, centroids)[None, :])
+
+def nearest_centroids(vectors, centroids, block_rows=TRAINING_ROWS):
+	"""Index of the nearest centroid of every row of vectors, a block of rows at a time."""
+	assignments = np.empty(len(vectors), dtype=np.int64)
+	for start in range(0, len(vectors), block_rows):
+		block = np.asarray(vectors[start:start + block_rows], dtype=np.float32)
+		assignments[start:start + block_rows] = np.argmin(squared_distances(block, centroids), axis=1)
+	return assignments
+
+def kmeans(vectors, k, iterations=KMEANS_ITERATIONS, seed=0):
+	"""Lloyd's k-means started from k distinct rows of vectors; a cluster left empty keeps its centroid."""
+	rng = np.random.default_rng(seed)
+	centroids = vectors[np.sort(rng.choice(len(vectors), k, replace=False))].astype(np.float32)
+	for _ in range(iterations):
+		assignments = nearest_centroids(vectors, centroids)
+		order = np.argsort(assignments, kind='stable')
+		clusters, starts, counts = np.unique(assignments[order], return_index=True, return_counts=True)
+		centroids[clusters] = np.add.reduceat(vectors[order], starts, axis=0) / counts[:, None]
+	return centroids
+
+class FrameHistogramIndex:
+	"""
+	IVF-PQ index over the projected histograms of every frame in the library.
+
+	Every vector goes into the inverted list of its nearest k-means centroid, and its
+	residual to that centroid is product-quantized to one byte per subspace. A lookup
+	visits the PROBES nearest lists of each key frame and ranks their frames by the
+	distance to the decoded residuals, read from one table per subspace, so the whole
+	library is searched without touching the full histograms.
+
+	Rows are row numbers of the store's frame_histograms column, turned into (video,
+	frame) pairs with frame_offsets, the column's per-video offsets.
+	"""
+
+	def __init__(self, centroids, codebooks, codes, list_offsets, rows, frame_offsets=None):
+		self.centroids = centroids
+		self.codebooks = codebooks
+		self.codes = codes
+		self.list_offsets = list_offsets
+		self.rows = rows
+		self.frame_offsets = None if frame_offsets is None else np.asarray(frame_offsets)
+
+	@classmethod
+	def build(cls, vectors, frame_offsets=None, seed=0):
+		"""Train the coarse centroids and codebooks on a sample of vectors, then encode all of them."""
+		dimensions = vectors.shape[1]
+		subspace = dimensions // PQ_SUBSPACES
+		if not len(vectors):
+			return cls(np.empty((0, dimensions), dtype=np.float32), np.empty((PQ_SUBSPACES, 0, subspace), dtype=np.float32),
+				np.empty((0, PQ_SUBSPACES), dtype=np.uint8), np.zeros(1, dtype=np.int64), np.empty(0, dtype=np.int64), frame_offsets)
+		training = np.asarray(vectors[::max(len(vectors) // TRAINING_ROWS, 1)], dtype=np.float32)
+		num_lists = int(np.clip(4 * np.sqrt(len(vectors)), 1, min(MAX_LISTS, len(training))))
+		centroids = kmeans(training, num_lists, seed=seed)
+		training_residuals = training - centroids[nearest_centroids(training, centroids)]
+		codebooks = np.stack([kmeans(np.ascontiguousarray(training_residuals[:, m * subspace:(m + 1) * subspace]),
+			min(PQ_CENTROIDS, len(training)), seed=seed) for m in range(PQ_SUBSPACES)])
+
+		assignments = nearest_centroids(vectors, centroids)
+		codes = np.empty((len(vectors), PQ_SUBSPACES), dtype=np.uint8)
+		for start in range(0, len(vectors), TRAINING_ROWS):
+			block = slice(start, start + TRAINING_ROWS)
+			residuals = np.asarray(vectors[block], dtype=np.float32) - centroids[assignments[block]]
+			for m in range(PQ_SUBSPACES):
+				codes[block, m] = nearest_centroids(residuals[:, m * subspace:(m + 1) * subspace], codebooks[m])
+		rows = np.argsort(assignments, kind='stable')
+		list_offsets = np.concatenate([[0], np.cumsum(np.bincount(assignments, minlength=num_lists))])
+		return cls(centroids, codebooks, codes[rows], list_offsets, rows, frame_offsets)
+
+	@staticmethod
+	def exists(directory):
+		return os.path.exists(os.path.join(directory, 'histogram_index_centroids.npy'))
+
+	@classmethod
+	def load(cls, directory, frame_offsets):
+		"""Memory-map a saved index; frame_offsets are the offsets of the store's frame_histograms column."""
+		def path(name):
+			return os.path.join(directory, f'histogram_index_{name}.npy')
+		return cls(np.load(path('centroids')), np.load(path('codebooks')), np.load(path('codes'), mmap_mode='r'),
+			np.load(path('list_offsets')), np.load(path('rows'), mmap_mode='r'), frame_offsets)
+
+	def save(self, directory):
+		for name in ('centroids', 'codebooks', 'codes', 'list_offsets', 'rows'):
+			np.save(os.path.join(directory, f'histogram_index_{name}.npy'), getattr(self, name))
+
+	def search(self, vector, neighbours=NEIGHBOURS, probes=PROBES):
+		"""
+		Approximate nearest library frames of one vector.
+
+		Returns:
+		ndarray: Up to neighbours rows of the frame_histograms column, nearest first.
+		"""
+		if not len(self.centroids):
+			return np.empty(0, dtype=np.int64)
+		vector = np.asarray(vector, dtype=np.float32)
+		coarse = squared_distances(vector[None, :], self.centroids)[0]
+		nearest_lists = np.argsort(coarse)[:probes]
+		subspace = self.codebooks.shape[2]
+		rows = []
+		distances = []
+		for list_index in nearest_lists:
+			start, end = self.list_offsets[list_index], self.list_offsets[list_index + 1]
+			if start == end:
+				continue
+			residual = (vector - self.centroids[list_index]).reshape(PQ_SUBSPACES, 1, subspace)
+			tables = ((residual - self.codebooks) ** 2).sum(axis=2)
+			codes = np.asarray(self.codes[start:end], dtype=np.int64)
+			distances.append(tables[np.arange(PQ_SUBSPACES)[None, :], codes].sum(axis=1))
+			rows.append(np.asarray(self.rows[start:end]))
+		if not rows:
+			return np.empty(0, dtype=np.int64)
+		rows = np.concatenate(rows)
+		distances = np.concatenate(distances)
+		nearest = np.argsort(distances, kind='stable')[:neighbours]
+		return rows[nearest]
+
+	def candidate_starts(self, key_vectors, key_frame_indices, max_candidates=MAX_CANDIDATES, min_votes=MIN_VOTES,
+		max_key_frames=MAX_KEY_FRAMES):
+		"""
+		Clip starts across the whole library that the key frames' nearest frames agree on.
+
+		Up to max_key_frames key frames, spread evenly over the clip, are looked up. Every
+		neighbour of key frame j at frame f of a video votes for that video starting the
+		clip at f - key_frame_indices[j], at most once per key frame.
+
+		Returns:
+		list: Up to max_candidates (video index, start frame, votes), most votes first.
+		"""
+		chosen = np.unique(np.linspace(0, len(key_frame_indices) - 1, min(max_key_frames, len(key_frame_indices))).round().astype(np.int64))
+		videos = []
+		starts = []
+		for vector, key_frame_index in zip(np.asarray(key_vectors)[chosen], np.asarray(key_frame_indices)[chosen]):
+			rows = self.search(vector)
+			video_indices = np.searchsorted(self.frame_offsets, rows, side='right') - 1
+			key_starts = rows - self.frame_offsets[video_indices] - key_frame_index
+			votes = np.unique(np.stack([video_indices[key_starts >= 0], key_starts[key_starts >= 0]]), axis=1)
+			videos.append(votes[0])
+			starts.append(votes[1])
+		if not videos:
+			return []
+		pairs, counts = np.unique(np.stack([np.concatenate(videos), np.concatenate(starts)]), axis=1, return_counts=True)
+		best = np.argsort(-counts, kind='stable')[:max_candidates]
+		return [(int(pairs[0, i]), int(pairs[1, i]), int(counts[i])) for i in best if counts[i] >= min_votes]
@@ -0,0 +1,89 @@
+import os
+import threading
+
+import cv2
+import numpy as np
+
+from rgb_verification import FRAME_HEIGHT, FRAME_WIDTH, map_rgb_file
+from signature_store import SignatureStore, store_exists
+
+# Frames kept in memory around the current one, about 9 MB at 352x288, and how many of them lie before it
+BUFFER_FRAMES = 32
+FRAMES_BEHIND = 4
+
+class RgbFrameSource:
+	"""
+	Frames of a database video read straight from its memory-mapped .rgb file.
+
+	Frame count, fps and geometry come from the signature store, so opening a video
+	decodes nothing. The frames around the last requested one are copied into a ring
+	buffer by a background thread: slot i % BUFFER_FRAMES holds frame i, so any run of
+	BUFFER_FRAMES consecutive frames fits without evicting itself.
+	"""
+
+	def __init__(self, rgb_path, fps, frame_count, width=FRAME_WIDTH, height=FRAME_HEIGHT, buffer_frames=BUFFER_FRAMES):
+		self.fps = fps
+		self.width = width
+		self.height = height
+		self.frames = map_rgb_file(rgb_path, width, height)
+		self.frame_count = min(int(frame_count), len(self.frames))
+		self.buffer = np.empty((buffer_frames, height, width, 3), dtype=np.uint8)
+		self.buffered = np.full(buffer_frames, -1, dtype=np.int64)
+		self.lock = threading.Lock()
+		self.prefetch_center = None
+
+	@classmethod
+	def open(cls, video_path, signature_directory=None):
+		"""
+		Frame source for a video, described by the signature store at signature_directory.
+
+		A video the store does not know is probed once with OpenCV instead.
+		"""
+		rgb_path = f"{os.path.splitext(video_path)[0]}.rgb"
+		if signature_directory is not None and store_exists(signature_directory):
+			store = SignatureStore(signature_directory)
+			if video_path in store.video_indices:
+				return cls(rgb_path, store.fps(video_path), store.frame_count(video_path), *store.geometry(video_path))
+		cap = cv2.VideoCapture(video_path)
+		fps = cap.get(cv2.CAP_PROP_FPS)
+		frame_count = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+		width, height = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)), int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+		cap.release()
+		return cls(rgb_path, fps, frame_count, width or FRAME_WIDTH, height or FRAME_HEIGHT)
+
+	def frame_to_ms(self, frame_index):
+		"""Start of a frame in milliseconds, at the video's own fps."""
+		return int(round(frame_index * 1000 / self.fps))
+
+	def _load(self, frame_index):
+		"""Slot holding frame_index, read into the buffer if needed; the caller holds self.lock."""
+		slot = frame_index % len(self.buffer)
+		if self.buffered[slot] != frame_index:
+			self.buffer[slot] = self.frames[frame_index]
+			self.buffered[slot] = frame_index
+		return slot
+
+	def frame(self, frame_index):
+		"""One (height, width, 3) RGB frame, from the ring buffer when it has been prefetched."""
+		frame_index = min(max(int(frame_index), 0), self.frame_count - 1)
+		# Copied in the same critical section as the load, so a prefetch cannot overwrite the slot first
+		with self.lock:
+			return self.buffer[self._load(frame_index)].copy()
+
+	def prefetch(self, center):
+		"""Fill the ring buffer with the frames around center, FRAMES_BEHIND of them before it."""
+		self.prefetch_center = center
+		first = max(center - FRAMES_BEHIND, 0)
+		for frame_index in range(first, min(first + len(self.buffer), self.frame_count)):
+			# A newer seek moved the window, so its prefetch takes over
+			if self.prefetch_center != center:
+				return
+			with self.lock:
+				self._load(frame_index)
+
+	def prefetch_async(self, center):
+		"""prefetch in a background thread, so showing the current frame never waits for it."""
+		self.prefetch_center = center
+		thread = threading.Thread(target=self.prefetch, args=(center,), daemon=True)
+		thread.start()
+		return thread
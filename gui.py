@@ -2,11 +2,10 @@ import sys
 import time
 import os
 
-import cv2
 from PyQt5.QtCore import QTimer, Qt
 from PyQt5.QtCore import QUrl
+from PyQt5.QtGui import QImage, QPixmap
 from PyQt5.QtMultimedia import QMediaContent, QMediaPlayer
-from PyQt5.QtMultimediaWidgets import QVideoWidget
 from PyQt5.QtWidgets import QApplication
 from PyQt5.QtWidgets import (
     QWidget,
@@ -17,23 +16,31 @@ from PyQt5.QtWidgets import (
     QSlider,
 )
 
+from frame_source import RgbFrameSource
+
 
 class VideoPlayer(QWidget):
-    __TICK_INTERVAL = 200
-    __FRAME_RATE = 30
+    """
+    Shows a matched video from its .rgb file, starting at the matched frame.
+
+    Frames come from an RgbFrameSource, so the matched frame is on screen as soon as the
+    window opens and every seek lands on the exact frame. The QMediaPlayer only plays
+    the sound, kept in step with the frames on play and seek.
+    """
 
-    def __init__(self, file_path: str, start_frame: int):
+    def __init__(self, file_path: str, start_frame: int, signature_directory: str = None):
         super().__init__()
         self.start_frame = start_frame
         self.file_path = file_path
-        self.total_frames = VideoPlayer.__total_video_frames(file_path)
+        self.frames = RgbFrameSource.open(file_path, signature_directory)
+        self.total_frames = self.frames.frame_count
+        self.current_frame = start_frame
         self.video_name = os.path.basename(file_path)  # Get video name
-        self.total_length_ms = VideoPlayer.__frame_to_ms(self.total_frames)
+        self.total_length_ms = self.frames.frame_to_ms(self.total_frames)
         print(f"Total length: {self.total_length_ms}")
         print(f"Total Frames: {self.total_frames}")
         print(f"Start Frame: {self.start_frame}")
         print(f"Video Name: {self.video_name}")
-        print(self.total_frames)
         self.__initUI()
 
     def __initUI(self):
@@ -42,8 +49,6 @@ class VideoPlayer(QWidget):
         self.setWindowTitle("Video Player")
         self.setGeometry(200, 200, 850, 850)
 
-        # Video display
-        self.label = QLabel(self)
         # Main layout
         self.vbox = QVBoxLayout()
 
@@ -51,32 +56,21 @@ class VideoPlayer(QWidget):
         self.info_label = QLabel(f"Matched Frame: {self.start_frame} | to Video: {self.video_name}", self)
         self.vbox.addWidget(self.info_label)
 
+        # Video display, drawn from the .rgb frames
+        self.label = QLabel(self)
+        self.label.setFixedSize(self.frames.width, self.frames.height)
         self.vbox.addWidget(self.label)
         self.setLayout(self.vbox)
 
-        self.video = QVideoWidget()
-        # self.video.move(0, 0)
+        # Sound only, the frames are drawn by __show_frame
         self.player = QMediaPlayer()
-
-        video_resolution = self.__get_video_resolution(self.file_path)
-        if video_resolution:
-            self.video.setFixedSize(*video_resolution)
-        self.player.setVideoOutput(self.video)
         self.player.setMedia(QMediaContent(QUrl.fromLocalFile(self.file_path)))
-        self.player.setPosition(VideoPlayer.__frame_to_ms(self.start_frame))
-        self.video.show()
-        self.player.play()
-        time.sleep(0.001)
-        self.player.pause()
-        self.vbox.addWidget(self.video)
 
         self.seek_slider = QSlider(Qt.Horizontal)
         self.seek_slider.setMinimum(0)
-        self.seek_slider.setMaximum(self.total_frames)
+        self.seek_slider.setMaximum(max(self.total_frames - 1, 0))
         self.seek_slider.setValue(self.start_frame)
-        # self.seek_slider.sliderMoved.connect(self.__seek_move)
         self.seek_slider.sliderReleased.connect(self.__seek)
-        # self.seek_slider.sliderPressed.connect(self.__seek)
         self.vbox.addWidget(self.seek_slider)
 
         # Buttons
@@ -104,20 +98,46 @@ class VideoPlayer(QWidget):
         self.bbox.addWidget(self.target_button)
         self.target_button.clicked.connect(self.__go_to_start_frame)
 
+        # Ticks at the video's frame rate while playing; the frame shown is the one due at the
+        # elapsed time, so a late tick skips frames instead of slowing the video down
         self.timer = QTimer(self)
-        self.timer.setInterval(self.__TICK_INTERVAL)
+        self.timer.setTimerType(Qt.PreciseTimer)
+        self.timer.setInterval(max(int(1000 / self.frames.fps), 1))
         self.timer.timeout.connect(self.__update_timer)
-        self.adjustSize()
-        self.timer.start()
+        self.play_started = None
 
         # Timestamp Label
         self.timestamp_label = QLabel("00:00:00", self)
         self.vbox.addWidget(self.timestamp_label, alignment=Qt.AlignCenter)
 
+        self.__show_frame(self.start_frame)
+        self.adjustSize()
+
+    def __show_frame(self, frame_index: int):
+        """Draw one frame, refilling the prefetch buffer around it after a jump or halfway through it."""
+        if not self.total_frames:
+            return
+        frame_index = min(max(frame_index, 0), self.total_frames - 1)
+        previous_frame = self.current_frame
+        self.current_frame = frame_index
+        prefetched = self.frames.prefetch_center
+        if prefetched is None or abs(frame_index - previous_frame) > 1 or frame_index - prefetched >= len(self.frames.buffer) // 2:
+            self.frames.prefetch_async(frame_index)
+        frame = self.frames.frame(frame_index)
+        image = QImage(frame.data, self.frames.width, self.frames.height, 3 * self.frames.width, QImage.Format_RGB888)
+        self.label.setPixmap(QPixmap.fromImage(image))
+        self.seek_slider.setValue(frame_index)
+        self.timestamp_label.setText(self.__format_time(self.frames.frame_to_ms(frame_index)))
+
     def __go_to_start_frame(self):
         """Move video to the start frame."""
-        self.player.setPosition(VideoPlayer.__frame_to_ms(self.start_frame))
-        self.seek_slider.setValue(self.start_frame)
+        self.__move_to(self.start_frame)
+
+    def __move_to(self, frame_index: int):
+        self.__show_frame(frame_index)
+        self.player.setPosition(self.frames.frame_to_ms(self.current_frame))
+        if self.play_started is not None:
+            self.play_started = (time.perf_counter(), self.current_frame)
 
     def __format_time(self, current_ms: int) -> str:
         """Format current and total time into a string."""
@@ -126,6 +146,8 @@ class VideoPlayer(QWidget):
         return f"Timestamp: {current_time_str} / {total_time_str}"
 
     def __play(self):
+        self.play_started = (time.perf_counter(), self.current_frame)
+        self.player.setPosition(self.frames.frame_to_ms(self.current_frame))
         self.player.play()
         self.play_button.setEnabled(False)
         self.pause_button.setEnabled(True)
@@ -133,54 +155,26 @@ class VideoPlayer(QWidget):
 
     def __pause(self):
         self.player.pause()
+        self.play_started = None
         self.pause_button.setEnabled(False)
         self.play_button.setEnabled(True)
         self.timer.stop()
 
     def __reset(self):
-        self.player.setPosition(VideoPlayer.__frame_to_ms(0))
-        self.seek_slider.setValue(0)
-        self.play_button.setEnabled(True)
-        self.pause_button.setEnabled(False)
-        self.player.pause()
+        self.__pause()
+        self.__move_to(0)
 
     def __seek(self):
-        new_frame = self.seek_slider.value()
-        new_position_ms = self.__frame_to_ms(new_frame)
-        self.seek_slider.setValue(new_frame)
-        self.player.setPosition(new_position_ms)
+        self.__move_to(self.seek_slider.value())
 
     def __update_timer(self):
-        frames_per_tick = int((self.__FRAME_RATE / 1000) * self.__TICK_INTERVAL)
-        current_position_ms = self.player.position()
-        current_frame = int((current_position_ms / 1000) * self.__FRAME_RATE)
-        new_frame = current_frame + frames_per_tick
-        self.seek_slider.setValue(new_frame)
-
-        # Update the timestamp
-        current_position_ms = self.player.position()
-        self.timestamp_label.setText(self.__format_time(current_position_ms))
-
-    @staticmethod
-    def __total_video_frames(file_path: str):
-        video = cv2.VideoCapture(file_path)
-        frame_count = video.get(cv2.CAP_PROP_FRAME_COUNT)
-        return int(frame_count)
-
-    @staticmethod
-    def __frame_to_ms(frame_number: int):
-        return frame_number // 30 * 1000
-
-    @staticmethod
-    def __get_video_resolution(file_path):
-        cap = cv2.VideoCapture(file_path)
-        if not cap.isOpened():
-            return None
-
-        width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
-        height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
-        cap.release()
-        return width, height
+        started_at, first_frame = self.play_started
+        frame_index = first_frame + int((time.perf_counter() - started_at) * self.frames.fps)
+        if frame_index >= self.total_frames:
+            self.__pause()
+            frame_index = self.total_frames - 1
+        if frame_index != self.current_frame:
+            self.__show_frame(frame_index)
 
     @staticmethod
     def __convert_ms_to_time_str(ms: int) -> str:
@@ -191,10 +185,17 @@ class VideoPlayer(QWidget):
         return f"{minutes % 60:02}:{seconds % 60:02}"
 
 
-def play_video(file_path, start_frame):
-    app = QApplication(sys.argv)
-    v = VideoPlayer(file_path, start_frame)
+def launch_player(file_path, start_frame, signature_directory=None):
+    """Open the player window, returning once the matched frame is on screen."""
+    app = QApplication.instance() or QApplication(sys.argv)
+    v = VideoPlayer(file_path, start_frame, signature_directory)
     v.show()
+    app.processEvents()
+    return app, v
+
+
+def play_video(file_path, start_frame, signature_directory=None):
+    app, v = launch_player(file_path, start_frame, signature_directory)
     app.exec_()
 
 
@@ -203,4 +204,4 @@ def play_video(file_path, start_frame):
 if __name__ == '__main__':
     file_path = sys.argv[1]
     start_frame = int(sys.argv[2])
-    play_video(file_path, start_frame)
\ No newline at end of file
+    play_video(file_path, start_frame, sys.argv[3] if len(sys.argv) > 3 else None)
\ No newline at end of file
@@ -0,0 +1,251 @@
+import os
+from itertools import combinations
+
+import numpy as np
+
+# Distance below which the original per-video scan stopped looking at further segments
+EARLY_STOP_DISTANCE = 5
+
+if hasattr(np, 'bitwise_count'):
+	def popcount64(values):
+		"""Count the set bits of every element of a uint64 array."""
+		return np.bitwise_count(values)
+else:
+	_POPCOUNT_TABLE = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+	def popcount64(values):
+		"""Count the set bits of every element of a uint64 array."""
+		values = np.ascontiguousarray(values, dtype=np.uint64)
+		return _POPCOUNT_TABLE[values.view(np.uint8)].reshape(values.shape + (8,)).sum(axis=-1, dtype=np.uint8)
+
+def pack_hashes(hashes):
+	"""Convert a list of 64-character binary hash strings to a uint64 array."""
+	return np.array([int(bin_str, 2) for bin_str in hashes], dtype=np.uint64)
+
+class HashLibrary:
+	"""
+	All segment hashes of the database in one contiguous uint64 array.
+
+	The hashes of video_paths[i] are hashes[offsets[i]:offsets[i + 1]].
+	"""
+
+	def __init__(self, video_paths, hashes, offsets):
+		self.video_paths = list(video_paths)
+		self.hashes = hashes
+		self.offsets = np.asarray(offsets, dtype=np.int64)
+
+	def video_hashes(self, video_index):
+		return self.hashes[self.offsets[video_index]:self.offsets[video_index + 1]]
+
+def segment_distances(clip_hashes, hashes):
+	"""Hamming distance between every clip hash (rows) and every library hash (columns)."""
+	return popcount64(clip_hashes[:, None] ^ hashes[None, :])
+
+def scanned_row_minimum(distances, offsets):
+	"""
+	Per-video minimum distance of every clip hash, as found by the original early-stopping scan.
+
+	For every clip hash the original loop walked a video's segments in order and stopped
+	at the first one closer than EARLY_STOP_DISTANCE, so that distance is the one kept
+	even when a later segment would have been closer.
+
+	Args:
+	distances (ndarray): (clip hashes, segments) Hamming distances.
+	offsets (ndarray): Segment offsets of each video, with a trailing end offset.
+
+	Returns:
+	ndarray: (clip hashes, videos) minimum distances, inf for videos without segments.
+	"""
+	num_videos = len(offsets) - 1
+	result = np.full((distances.shape[0], num_videos), np.inf)
+	if distances.size == 0:
+		return result
+
+	close = distances < EARLY_STOP_DISTANCE
+	close_before = np.cumsum(close, axis=1, dtype=np.uint32) - close
+	starts = offsets[:-1]
+	# Number of close segments before each segment, counted from the start of its video
+	video_of_segment = np.repeat(np.arange(num_videos), np.diff(offsets))
+	close_at_start = close_before[:, starts[video_of_segment]]
+	scanned = close_before == close_at_start
+	masked = np.where(scanned, distances, np.iinfo(np.uint8).max)
+
+	non_empty = np.flatnonzero(np.diff(offsets) > 0)
+	result[:, non_empty] = np.minimum.reduceat(masked, starts[non_empty], axis=1)
+	return result
+
+def scanned_minimum(distances, offsets):
+	"""Per-video minimum distance over all clip hashes, see scanned_row_minimum."""
+	return scanned_row_minimum(distances, offsets).min(axis=0, initial=np.inf)
+
+def _sorted_matches(video_paths, min_distances):
+	best_matches = [(video_path, int(distance) if np.isfinite(distance) else float('inf'))
+		for video_path, distance in zip(video_paths, min_distances)]
+	return sorted(best_matches, key=lambda x: x[1])
+
+def rank_videos_batch(queries, library, max_cells=1 << 22):
+	"""
+	Rank every library video for many clips in one pass.
+
+	The hashes of all clips are stacked and XOR + popcounted against the whole library
+	at once, in blocks of whole videos sized so that a block's distance matrix has about
+	max_cells entries.
+
+	Args:
+	queries (list): One uint64 array of segment hashes per clip.
+	library (HashLibrary): The packed library hashes.
+
+	Returns:
+	list: For every clip, (video_path, min_distance) tuples sorted from smallest to largest distance.
+	"""
+	queries = [np.asarray(clip_hashes, dtype=np.uint64) for clip_hashes in queries]
+	num_videos = len(library.video_paths)
+	min_distances = np.full((len(queries), num_videos), np.inf)
+	query_offsets = np.concatenate([[0], np.cumsum([len(clip_hashes) for clip_hashes in queries])])
+	rows = np.concatenate(queries) if queries else np.empty(0, dtype=np.uint64)
+	answered = np.flatnonzero(np.diff(query_offsets) > 0)
+	if len(rows):
+		block_size = max(1, max_cells // len(rows))
+		first_video = 0
+		while first_video < num_videos:
+			last_video = int(np.searchsorted(library.offsets, library.offsets[first_video] + block_size, side='right')) - 1
+			last_video = min(max(last_video, first_video + 1), num_videos)
+			start, end = library.offsets[first_video], library.offsets[last_video]
+			distances = segment_distances(rows, np.asarray(library.hashes[start:end]))
+			row_minimum = scanned_row_minimum(distances, library.offsets[first_video:last_video + 1] - start)
+			min_distances[answered, first_video:last_video] = np.minimum.reduceat(row_minimum, query_offsets[answered], axis=0)
+			first_video = last_video
+
+	return [_sorted_matches(library.video_paths, distances) for distances in min_distances]
+
+def rank_videos(clip_hashes, library, max_cells=1 << 22):
+	"""
+	Rank every library video by its minimum Hamming distance to the clip.
+
+	Returns:
+	List of tuples: (video_path, min_distance) sorted from smallest to largest distance.
+	"""
+	return rank_videos_batch([clip_hashes], library, max_cells)[0]
+
+def _flip_masks(bits, max_flips):
+	"""All bit masks of the given width with at most max_flips bits set."""
+	masks = [sum(1 << bit for bit in flipped)
+		for flips in range(min(max_flips, bits) + 1) for flipped in combinations(range(bits), flips)]
+	return np.array(masks, dtype=np.uint64)
+
+def bucket_positions(low, counts):
+	"""Positions of a sorted table covered by the buckets [low, low + counts), concatenated in bucket order."""
+	return np.repeat(low - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+
+class MultiIndexHashTable:
+	"""
+	Multi-index hashing over the library's 64-bit segment hashes.
+
+	Every hash is split into num_substrings sub-words and each sub-word table keeps the
+	segment ids sorted by sub-word, so a bucket is a contiguous run found by binary search.
+	If two hashes are within radius r, at least one of their sub-words differs in at most
+	r // num_substrings bits, so probing those neighbours of every sub-word finds every
+	segment within r without touching the rest of the library.
+	"""
+
+	def __init__(self, sorted_keys, order, num_substrings):
+		self.sorted_keys = sorted_keys
+		self.order = order
+		self.num_substrings = num_substrings
+		self.substring_bits = 64 // num_substrings
+
+	@classmethod
+	def build(cls, hashes, num_substrings=4):
+		if 64 % num_substrings:
+			raise ValueError("num_substrings must divide 64")
+		hashes = np.asarray(hashes, dtype=np.uint64)
+		substrings = cls._split(hashes, num_substrings)
+		order = np.argsort(substrings, axis=1, kind='stable')
+		sorted_keys = np.take_along_axis(substrings, order, axis=1)
+		key_dtype = np.min_scalar_type((1 << (64 // num_substrings)) - 1)
+		order_dtype = np.uint32 if len(hashes) < (1 << 32) else np.int64
+		return cls(sorted_keys.astype(key_dtype), order.astype(order_dtype), num_substrings)
+
+	@staticmethod
+	def exists(directory):
+		return os.path.exists(os.path.join(directory, 'hash_index_keys.npy'))
+
+	@classmethod
+	def load(cls, directory):
+		"""Memory-map a table saved with save(), so buckets are paged in on lookup."""
+		sorted_keys = np.load(os.path.join(directory, 'hash_index_keys.npy'), mmap_mode='r')
+		order = np.load(os.path.join(directory, 'hash_index_order.npy'), mmap_mode='r')
+		return cls(sorted_keys, order, sorted_keys.shape[0])
+
+	def save(self, directory):
+		np.save(os.path.join(directory, 'hash_index_keys.npy'), self.sorted_keys)
+		np.save(os.path.join(directory, 'hash_index_order.npy'), self.order)
+
+	@staticmethod
+	def _split(hashes, num_substrings):
+		bits = 64 // num_substrings
+		shifts = np.arange(num_substrings, dtype=np.uint64) * np.uint64(bits)
+		mask = np.uint64((1 << bits) - 1)
+		return (hashes[None, :] >> shifts[:, None]) & mask
+
+	def candidates(self, clip_hashes, radius):
+		"""Ids of all segments sharing a sub-word bucket within radius // num_substrings bits of a clip hash."""
+		clip_hashes = np.asarray(clip_hashes, dtype=np.uint64)
+		if not len(clip_hashes) or not self.sorted_keys.shape[1]:
+			return np.empty(0, dtype=np.int64)
+		masks = _flip_masks(self.substring_bits, radius // self.num_substrings)
+		substrings = self._split(clip_hashes, self.num_substrings)
+		found = []
+		for i in range(self.num_substrings):
+			probes = np.unique(substrings[i][:, None] ^ masks[None, :]).astype(self.sorted_keys.dtype)
+			low = np.searchsorted(self.sorted_keys[i], probes, side='left')
+			high = np.searchsorted(self.sorted_keys[i], probes, side='right')
+			counts = high - low
+			if not counts.sum():
+				continue
+			positions = bucket_positions(low, counts)
+			found.append(self.order[i][positions].astype(np.int64))
+		if not found:
+			return np.empty(0, dtype=np.int64)
+		return np.unique(np.concatenate(found))
+
+	def search(self, clip_hashes, library_hashes, radius):
+		"""
+		Find all segments within Hamming distance radius of any clip hash.
+
+		Returns:
+		Tuple: (segment ids, minimum distance of each segment to the clip).
+		"""
+		clip_hashes = np.asarray(clip_hashes, dtype=np.uint64)
+		segment_ids = self.candidates(clip_hashes, radius)
+		if not len(segment_ids):
+			return segment_ids, np.empty(0, dtype=np.uint8)
+		distances = segment_distances(clip_hashes, np.asarray(library_hashes[segment_ids])).min(axis=0)
+		within = distances <= radius
+		return segment_ids[within], distances[within]
+
+def rank_videos_indexed(clip_hashes, library, hash_index, radius=10):
+	"""
+	Rank videos using the multi-index table instead of scanning the whole library.
+
+	Only videos with a segment within radius of the clip are scored, over their own
+	segments, exactly as rank_videos would. Every other video follows with distance inf.
+	If nothing is within radius the full scan is used, so a ranking is always returned.
+	"""
+	clip_hashes = np.asarray(clip_hashes, dtype=np.uint64)
+	segment_ids, _ = hash_index.search(clip_hashes, library.hashes, radius)
+	if not len(segment_ids):
+		return rank_videos(clip_hashes, library)
+
+	hit_videos = np.unique(np.searchsorted(library.offsets, segment_ids, side='right') - 1)
+	best_matches = []
+	for video_index in hit_videos:
+		distances = segment_distances(clip_hashes, np.asarray(library.video_hashes(video_index)))
+		distance = scanned_minimum(distances, np.array([0, distances.shape[1]]))[0]
+		best_matches.append((library.video_paths[video_index], int(distance)))
+	best_matches.sort(key=lambda x: x[1])
+
+	hit = set(hit_videos.tolist())
+	best_matches.extend((video_path, float('inf')) for video_index, video_path in enumerate(library.video_paths)
+		if video_index not in hit)
+	return best_matches
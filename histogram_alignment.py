@@ -0,0 +1,360 @@
+import os
+
+import numpy as np
+
+from instrumentation import count, span
+
+# cv2.compareHist returns 1 when the variance product of the two histograms is below this
+DBL_EPSILON = np.finfo(np.float64).eps
+# Temporal subsampling of the pyramid levels, and the bins each level keeps of the 8x8x8 histograms
+PYRAMID_STEPS = (2, 4, 8, 16)
+PYRAMID_BINS = 64
+# Offsets kept at each pyramid level before moving to the next finer one
+BEAM_WIDTH = 16
+# How far below frame_threshold the best coarsest-level score of a video may be before its
+# pyramid pass is skipped. The coarse score is no bound on the full one (short shots blur
+# together on the coarse levels), so such a video still gets the full scan.
+PYRAMID_SKIP_MARGIN = 0.25
+# Dimensions of the compact histograms, the int8 value a projected component of 1 is stored
+# as, the uint8 value a residual norm of 1 is stored as, and how many library frames the
+# projection is learned from
+COMPACT_DIMENSIONS = 64
+COMPACT_SCALE = 127
+RESIDUAL_SCALE = 255
+PROJECTION_SAMPLE_ROWS = 65536
+# Allowance for the int8 rounding of the compact histograms when they are compared with frame_threshold
+COMPACT_TOLERANCE = 0.02
+
+def normalize_histograms(histograms):
+	"""
+	Center and L2-normalize histograms so that the dot product of two of them equals
+	cv2.compareHist(h1, h2, cv2.HISTCMP_CORREL).
+
+	Returns:
+	Tuple: (normalized histograms, sum of squared deviations of each histogram).
+	"""
+	histograms = np.asarray(histograms, dtype=np.float64)
+	centered = histograms - histograms.mean(axis=-1, keepdims=True)
+	variances = np.einsum('...i,...i->...', centered, centered)
+	norms = np.sqrt(variances)
+	return centered / np.where(norms > 0, norms, 1)[..., None], variances
+
+def correlation_matrix(normalized_a, variances_a, normalized_b, variances_b):
+	"""HISTCMP_CORREL between every row of a and every row of b, with OpenCV's flat-histogram rule."""
+	scores = normalized_a @ normalized_b.T
+	flat = np.outer(variances_a, variances_b) <= DBL_EPSILON
+	if flat.any():
+		scores[flat] = 1.0
+	return scores
+
+def reduce_bins(histograms, bins=PYRAMID_BINS):
+	"""Merge neighbouring bins of 8x8x8 color histograms per channel, down to bins = n**3 bins."""
+	per_channel = round(bins ** (1 / 3))
+	factor = 8 // per_channel
+	histograms = np.asarray(histograms, dtype=np.float64).reshape(-1, per_channel, factor, per_channel, factor, per_channel, factor)
+	return histograms.sum(axis=(2, 4, 6)).reshape(-1, per_channel ** 3)
+
+def histogram_pyramid(frame_histograms, steps=PYRAMID_STEPS, bins=PYRAMID_BINS):
+	"""
+	Temporal pyramid of a video's frame histograms.
+
+	Level step holds one histogram per run of step frames: the average of the run, reduced to
+	bins bins and already normalized like normalize_histograms, so scoring it is a dot product.
+
+	Returns:
+	dict: step -> (ceil(frames / step), bins) float32 array.
+	"""
+	reduced = reduce_bins(frame_histograms, bins)
+	levels = {}
+	for step in steps:
+		if not len(reduced):
+			levels[step] = np.empty((0, reduced.shape[1]), dtype=np.float32)
+			continue
+		starts = np.arange(0, len(reduced), step)
+		averages = np.add.reduceat(reduced, starts, axis=0) / np.diff(np.append(starts, len(reduced)))[:, None]
+		levels[step] = normalize_histograms(averages)[0].astype(np.float32)
+	return levels
+
+class HistogramProjection:
+	"""
+	Learned projection of normalized frame histograms down to COMPACT_DIMENSIONS.
+
+	The basis is the top eigenvectors of the second-moment matrix of a sample of the
+	library's normalized histograms. Every histogram is kept as its projection, stored
+	as int8, and the norm of what the projection leaves out, stored as uint8: 65 bytes
+	a frame instead of the 2 KB of a float32 histogram. The correlation of two histograms
+	is the dot product of their projections plus that of their residuals, so it is at
+	most the projected dot product plus the product of the two residual norms.
+	"""
+
+	def __init__(self, basis):
+		self.basis = np.asarray(basis, dtype=np.float32)
+
+	@classmethod
+	def fit(cls, frame_histograms, dimensions=COMPACT_DIMENSIONS, sample_rows=PROJECTION_SAMPLE_ROWS):
+		step = max(len(frame_histograms) // sample_rows, 1)
+		sample = normalize_histograms(np.asarray(frame_histograms[::step]).reshape(-1, frame_histograms.shape[-1]))[0]
+		_, eigenvectors = np.linalg.eigh(sample.T @ sample)
+		# eigh sorts eigenvalues in increasing order
+		return cls(eigenvectors[:, ::-1][:, :dimensions])
+
+	def project(self, histograms):
+		"""
+		Project histograms without quantizing them.
+
+		Returns:
+		Tuple: (float32 projections, norm of the part of each normalized histogram the projection leaves out).
+		"""
+		normalized, _ = normalize_histograms(histograms)
+		projected = normalized @ self.basis
+		lengths = np.einsum('ij,ij->i', normalized, normalized)
+		residuals = np.sqrt(np.maximum(lengths - np.einsum('ij,ij->i', projected, projected), 0))
+		return projected.astype(np.float32), residuals.astype(np.float32)
+
+	def compact(self, frame_histograms, block_rows=PROJECTION_SAMPLE_ROWS):
+		"""
+		Quantized projections of frame_histograms, computed a block at a time so a memmap is never read whole.
+
+		Residual norms are rounded up, so the correlation bound still holds after quantization.
+
+		Returns:
+		Tuple: ((frames, dimensions) int8 projections, (frames,) uint8 residual norms).
+		"""
+		compact = np.empty((len(frame_histograms), self.basis.shape[1]), dtype=np.int8)
+		residuals = np.empty(len(frame_histograms), dtype=np.uint8)
+		for start in range(0, len(frame_histograms), block_rows):
+			projected, residual = self.project(frame_histograms[start:start + block_rows])
+			compact[start:start + block_rows] = np.clip(np.rint(projected * COMPACT_SCALE), -COMPACT_SCALE, COMPACT_SCALE)
+			residuals[start:start + block_rows] = np.minimum(np.ceil(residual * RESIDUAL_SCALE), RESIDUAL_SCALE)
+		return compact, residuals
+
+	@staticmethod
+	def exists(directory):
+		return os.path.exists(os.path.join(directory, 'histogram_projection.npy'))
+
+	@classmethod
+	def load(cls, directory):
+		"""The projection and the memory-mapped compact histograms and residual norms saved with it."""
+		projection = cls(np.load(os.path.join(directory, 'histogram_projection.npy')))
+		compact = np.load(os.path.join(directory, 'compact_histograms.npy'), mmap_mode='r')
+		residuals = np.load(os.path.join(directory, 'compact_residuals.npy'), mmap_mode='r')
+		return projection, compact, residuals
+
+	def save(self, directory, compact, residuals):
+		np.save(os.path.join(directory, 'histogram_projection.npy'), self.basis)
+		np.save(os.path.join(directory, 'compact_histograms.npy'), compact)
+		np.save(os.path.join(directory, 'compact_residuals.npy'), residuals)
+
+class HistogramAligner:
+	"""
+	Scores a clip's key frames against every candidate start offset of a video at once.
+
+	The database histograms of a window are normalized once and multiplied with the
+	key-frame histograms in a single matmul. The score of key frame j at offset i is
+	then gathered from row i + key_frame_indices[j] of that product.
+	"""
+
+	def __init__(self, key_frame_histograms, key_frame_indices, block_size=4096):
+		self.key_frame_histograms = np.asarray(key_frame_histograms)
+		self.key_histograms, self.key_variances = normalize_histograms(key_frame_histograms)
+		self.key_frame_indices = np.asarray(key_frame_indices, dtype=np.int64)
+		self.block_size = block_size
+		self.reduced_key_histograms = {}
+		self.projected_key_histograms = None
+
+	def boundary_similarities(self, histogram, frame_histograms, shot_boundaries):
+		"""Correlation of one histogram with the frame at every shot boundary."""
+		count('histograms_compared', len(shot_boundaries))
+		with span('histogram_alignment'):
+			normalized, variance = normalize_histograms(np.asarray(histogram)[None, :])
+			boundary_histograms, boundary_variances = normalize_histograms(np.asarray(frame_histograms[shot_boundaries]))
+			return correlation_matrix(boundary_histograms, boundary_variances, normalized, variance)[:, 0]
+
+	def offset_scores(self, frame_histograms, start_index, end_index):
+		"""
+		Score every key frame at every start offset in [start_index, end_index].
+
+		Returns:
+		ndarray: (offsets, key frames) correlations, -inf where the key frame falls past the video.
+		"""
+		num_frames = len(frame_histograms)
+		offsets = np.arange(start_index, end_index + 1)
+		window_end = min(end_index + int(self.key_frame_indices.max(initial=0)), num_frames - 1)
+		if window_end < start_index:
+			return np.full((len(offsets), len(self.key_frame_indices)), -np.inf)
+
+		count('histograms_compared', len(offsets) * len(self.key_frame_indices))
+		with span('histogram_alignment'):
+			window, window_variances = normalize_histograms(np.asarray(frame_histograms[start_index:window_end + 1]))
+			products = correlation_matrix(window, window_variances, self.key_histograms, self.key_variances)
+			rows = offsets[:, None] - start_index + self.key_frame_indices[None, :]
+			in_range = rows < len(window)
+			scores = products[np.minimum(rows, len(window) - 1), np.arange(len(self.key_frame_indices))[None, :]]
+			scores[~in_range] = -np.inf
+			return scores
+
+	def segment_candidates(self, frame_histograms, start_index, end_index, frame_threshold, found_match=None):
+		"""
+		Find the start offsets where every key frame scores above frame_threshold.
+
+		found_match is checked before every block; once it is set the search stops and
+		returns no candidates.
+
+		Returns:
+		Tuple: (candidate offsets in increasing order, average similarity of each).
+		"""
+		indices = []
+		similarities = []
+		for block_start in range(start_index, end_index + 1, self.block_size):
+			if found_match is not None and found_match.is_set():
+				return np.empty(0, dtype=np.int64), np.empty(0)
+			block_end = min(block_start + self.block_size - 1, end_index)
+			scores = self.offset_scores(frame_histograms, block_start, block_end)
+			above = (scores > frame_threshold).all(axis=1)
+			indices.append(np.flatnonzero(above) + block_start)
+			similarities.append(scores[above].mean(axis=1))
+		if not indices:
+			return np.empty(0, dtype=np.int64), np.empty(0)
+		return np.concatenate(indices), np.concatenate(similarities)
+
+	def compact_candidates(self, projection, compact, residuals, frame_histograms, start_index, end_index, frame_threshold,
+		tolerance=COMPACT_TOLERANCE, found_match=None):
+		"""
+		segment_candidates run on the compact histograms, confirmed at full precision.
+
+		Every offset gets an upper bound on each key frame's correlation from compact and
+		residuals, the video's quantized projections and residual norms. Offsets where every
+		bound reaches frame_threshold - tolerance are rescored with scores_at, and only those
+		full-precision scores decide which offsets are returned.
+
+		Args:
+		projection (HistogramProjection): The projection compact was made with.
+		compact (ndarray): The video's int8 projected histograms, one row per frame.
+		residuals (ndarray): The video's uint8 residual norms, one per frame.
+		found_match: Cancellation checked before every block, as in segment_candidates.
+
+		Returns:
+		Tuple: (candidate offsets in increasing order, average similarity of each).
+		"""
+		if self.projected_key_histograms is None or self.projected_key_histograms[0] is not projection:
+			self.projected_key_histograms = (projection, *projection.project(self.key_frame_histograms))
+		_, key_histograms, key_residuals = self.projected_key_histograms
+		num_frames = len(compact)
+		survivors = []
+		for block_start in range(start_index, end_index + 1, self.block_size):
+			if found_match is not None and found_match.is_set():
+				return np.empty(0, dtype=np.int64), np.empty(0)
+			block_end = min(block_start + self.block_size - 1, end_index)
+			offsets = np.arange(block_start, block_end + 1)
+			window_end = min(block_end + int(self.key_frame_indices.max(initial=0)), num_frames - 1)
+			if window_end < block_start:
+				continue
+			count('compact_histograms_compared', len(offsets) * len(self.key_frame_indices))
+			with span('histogram_alignment'):
+				window = slice(block_start, window_end + 1)
+				bounds = np.asarray(compact[window], dtype=np.float32) @ (key_histograms.T / COMPACT_SCALE)
+				bounds += np.asarray(residuals[window], dtype=np.float32)[:, None] * (key_residuals[None, :] / RESIDUAL_SCALE)
+				rows = offsets[:, None] - block_start + self.key_frame_indices[None, :]
+				scores = bounds[np.minimum(rows, len(bounds) - 1), np.arange(len(self.key_frame_indices))[None, :]]
+				scores[rows >= len(bounds)] = -np.inf
+				survivors.append(offsets[(scores >= frame_threshold - tolerance).all(axis=1)])
+		offsets = np.concatenate(survivors) if survivors else np.empty(0, dtype=np.int64)
+		if not len(offsets):
+			return offsets, np.empty(0)
+		scores = self.scores_at(frame_histograms, offsets)
+		above = (scores > frame_threshold).all(axis=1)
+		return offsets[above], scores[above].mean(axis=1)
+
+	def scores_at(self, frame_histograms, offsets):
+		"""
+		Score every key frame at the given start offsets only.
+
+		Only the frames those offsets touch are read and normalized, which is what keeps
+		scoring a few scattered windows cheap.
+
+		Returns:
+		ndarray: (offsets, key frames) correlations, -inf where the key frame falls past the video.
+		"""
+		rows = np.asarray(offsets, dtype=np.int64)[:, None] + self.key_frame_indices[None, :]
+		count('histograms_compared', rows.size)
+		with span('histogram_alignment'):
+			in_range = rows < len(frame_histograms)
+			unique_rows, inverse = np.unique(np.minimum(rows, len(frame_histograms) - 1), return_inverse=True)
+			normalized, variances = normalize_histograms(np.asarray(frame_histograms[unique_rows]))
+			inverse = inverse.reshape(rows.shape)
+			scores = np.einsum('okb,kb->ok', normalized[inverse], self.key_histograms)
+			flat = variances[inverse] * self.key_variances[None, :] <= DBL_EPSILON
+			scores[flat] = 1.0
+			scores[~in_range] = -np.inf
+			return scores
+
+	def level_scores(self, level, step, offsets):
+		"""Approximate scores of the key frames at the given offsets against one pyramid level."""
+		count('coarse_histograms_compared', len(offsets) * len(self.key_frame_indices))
+		with span('histogram_alignment'):
+			bins = level.shape[1]
+			if bins not in self.reduced_key_histograms:
+				self.reduced_key_histograms[bins] = normalize_histograms(reduce_bins(self.key_frame_histograms, bins))[0]
+			entries = (np.asarray(offsets, dtype=np.int64)[:, None] + self.key_frame_indices[None, :]) // step
+			in_range = entries < len(level)
+			unique_entries, inverse = np.unique(np.minimum(entries, len(level) - 1), return_inverse=True)
+			inverse = inverse.reshape(entries.shape)
+			rows = np.asarray(level[unique_entries], dtype=np.float64)
+			if len(unique_entries) < len(entries):
+				# Dense grids touch few distinct entries, so score each entry against every key frame once
+				scores = (rows @ self.reduced_key_histograms[bins].T)[inverse, np.arange(entries.shape[1])[None, :]]
+			else:
+				scores = np.einsum('okb,kb->ok', rows[inverse], self.reduced_key_histograms[bins])
+			scores[~in_range] = -np.inf
+			return scores
+
+	def coarse_score(self, pyramid, start_index, end_index):
+		"""Best average score of the key frames against the coarsest pyramid level, over the offsets in [start_index, end_index]."""
+		if not pyramid:
+			return np.inf
+		step = max(pyramid)
+		offsets = np.arange(start_index // step * step, end_index + 1, step)
+		if not len(offsets):
+			return -np.inf
+		return float(self.level_scores(pyramid[step], step, offsets).mean(axis=1).max())
+
+	def pyramid_candidates(self, pyramid, frame_histograms, start_index, end_index, frame_threshold, beam_width=BEAM_WIDTH,
+		found_match=None):
+		"""
+		Coarse-to-fine version of segment_candidates.
+
+		Offsets on the coarsest grid of the segment are scored against the coarsest level;
+		the beam_width best survive, and each is replaced by itself and its two neighbours on
+		the next finer grid, down to single frames. Only those last offsets are scored at full
+		resolution and checked against frame_threshold, so a segment of n frames costs about
+		n / max step coarse comparisons per key frame instead of n full ones.
+
+		Args:
+		pyramid (dict): step -> pyramid level of the video, as built by histogram_pyramid.
+		found_match: Cancellation checked before every level, as in segment_candidates.
+
+		Returns:
+		Tuple: (candidate offsets in increasing order, average similarity of each).
+		"""
+		if not pyramid:
+			return self.segment_candidates(frame_histograms, start_index, end_index, frame_threshold, found_match)
+		steps = sorted(pyramid, reverse=True)
+		offsets = np.arange(start_index // steps[0] * steps[0], end_index + 1, steps[0])
+		previous_step = None
+		# Step 1 is the full-resolution histograms
+		for step in steps + [1]:
+			if previous_step is not None:
+				children = np.arange(-(previous_step // 2), previous_step // 2 + 1, step)
+				offsets = np.unique((offsets[:, None] + children[None, :]).ravel())
+			offsets = offsets[(offsets >= max(start_index - step + 1, 0)) & (offsets <= end_index)]
+			if not len(offsets) or (found_match is not None and found_match.is_set()):
+				return np.empty(0, dtype=np.int64), np.empty(0)
+			if step == 1:
+				break
+			averages = self.level_scores(pyramid[step], step, offsets).mean(axis=1)
+			offsets = offsets[np.argsort(-averages, kind='stable')[:beam_width]]
+			previous_step = step
+
+		scores = self.scores_at(frame_histograms, offsets)
+		above = (scores > frame_threshold).all(axis=1)
+		return offsets[above], scores[above].mean(axis=1)
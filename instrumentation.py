@@ -0,0 +1,204 @@
+import contextvars
+import cProfile
+import io
+import json
+import os
+import pstats
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+_active_trace = contextvars.ContextVar('active_trace', default=None)
+# tracemalloc and its peak are process-wide, so profiled traces take turns
+_profile_lock = threading.Lock()
+
+# Where finished traces are appended as JSON lines, and whether queries are profiled;
+# set from the environment here and overridden with configure()
+settings = {
+	'trace_path': os.environ.get('VIDEO_SEARCH_TRACE') or None,
+	'profile': bool(os.environ.get('VIDEO_SEARCH_PROFILE')),
+}
+
+def configure(trace_path=None, profile=None):
+	"""Set the JSON trace file and whether every trace runs cProfile and tracemalloc."""
+	if trace_path is not None:
+		settings['trace_path'] = trace_path
+	if profile is not None:
+		settings['profile'] = profile
+	if profile:
+		start_memory_tracing()
+
+def start_memory_tracing():
+	"""Start tracemalloc for the rest of the process; traces never stop it, as other threads may be reading it."""
+	with _profile_lock:
+		if not tracemalloc.is_tracing():
+			tracemalloc.start()
+
+class SpanTiming:
+	"""Duration of a finished span, in seconds."""
+
+	def __init__(self):
+		self.seconds = 0.0
+
+@contextmanager
+def span(name):
+	"""
+	Time a named stage and add it to the active trace.
+
+	Spans with the same name are aggregated into a count and a total, so a span around
+	every decoded frame costs no more memory than one around the whole decode.
+	"""
+	timing = SpanTiming()
+	start_time = time.perf_counter()
+	try:
+		yield timing
+	finally:
+		timing.seconds = time.perf_counter() - start_time
+		trace = _active_trace.get()
+		if trace is not None:
+			trace.add_span(name, timing.seconds)
+
+def count(name, value=1):
+	"""Add value to a counter of the active trace."""
+	trace = _active_trace.get()
+	if trace is not None:
+		trace.counters[name] = trace.counters.get(name, 0) + int(value)
+
+def merge_into_active(snapshot):
+	"""Add a snapshot taken elsewhere, such as in a worker process, to the active trace."""
+	trace = _active_trace.get()
+	if trace is not None:
+		trace.merge(snapshot)
+
+class Trace:
+	"""
+	Spans and counters of one unit of work, such as a query.
+
+	While a trace is active (inside its with block) span() and count() record into it.
+	A trace started inside another one is merged into the outer trace when it ends;
+	an outermost trace is added to the process-wide totals and, when a trace file is
+	configured, appended to it. With profile=True an outermost trace also captures a
+	cProfile summary and the peak traced memory. tracemalloc is process-wide, so the peak
+	includes whatever other threads allocated meanwhile; profiled traces run one at a time
+	so that they do not reset each other's peak.
+	"""
+
+	def __init__(self, name, profile=None, record=True):
+		self.name = name
+		self.profile = settings['profile'] if profile is None else profile
+		self.record = record
+		self.spans = {}
+		self.counters = {}
+		self.seconds = 0.0
+		self.profile_stats = None
+		self.memory = None
+
+	def add_span(self, name, seconds, calls=1):
+		calls_so_far, seconds_so_far = self.spans.get(name, (0, 0.0))
+		self.spans[name] = (calls_so_far + calls, seconds_so_far + seconds)
+
+	def span_seconds(self, name):
+		return self.spans.get(name, (0, 0.0))[1]
+
+	def merge(self, snapshot):
+		"""Add the spans and counters of another trace's snapshot to this one."""
+		for name, values in snapshot['spans'].items():
+			self.add_span(name, values['seconds'], values['count'])
+		for name, value in snapshot['counters'].items():
+			self.counters[name] = self.counters.get(name, 0) + value
+
+	def __enter__(self):
+		self._parent = _active_trace.get()
+		self._token = _active_trace.set(self)
+		# A nested trace is already covered by the outer trace's profile
+		self.profile = self.profile and self._parent is None
+		if self.profile:
+			start_memory_tracing()
+			_profile_lock.acquire()
+			self._profiler = cProfile.Profile()
+			tracemalloc.reset_peak()
+			self._profiler.enable()
+		self._start_time = time.perf_counter()
+		return self
+
+	def __exit__(self, *exc_info):
+		self.seconds = time.perf_counter() - self._start_time
+		if self.profile:
+			try:
+				self._profiler.disable()
+				current, peak = tracemalloc.get_traced_memory()
+				top = tracemalloc.take_snapshot().statistics('lineno')[:10]
+			finally:
+				_profile_lock.release()
+			output = io.StringIO()
+			pstats.Stats(self._profiler, stream=output).sort_stats('cumulative').print_stats(30)
+			self.profile_stats = output.getvalue()
+			self.memory = {'peak_bytes': peak, 'current_bytes': current, 'top': [str(stat) for stat in top]}
+		_active_trace.reset(self._token)
+		if self._parent is not None:
+			self._parent.merge(self.snapshot())
+		elif self.record:
+			REGISTRY.add(self)
+			if settings['trace_path']:
+				with open(settings['trace_path'], 'a') as file:
+					file.write(json.dumps(self.snapshot()) + '\n')
+		return False
+
+	def snapshot(self):
+		"""The trace as a JSON-serializable dict."""
+		snapshot = {
+			'name': self.name,
+			'seconds': self.seconds,
+			'spans': {name: {'count': calls, 'seconds': seconds} for name, (calls, seconds) in self.spans.items()},
+			'counters': dict(self.counters),
+		}
+		if self.profile_stats is not None:
+			snapshot['profile'] = self.profile_stats
+			snapshot['memory'] = self.memory
+		return snapshot
+
+class Registry:
+	"""Totals of every finished trace in this process, exported in the Prometheus text format."""
+
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.traces = {}
+		self.spans = {}
+		self.counters = {}
+
+	def add(self, trace):
+		with self.lock:
+			calls, seconds = self.traces.get(trace.name, (0, 0.0))
+			self.traces[trace.name] = (calls + 1, seconds + trace.seconds)
+			for name, (span_calls, span_seconds) in trace.spans.items():
+				calls, seconds = self.spans.get(name, (0, 0.0))
+				self.spans[name] = (calls + span_calls, seconds + span_seconds)
+			for name, value in trace.counters.items():
+				self.counters[name] = self.counters.get(name, 0) + value
+
+	def prometheus_text(self):
+		with self.lock:
+			lines = [
+				'# HELP video_search_trace_seconds Wall time of finished traces.',
+				'# TYPE video_search_trace_seconds summary',
+			]
+			for name, (calls, seconds) in sorted(self.traces.items()):
+				lines.append(f'video_search_trace_seconds_sum{{trace="{name}"}} {seconds}')
+				lines.append(f'video_search_trace_seconds_count{{trace="{name}"}} {calls}')
+			lines += [
+				'# HELP video_search_span_seconds Time spent in each stage.',
+				'# TYPE video_search_span_seconds summary',
+			]
+			for name, (calls, seconds) in sorted(self.spans.items()):
+				lines.append(f'video_search_span_seconds_sum{{span="{name}"}} {seconds}')
+				lines.append(f'video_search_span_seconds_count{{span="{name}"}} {calls}')
+			for name, value in sorted(self.counters.items()):
+				lines.append(f'# TYPE video_search_{name}_total counter')
+				lines.append(f'video_search_{name}_total {value}')
+		return '\n'.join(lines) + '\n'
+
+REGISTRY = Registry()
+
+def prometheus_text():
+	return REGISTRY.prometheus_text()
@@ -4,15 +4,19 @@ import warnings
 import sys
 import os
 import cv2
-import imagehash
 import numpy as np
-from PIL import Image
-import time
-import librosa
-from concurrent.futures import ThreadPoolExecutor, as_completed
 import threading
-import pickle
-from gui import play_video 
+import time
+from audio_fingerprint import audio_path, fingerprint_audio
+from candidate_scheduler import CandidateScheduler
+from hash_index import pack_hashes, rank_videos, rank_videos_indexed
+from instrumentation import Trace, count, span
+from result_cache import CACHE_SIZE, QueryResultCache, clip_key
+from signature_store import SignatureStore, index_file_stat
+from histogram_alignment import COMPACT_TOLERANCE, PYRAMID_SKIP_MARGIN, HistogramAligner
+from segment_hashing import SegmentHasher
+from rgb_verification import RgbVerifier, map_rgb_file
+from query_server import request_match
 
 warnings.filterwarnings("ignore")
 
@@ -20,65 +24,17 @@ current_directory = os.path.dirname(os.path.abspath(__file__))
 # Get the path to the preprocessing directory
 preprocessing_directory = os.path.join(current_directory, 'preprocessing')
 
+# Only the start of the clip's audio is fingerprinted, so an audio lookup costs the same for any clip length
+AUDIO_QUERY_SECONDS = 10
+# Frames on either side of a start frame predicted from the audio or the shot lengths that are checked
+ALIGNMENT_WINDOW_FRAMES = 2
+
 def calculate_histogram(frame):
 	"""Calculate the color histogram for a frame."""
 	hist = cv2.calcHist([frame], [0, 1, 2], None, [8, 8, 8], [0, 256, 0, 256, 0, 256])
 	hist = cv2.normalize(hist, hist).flatten()
 	return hist
 
-def hamming_distance(hash1, hash2):
-	# Assuming hash1 and hash2 are binary strings
-	xor_result = int(hash1, 2) ^ int(hash2, 2)  # Convert to integers and XOR
-	return bin(xor_result).count('1')  # Count the number of 1s
-
-def get_video_segment_hashes(video_path, segment_length=3, overlap_fraction=0.3):
-	# profiler = cProfile.Profile()
-	# profiler.enable()
-	start_time = time.time()
-	cap = cv2.VideoCapture(video_path)
-	video_fps = cap.get(cv2.CAP_PROP_FPS)
-	segment_frames = int(video_fps * segment_length)
-	overlap_frames = int(segment_frames * overlap_fraction)  # Calculate the number of frames to overlap
-	hashes = []
-	
-	frame_count = 0
-	frames = []
-	
-	while True:
-		ret, frame = cap.read()
-		if not ret:
-			break
-		
-		frames.append(cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY))
-		
-		if frame_count % segment_frames == 0 and frame_count != 0:
-			# Process the segment
-			avg_frame = np.mean(np.array(frames), axis=0).astype(np.uint8)
-			frame_hash = imagehash.phash(Image.fromarray(avg_frame))
-			bin_str = format(int(str(frame_hash), 16), '064b')
-			hashes.append(bin_str)
-			
-			# Keep the last 'overlap_frames' for the next segment
-			frames = frames[-overlap_frames:]
-			
-		frame_count += 1
-		
-		# Process the last segment
-	if frames:
-		avg_frame = np.mean(np.array(frames), axis=0).astype(np.uint8)
-		frame_hash = imagehash.phash(Image.fromarray(avg_frame))
-		bin_str = format(int(str(frame_hash), 16), '064b')
-		hashes.append(bin_str)
-		
-	cap.release()
-	end_time = time.time()
-	computation_time = end_time - start_time  # Calculate the total time taken
-	print(f"Hashes for {video_path} calculated in {computation_time:.2f} seconds")
-	# profiler.disable()
-	# stats = pstats.Stats(profiler).sort_stats('cumtime')
-	# stats.print_stats()
-	return hashes
-
 def format_timestamp(start_timestamp):
 	minutes = int(start_timestamp/60)
 	if minutes < 10:
@@ -107,28 +63,109 @@ def get_filepath_without_extension(file_path):
 	
 	return path_without_extension
 
-def extract_key_frames_v2(clip_video_path):
-	clip_video = cv2.VideoCapture(clip_video_path)
-	key_frames = []
-	indices = []
+class QueryFeatures:
+	"""
+	Everything the ranking and localization stages need from the query clip.
+
+	Built by extract_query_features from a single decode of the clip, then shared by
+	every candidate video instead of reopening the clip for each one.
+	"""
+	
+	def __init__(self, clip_path, clip_rgb, hashes, key_frame_histograms, key_frame_indices, rgb_verifier, fps,
+		key_frames=None, audio_aligner=None, shot_boundaries=None):
+		self.clip_path = clip_path
+		self.clip_rgb = clip_rgb
+		self.hashes = hashes
+		self.packed_hashes = pack_hashes(hashes)
+		self.key_frame_histograms = key_frame_histograms
+		self.key_frame_indices = key_frame_indices
+		self.key_frames = key_frames
+		self.rgb_verifier = rgb_verifier
+		self.first_rgb_frame = rgb_verifier.first_frame
+		self.fps = fps
+		self.average_hist = sum(key_frame_histograms)/len(key_frame_histograms)
+		self.aligner = HistogramAligner(key_frame_histograms, key_frame_indices)
+		self.audio_aligner = audio_aligner
+		self.shot_boundaries = shot_boundaries or []
+		
+		
+def extract_query_features(clip_path, clip_rgb, segment_length=3, overlap_fraction=0.3, keep_key_frames=False,
+	rgb_check_frames=1, clip_wav=None, shot_threshold=0.5, from_rgb=False):
+	"""
+	Decodes the query clip once and computes its segment hashes and key-frame histograms.
+
+	With from_rgb the frames are read from clip_rgb instead, as they must be when the
+	signature store was indexed from the database's .rgb files.
+
+	Args:
+	clip_path (str): Path to the query clip video.
+	clip_rgb (str): Path to the query clip's raw .rgb file.
+	segment_length (int): Length of a hashed segment in seconds.
+	overlap_fraction (float): Fraction of a segment carried over into the next one.
+	keep_key_frames (bool): Also keep the decoded key frames, not only their histograms.
+	rgb_check_frames (int): Number of clip frames, spread over the clip, a candidate must match exactly.
+	clip_wav (str): Path to the query clip's .wav, defaults to the one next to clip_path.
+	shot_threshold (float): Histogram correlation below which a clip frame starts a new shot, as in preprocessing.
+	from_rgb (bool): Read the frames from clip_rgb rather than decoding clip_path, which then only provides the fps.
+
+	Returns:
+	QueryFeatures: The clip's segment hashes, key frames every (frame count // 120) frames, and their histograms.
+	"""
+	with span('features') as timing:
+		cap = cv2.VideoCapture(clip_path)
+		video_fps = cap.get(cv2.CAP_PROP_FPS)
+		segment_frames = int(video_fps * segment_length)
+		overlap_frames = int(segment_frames * overlap_fraction)  # Calculate the number of frames to overlap
+		hasher = SegmentHasher(segment_frames, overlap_frames)
 	
-	total_frames = round(clip_video.get(cv2.CAP_PROP_FRAME_COUNT))
-	frame_step = total_frames // 120
-	current_frame_index = 0
+		rgb_frames = map_rgb_file(clip_rgb) if from_rgb else None
+		total_frames = len(rgb_frames) if from_rgb else round(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+		frame_step = max(total_frames // 120, 1)
+		key_frames = []
+		key_frame_histograms = []
+		indices = []
+		shot_boundaries = []
+		prev_hist = None
+		current_frame_index = 0
 	
-	while current_frame_index < total_frames:
-		ret, frame = clip_video.read()
-		if not ret:
-			break
+		while True:
+			with span('decode'):
+				if from_rgb:
+					ret = current_frame_index < len(rgb_frames)
+					# Flipped to BGR, so the frame is handled exactly like a decoded one
+					frame = cv2.cvtColor(rgb_frames[current_frame_index], cv2.COLOR_RGB2BGR) if ret else None
+				else:
+					ret, frame = cap.read()
+			if not ret:
+				break
+			count('frames_decoded')
 		
-		if current_frame_index % frame_step == 0 or current_frame_index == 0:
-			key_frames.append(frame)
-			indices.append(current_frame_index)
-			
-		current_frame_index += 1
+			with span('hash'):
+				hasher.add_frame(cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY))
+			with span('keyframe_extraction'):
+				# The clip's own cuts, found the way preprocessing finds the database cuts
+				frame_hist = calculate_histogram(frame)
+				if prev_hist is not None and histogram_similarity(prev_hist, frame_hist) < shot_threshold:
+					shot_boundaries.append(current_frame_index)
+				prev_hist = frame_hist
+				if current_frame_index < total_frames and current_frame_index % frame_step == 0:
+					key_frame_histograms.append(frame_hist)
+					indices.append(current_frame_index)
+					if keep_key_frames:
+						key_frames.append(frame)
+					
+			current_frame_index += 1
 		
-	clip_video.release()
-	return key_frames, indices
+		cap.release()
+		hashes = hasher.finish()
+		rgb_verifier = RgbVerifier(clip_rgb, rgb_check_frames)
+		clip_wav = clip_wav or audio_path(clip_path)
+		# Imported here, so a CLI that gets its match from the query server never loads librosa and soundfile
+		from audio_alignment import AudioAligner
+		audio_aligner = AudioAligner(clip_wav) if os.path.exists(clip_wav) else None
+	print(f"Query features for {clip_path} calculated in {timing.seconds:.2f} seconds")
+	return QueryFeatures(clip_path, clip_rgb, hashes, key_frame_histograms, indices, rgb_verifier, video_fps,
+		key_frames if keep_key_frames else None, audio_aligner, shot_boundaries)
 
 
 def get_frame_count(video_path):
@@ -149,177 +186,152 @@ def get_frame_count(video_path):
 	return frame_count
 
 
-def compare_rgb_data_first_frame(rgb_data1, rgb_data2):
+def find_best_match_per_video(clip_hashes, hash_library, hash_index=None):
+	# Use the multi-index table when one was built, otherwise one batched XOR + popcount over the packed hashes
+	with span('rank'):
+		if hash_index is not None:
+			return rank_videos_indexed(pack_hashes(clip_hashes), hash_library, hash_index)
+		return rank_videos(pack_hashes(clip_hashes), hash_library)
+
+
+def find_clip_start(main_video_path, query, main_video_rgb, shot_boundaries, frame_histograms, frame_threshold, use_rgb_verification,
+	pyramid=None, compact=None, found_match=None, compact_tolerance=COMPACT_TOLERANCE):
+	# Key frames and their histograms were computed once for the query
+	aligner = query.aligner
+	# The coarse-to-fine pass is unlikely to find anything in a video whose coarsest pyramid
+	# level nowhere comes near frame_threshold, so such a video goes straight to the full scan
+	if pyramid is not None and aligner.coarse_score(pyramid, 0, len(frame_histograms) - 1) < frame_threshold - PYRAMID_SKIP_MARGIN:
+		count('pyramid_skips')
+		pyramid = None
+	#find the shot boundary that the clip is within
+	boundary_similarities = aligner.boundary_similarities(query.average_hist, frame_histograms, shot_boundaries)
+	similarity_rankings = list(enumerate(boundary_similarities.tolist()))
+	# Sort shot boundaries by similarity, in descending order
+	similarity_rankings.sort(key=lambda x: x[1], reverse=True)
+	# Narrow down to exact frame within the identified shot segment
+	start_best_index = -1
+	# With a histogram pyramid the segments are first searched coarse-to-fine, and then every
+	# offset is scored if that finds nothing: on the compact histograms when the store has them,
+	# with only the offsets whose upper bound comes within compact_tolerance of frame_threshold
+	# rescored at full precision
+	if compact is not None:
+		searches = [lambda *segment: aligner.compact_candidates(*compact, *segment, tolerance=compact_tolerance, found_match=found_match)]
+	else:
+		searches = [lambda *segment: aligner.segment_candidates(*segment, found_match=found_match)]
+	if pyramid is not None:
+		searches.insert(0, lambda *segment: aligner.pyramid_candidates(pyramid, *segment, found_match=found_match))
+	for segment_candidates in searches:
+		for boundary_index, similarity in similarity_rankings:
+			# Another video already matched; the searches and the RGB check also stop within a segment
+			if found_match is not None and found_match.is_set():
+				return -1
+			start_index = shot_boundaries[boundary_index] + 1 if boundary_index > 0 else 0
+			end_index = shot_boundaries[boundary_index + 1] if boundary_index < len(shot_boundaries) - 1 else len(frame_histograms) - 1
+			
+			# Score the offsets of the segment at once, keeping those where every key frame is above frame_threshold
+			indices, similarities = segment_candidates(frame_histograms, start_index, end_index, frame_threshold)
+			
+			# The best average similarity is the one we keep
+			if len(indices) and not use_rgb_verification:
+				best = int(np.argmax(similarities))
+				if similarities[best] > 0:
+					return int(indices[best])
+				
+			# RGB verification
+			if not len(indices):
+				continue
+			if use_rgb_verification:
+				# Candidates of earlier segments already failed, so only this segment's need checking,
+				# best similarity first, all at once against the memory-mapped .rgb file
+				candidates = indices[np.argsort(-similarities, kind='stable')]
+				start_best_index = query.rgb_verifier.first_match(main_video_rgb, candidates, found_match)
+				if start_best_index != -1:
+					print("Found exact match")
+					return start_best_index
+					
+	return start_best_index
+
+def confirm_predicted_start(query, main_video_rgb, frame_histograms, predicted_frame, frame_threshold):
+	"""Runs the histogram and RGB checks on the frames within ALIGNMENT_WINDOW_FRAMES of a predicted start, or returns -1."""
+	start_index = max(predicted_frame - ALIGNMENT_WINDOW_FRAMES, 0)
+	end_index = min(predicted_frame + ALIGNMENT_WINDOW_FRAMES, len(frame_histograms) - 1)
+	indices, similarities = query.aligner.segment_candidates(frame_histograms, start_index, end_index, frame_threshold)
+	if not len(indices):
+		return -1
+	return query.rgb_verifier.first_match(main_video_rgb, indices[np.argsort(-similarities, kind='stable')])
+
+def find_clip_start_by_audio(main_video_path, query, main_video_rgb, audio_envelope, frame_histograms, fps, frame_threshold):
 	"""
-	Compares the first frame of two sets of RGB data and checks for an exact match.
+	Aligns the clip's audio with the video's to get the start frame without scanning shot segments.
 
-	Args:
-	rgb_data1, rgb_data2 (List of bytes): Two lists containing RGB data for comparison.
+	The sample-accurate audio start is converted to a frame index, and only the frames within
+	ALIGNMENT_WINDOW_FRAMES of it go through the histogram and RGB checks.
 
 	Returns:
-	bool: True if the first frames are exactly the same, False otherwise.
+	int: The confirmed start frame, or -1 when the audio does not align or the frames disagree.
 	"""
-	if not rgb_data1 or not rgb_data2:
-		return False  # One of the lists is empty
-	
-	return rgb_data1[0] == rgb_data2[0]
+	start_seconds = query.audio_aligner.align(audio_path(main_video_path), audio_envelope)
+	if start_seconds is None:
+		return -1
+	start_frame = confirm_predicted_start(query, main_video_rgb, frame_histograms, int(round(start_seconds * fps)), frame_threshold)
+	if start_frame != -1:
+		print(f"Found exact match from the audio alignment at {start_seconds:.4f} seconds")
+	return start_frame
 
-def extract_rgb_data(video_path, start_frame, end_frame, frame_width, frame_height):
+def find_clip_start_by_shots(query, main_video_rgb, shot_index, video_index, frame_histograms, frame_threshold, found_match=None):
 	"""
-	Extracts RGB data from a video file for a specified range of frames.
-
-	Args:
-	video_path (str): Path to the video file.
-	start_frame (int): The starting frame number.
-	end_frame (int): The ending frame number.
-	frame_width (int): The width of a frame in pixels.
-	frame_height (int): The height of a frame in pixels.
+	Looks the clip's shot lengths up in the shot-length index to get a few candidate start frames.
 
 	Returns:
-	List of tuples: A list where each element is a tuple representing the RGB data of a frame.
+	int: The first candidate confirmed by the histogram and RGB checks, or -1.
 	"""
-	frame_data = []
-	bytes_per_frame = frame_width * frame_height * 3  # 3 bytes per pixel (RGB)
-	
-	with open(video_path, 'rb') as file:
-		file.seek(start_frame * bytes_per_frame)  # Jump to the start frame
-		for _ in range(start_frame, end_frame):
-			frame_bytes = file.read(bytes_per_frame)
-			if not frame_bytes:
-				break  # End of file
-			frame_data.append(frame_bytes)
-			
-	return frame_data
-
-def find_best_match_per_video(clip_hashes, video_hashes):
-	# profiler = cProfile.Profile()
-	# profiler.enable()
-	best_matches = []
-	
-	for video_path, segment_hashes in video_hashes.items():
-		min_distance = float('inf')
-		for clip_hash in clip_hashes:
-			for segment_hash in segment_hashes:
-				distance = hamming_distance(clip_hash, segment_hash)
-				if distance < min_distance:
-					min_distance = distance
-				if distance < 5:
-					break
-				
-		best_matches.append((video_path, min_distance))
-		
-		# Sort the list by distance (second item of the tuple), from smallest to largest
-	sorted_best_matches = sorted(best_matches, key=lambda x: x[1])
-	# profiler.disable()
-	# stats = pstats.Stats(profiler).sort_stats('cumtime')
-	# stats.print_stats()
-	return sorted_best_matches
-
-
-def find_clip_start(main_video_path, clip_video_path, main_video_rgb, clip_video_rgb, shot_boundaries, frame_histograms, frame_threshold, use_rgb_verification):
-	# Gets key frames for clip and its histograms
-	start_time = time.time()
-	key_frames, key_frame_indices = extract_key_frames_v2(clip_video_path)
-	end_time = time.time()
-	computation_time = end_time - start_time  # Calculate the total time taken
-	print(f"Key frames extracted in {computation_time:.2f} seconds")
-	start_time = time.time()
-	key_frame_histograms = [calculate_histogram(frame) for frame in key_frames]
-	end_time = time.time()
-	computation_time = end_time - start_time  # Calculate the total time taken
-	print(f"Calculated histograms in {computation_time:.2f} seconds")
-	average_hist = sum(key_frame_histograms)/len(key_frame_histograms)
-	clip_hist = key_frame_histograms[0]
-	#find the shot boundary that the clip is within
-	similarity_rankings = []
-	start_time = time.time()
-	for boundary in shot_boundaries:
-		frame_hist = frame_histograms[boundary]
-		similarity = histogram_similarity(average_hist, frame_hist)
-		similarity_rankings.append((boundary, similarity))
-		# Sort shot boundaries by similarity, in descending order
-	similarity_rankings.sort(key=lambda x: x[1], reverse=True)
-	# Narrow down to exact frame within the identified shot segment
-	candidates = []
-	end_time = time.time()
-	for boundary, similarity in similarity_rankings:
-		boundary_index = shot_boundaries.index(boundary)
-		start_index = shot_boundaries[boundary_index] + 1 if boundary_index > 0 else 0
-		end_index = shot_boundaries[boundary_index + 1] if boundary_index < len(shot_boundaries) - 1 else len(frame_histograms) - 1
-		
-		# Initialize the average similarity calculation
-		best_similarity = 0
-		start_best_index = -1
-		# Compare each key frame within the identified segment
-		for i in range(start_index, end_index + 1):
-			total_similarity = 0
-			average_similarity = 0
-			frame_count = 0
-			# Calculates average similarity for every key frame in this position
-			for j, key_frame_hist in enumerate(key_frame_histograms):
-				if i+key_frame_indices[j] >= len(frame_histograms):
-					break
-				frame_hist = frame_histograms[i+key_frame_indices[j]]
-				similarity = histogram_similarity(key_frame_hist, frame_hist)
-				if similarity > frame_threshold:
-					total_similarity += similarity
-					frame_count += 1
-				else:
-					break
-				
-				# Only calculates average if every frame had a similarity score above frame_threshold
-			if frame_count == len(key_frame_histograms):
-				average_similarity = total_similarity / frame_count
-				candidates.append( {'index': i, 'similarity': average_similarity})
-				
-				# The best average similarity is the one we keep
-			if average_similarity > best_similarity and not use_rgb_verification:
-				best_similarity = average_similarity
-				start_best_index = i
-				
-		# RGB verification
-		#print(candidates)
-		if best_similarity > 0 and not use_rgb_verification:
-			return start_best_index
-		if not candidates:
-			continue
-		candidates = sorted(candidates, key=lambda x: x['similarity'], reverse=True)
-		if use_rgb_verification:
-			for candidate in candidates:
-				# Extract RGB data for the first frame of the candidate segment from the main video
-				main_video_rgb_first_frame = extract_rgb_data(main_video_rgb, candidate['index'], candidate['index'] + 1, 352, 288)
-				
-				# Extract RGB data for the first frame of the query clip
-				clip_rgb_first_frame = extract_rgb_data(clip_video_rgb, 0, 1, 352, 288)
-				
-				# Check if the first frames are identical
-				if compare_rgb_data_first_frame(main_video_rgb_first_frame, clip_rgb_first_frame):
-					print("Found exact match")
-					start_best_index = candidate['index']
-					return start_best_index
-				
-	return start_best_index
+	with span('shot_lookup'):
+		candidates = shot_index.candidate_starts(query.shot_boundaries, video_index)
+	for _, predicted_frame, votes in candidates:
+		if found_match is not None and found_match.is_set():
+			return -1
+		start_frame = confirm_predicted_start(query, main_video_rgb, frame_histograms, predicted_frame, frame_threshold)
+		if start_frame != -1:
+			print(f"Found exact match from the shot lengths ({votes} votes)")
+			return start_frame
+	return -1
 
-def process_video(video, clip_path, clip_rgb, shot_boundaries_dict, frame_histograms_dict, frame_threshold, found_match=None):
+def process_video(video, query, store, frame_threshold, found_match=None, compact_tolerance=COMPACT_TOLERANCE):
 	if found_match and found_match.is_set():
 		return video, -1, None  # Early return if match already found
+	count('videos_searched')
 	
-	shot_boundaries = shot_boundaries_dict[video]
-	frame_histograms = frame_histograms_dict[video]
+	shot_boundaries = store.shot_boundaries(video)
+	frame_histograms = store.frame_histograms(video)
 	
 	path_no_extension = get_filepath_without_extension(video)
-	start_frame = find_clip_start(video, clip_path, f"{path_no_extension}.rgb", clip_rgb, shot_boundaries,
-		frame_histograms, frame_threshold, use_rgb_verification=True)
-	fps = cv2.VideoCapture(video).get(cv2.CAP_PROP_FPS)
+	fps = store.fps(video)
+	start_frame = -1
+	audio_envelope = store.audio_envelope(video)
+	if query.audio_aligner is not None and audio_envelope is not None and len(audio_envelope):
+		start_frame = find_clip_start_by_audio(video, query, f"{path_no_extension}.rgb", audio_envelope,
+			frame_histograms, fps, frame_threshold)
+	shot_index = store.shot_index()
+	if start_frame == -1 and shot_index is not None:
+		start_frame = find_clip_start_by_shots(query, f"{path_no_extension}.rgb", shot_index, store.video_indices[video],
+			frame_histograms, frame_threshold, found_match)
+	if start_frame == -1:
+		start_frame = find_clip_start(video, query, f"{path_no_extension}.rgb", shot_boundaries,
+			frame_histograms, frame_threshold, use_rgb_verification=True, pyramid=store.histogram_pyramid(video),
+			compact=store.compact_histograms(video), found_match=found_match, compact_tolerance=compact_tolerance)
 	return video, start_frame, fps
 
-def adaptive_video_search(matching_videos, clip_path, clip_rgb, shot_boundaries_dict,
-	frame_histograms_dict, frame_threshold, start_time_main, switch_to_parallel_threshold=2):
-	found_match = threading.Event()
-	
-	# Process the first few videos sequentially
-	for video in matching_videos[:switch_to_parallel_threshold]:  # Adjust the number as needed
-		_, start_frame, fps = process_video(video[0], clip_path, clip_rgb, shot_boundaries_dict, frame_histograms_dict, frame_threshold)
+def adaptive_video_search(matching_videos, query, store, frame_threshold, start_time_main,
+	switch_to_parallel_threshold=2, scheduler=None, compact_tolerance=COMPACT_TOLERANCE):
+	"""
+	Localizes the clip in the ranked videos, the first switch_to_parallel_threshold of them one at a time.
+
+	The rest go to scheduler, a CandidateScheduler, when one is given, and are searched
+	one at a time in rank order otherwise.
+	"""
+	sequential_videos = matching_videos if scheduler is None else matching_videos[:switch_to_parallel_threshold]
+	for video in sequential_videos:
+		_, start_frame, fps = process_video(video[0], query, store, frame_threshold, compact_tolerance=compact_tolerance)
 		if start_frame != -1:
 			start_timestamp = start_frame / fps
 			formated_timestamp = format_timestamp(start_timestamp)
@@ -329,78 +341,246 @@ def adaptive_video_search(matching_videos, clip_path, clip_rgb, shot_boundaries_
 			return video[0], start_frame
 		else:
 			print(f"Clip not found in the {get_filename(video[0])}. Searching next best...")
+	if scheduler is None or len(matching_videos) <= switch_to_parallel_threshold:
+		return None, -1
 		
-	# If no match found, proceed with parallel processing
+	# If no match found, the remaining candidates are searched by the worker processes in rank order
 	print("Match not found in first few videos. Switching to parallel processing...")
-	with ThreadPoolExecutor(max_workers=4) as executor:
-		future_to_video = {executor.submit(process_video, video[0], clip_path, clip_rgb, shot_boundaries_dict, frame_histograms_dict, frame_threshold, found_match): video for video in matching_videos[switch_to_parallel_threshold:]}
-		
-		for future in as_completed(future_to_video):
-			video, start_frame, fps = future.result()
-			if start_frame != -1:
-				found_match.set()  # Signal that a match has been found
-				start_timestamp = start_frame / fps
-				formated_timestamp = format_timestamp(start_timestamp)
-				computation_time = time.time() - start_time_main
-				print(f"Clip starts at frame: {start_frame}, in {get_filename(video)} which is at timestamp: {formated_timestamp}")
-				print(f"Match found in {computation_time:.2f} seconds")
-				return video, start_frame
-			
-			
-def main(clip_path, clip_rgb):
-	database = ['/Users/arshiabehzad/Downloads/Videos/video1.mp4',
-		'/Users/arshiabehzad/Downloads/Videos/video2.mp4',
-		'/Users/arshiabehzad/Downloads/Videos/video3.mp4',
-		'/Users/arshiabehzad/Downloads/Videos/video4.mp4',
-		'/Users/arshiabehzad/Downloads/Videos/video5.mp4',
-		'/Users/arshiabehzad/Downloads/Videos/video6.mp4',
-		'/Users/arshiabehzad/Downloads/Videos/video7.mp4',
-		'/Users/arshiabehzad/Downloads/Videos/video8.mp4',
-		'/Users/arshiabehzad/Downloads/Videos/video9.mp4',
-		'/Users/arshiabehzad/Downloads/Videos/video10.mp4',
-		'/Users/arshiabehzad/Downloads/Videos/video11.mp4',
-		'/Users/arshiabehzad/Downloads/Videos/video12.mp4',
-		'/Users/arshiabehzad/Downloads/Videos/video13.mp4',
-		'/Users/arshiabehzad/Downloads/Videos/video14.mp4',
-		'/Users/arshiabehzad/Downloads/Videos/video15.mp4',
-		'/Users/arshiabehzad/Downloads/Videos/video16.mp4',
-		'/Users/arshiabehzad/Downloads/Videos/video17.mp4',
-		'/Users/arshiabehzad/Downloads/Videos/video18.mp4',
-		'/Users/arshiabehzad/Downloads/Videos/video19.mp4',
-		'/Users/arshiabehzad/Downloads/Videos/video20.mp4']
-	
-	video_hashes_path = os.path.join(preprocessing_directory, 'video_hashes.pkl')
-	shot_boundaries_dict_path = os.path.join(preprocessing_directory, 'shot_boundaries_dict.pkl')
-	frame_histograms_dict_path = os.path.join(preprocessing_directory, 'frame_histograms_dict.pkl')
+	video, start_frame = scheduler.search([video[0] for video in matching_videos[switch_to_parallel_threshold:]], query, frame_threshold,
+		compact_tolerance, store.generation)
+	if start_frame != -1:
+		formated_timestamp = format_timestamp(start_frame / store.fps(video))
+		computation_time = time.time() - start_time_main
+		print(f"Clip starts at frame: {start_frame}, in {get_filename(video)} which is at timestamp: {formated_timestamp}")
+		print(f"Match found in {computation_time:.2f} seconds")
+		return video, start_frame
+	return None, -1
+
+
+def match_audio(store, clip_rgb, clip_wav, rgb_check_frames=1):
+	"""
+	Locates a clip from its audio alone and confirms the start frame against the .rgb.
+
+	The landmark vote gives the video and a start time, refined to the sample by waveform
+	cross-correlation; only the few frames around it are compared with the clip's first
+	frame, so the clip video is never decoded.
+
+	Returns:
+	Tuple: (video path, start frame), or None when the audio gives no confirmed match.
+	"""
+	vote = store.audio_index().lookup(*fingerprint_audio(clip_wav, duration=AUDIO_QUERY_SECONDS))
+	if vote is None:
+		print("No audio match, falling back to video matching")
+		return None
+	video_index, offset_seconds, votes = vote
+	video_path = store.video_paths[video_index]
+	from audio_alignment import AudioAligner
+	offset_seconds = AudioAligner(clip_wav).refine(audio_path(video_path), offset_seconds)
+	predicted_frame = int(round(offset_seconds * store.fps(video_path)))
+	window = np.arange(predicted_frame - ALIGNMENT_WINDOW_FRAMES, predicted_frame + ALIGNMENT_WINDOW_FRAMES + 1)
+	window = window[(window >= 0) & (window < store.frame_count(video_path))]
+	candidates = window[np.argsort(np.abs(window - predicted_frame), kind='stable')]
+	start_frame = RgbVerifier(clip_rgb, rgb_check_frames).first_match(f"{get_filepath_without_extension(video_path)}.rgb", candidates)
+	if start_frame == -1:
+		print(f"Audio points to {get_filename(video_path)} ({votes} votes) but the frames do not match, falling back to video matching")
+		return None
+	print(f"Audio match in {get_filename(video_path)} with {votes} votes")
+	return video_path, start_frame
+
+def match_histograms(store, query, frame_threshold):
+	"""
+	Looks the clip's key frames up in the library-wide histogram index.
+
+	The starts most key frames agree on are confirmed like an audio prediction, so a
+	clip whose video the phash ranking puts low is still found without scanning the
+	videos ranked above it.
+
+	Returns:
+	Tuple: (video path, start frame), or None when no voted start is confirmed.
+	"""
+	key_vectors, _ = store.histogram_projection().project(query.aligner.key_frame_histograms)
+	for video_index, predicted_frame, votes in store.histogram_index().candidate_starts(key_vectors, query.aligner.key_frame_indices):
+		count('histogram_index_candidates')
+		video_path = store.video_paths[video_index]
+		start_frame = confirm_predicted_start(query, f"{get_filepath_without_extension(video_path)}.rgb",
+			store.frame_histograms(video_path), predicted_frame, frame_threshold)
+		if start_frame != -1:
+			print(f"Histogram index match in {get_filename(video_path)} with {votes} votes")
+			return video_path, start_frame
+	return None
+
+def match_before_ranking(store, clip_path, clip_rgb, clip_wav=None, frame_threshold=0.95, rgb_check_frames=1, cache=None):
+	"""
+	The stages of a query that come before the phash ranking, shared by VideoMatcher and batch_query.
+
+	The clip's audio is tried first when the store has an audio index; video matching is
+	the fallback when there is no audio or its match is not confirmed by the frames. Video
+	matching extracts the clip's features, looks its phash sequence and first frame up in
+	cache, then its key frames in the library-wide histogram index.
+
+	Returns:
+	Tuple: (QueryFeatures, or None when the audio matched; (video path, start frame), or None
+	when the clip still has to be ranked and localized; whether the match came from cache).
+	"""
+	clip_wav = clip_wav or audio_path(clip_path)
+	if store.audio_index() is not None and os.path.exists(clip_wav):
+		with span('audio'):
+			audio_match = match_audio(store, clip_rgb, clip_wav, rgb_check_frames)
+		if audio_match is not None:
+			return None, audio_match, False
+	query = extract_query_features(clip_path, clip_rgb, segment_length=3, clip_wav=clip_wav,
+		rgb_check_frames=rgb_check_frames, from_rgb=store.frame_source == 'rgb')
+	if cache is not None:
+		with span('cache'):
+			cached = cache.get(clip_key(query.packed_hashes, query.first_rgb_frame))
+		if cached is not None:
+			count('cache_hits')
+			print("Cached match found")
+			return query, cached, True
+	if store.histogram_index() is not None:
+		with span('histogram_index'):
+			histogram_match = match_histograms(store, query, frame_threshold)
+		if histogram_match is not None:
+			return query, histogram_match, False
+	return query, None, False
+
+
+class VideoMatcher:
+	"""
+	The signature index, loaded once and reused for every query.
+
+	Columns stay memory-mapped, so only the pages of the videos a query looks at are read.
+	A start frame is confirmed by rgb_check_frames clip frames spread over the clip, and
+	compact_tolerance is how far below frame_threshold a compact histogram bound may be
+	and still have its offset rescored. Matches are remembered in an LRU cache of up to
+	cache_size clips, kept in cache_path between runs when given; a cache_size of 0 turns it off.
+
+	Every query first checks whether the store has been rebuilt or updated since it was
+	opened, and if so reopens it and empties the cache.
+	"""
 	
-	with open(video_hashes_path, 'rb') as file:
-		video_hashes = pickle.load(file)
+	def __init__(self, signature_directory=None, frame_threshold=0.95, workers=None, sequential_prefix=2,
+		cache_size=CACHE_SIZE, cache_path=None, rgb_check_frames=1, compact_tolerance=COMPACT_TOLERANCE):
+		if signature_directory is None:
+			signature_directory = os.path.join(preprocessing_directory, 'signatures')
+		self.signature_directory = signature_directory
+		self.reload_lock = threading.Lock()
+		self.index_stat = index_file_stat(signature_directory)
+		self.store = SignatureStore(signature_directory)
+		self.frame_threshold = frame_threshold
+		self.rgb_check_frames = rgb_check_frames
+		self.compact_tolerance = compact_tolerance
+		self.sequential_prefix = sequential_prefix
+		# Worker processes are only started by the first search that gets past the sequential prefix
+		workers = workers or os.cpu_count()
+		self.scheduler = CandidateScheduler(signature_directory, workers) if workers > 1 else None
+		self.cache = QueryResultCache(self.store.generation, cache_size, cache_path) if cache_size > 0 else None
+		
+	def current_store(self):
+		"""
+		The open store, reopened first when an update has replaced its index file.
+
+		A query keeps the store it started with, so one running while the store is reopened
+		still sees a consistent index.
+		"""
+		index_stat = index_file_stat(self.signature_directory)
+		# Missing while an update swaps the directory, the open store is used until it is back
+		if index_stat is None or index_stat == self.index_stat:
+			return self.store
+		with self.reload_lock:
+			if index_stat != self.index_stat:
+				store = SignatureStore(self.signature_directory)
+				if store.generation != self.store.generation:
+					print("Signature store changed, reloading it")
+					if self.cache is not None:
+						self.cache.reset(store.generation)
+				self.store = store
+				self.index_stat = index_stat
+			return self.store
 		
-		# Loading shot_boundaries_dict
-	with open(shot_boundaries_dict_path, 'rb') as file:
-		shot_boundaries_dict = pickle.load(file)
+	def close(self):
+		if self.scheduler is not None:
+			self.scheduler.close()
+		if self.cache is not None:
+			self.cache.save()
 		
-		# Loading frame_histograms_dict
-	with open(frame_histograms_dict_path, 'rb') as file:
-		frame_histograms_dict = pickle.load(file)
+	def result(self, video_path, start_frame, timings, store=None):
+		store = store or self.store
+		found = video_path is not None and start_frame != -1
+		fps = store.fps(video_path) if found else None
+		return {
+			'video': video_path if found else None,
+			'start_frame': start_frame if found else -1,
+			'fps': fps,
+			'timestamp': format_timestamp(start_frame / fps) if found else None,
+			'timings': timings,
+		}
 		
-	start_time_main = time.time()
-	clip_hash = get_video_segment_hashes(clip_path,  segment_length=3)
-	matching_videos = find_best_match_per_video(clip_hash, video_hashes)
-	end_time = time.time()
-	computation_time = end_time - start_time_main  # Calculate the total time taken
-	print(f"Video rankings found in {computation_time:.2f} seconds")
-	video_path, start_frame = adaptive_video_search(matching_videos, clip_path, clip_rgb, shot_boundaries_dict, frame_histograms_dict, start_time_main=start_time_main, frame_threshold=0.95)
+	def match(self, clip_path, clip_rgb, clip_wav=None):
+		"""
+		Finds the database video and start frame of a query clip.
+
+		match_before_ranking runs the audio, cache and histogram index stages; only a clip
+		none of them places is ranked by its phash sequence and localized in the ranked videos.
+
+		Returns:
+		dict: video, start_frame, fps, timestamp, whether the match came from the cache, the time
+		spent in each stage, in seconds, and the query's trace with every span and counter.
+		"""
+		start_time_main = time.time()
+		store = self.current_store()
+		with Trace('query') as trace:
+			query, found, cached = match_before_ranking(store, clip_path, clip_rgb, clip_wav, self.frame_threshold,
+				self.rgb_check_frames, self.cache)
+			if found is not None:
+				video_path, start_frame = found
+				print(f"Match found in {time.time() - start_time_main:.2f} seconds")
+			else:
+				matching_videos = find_best_match_per_video(query.hashes, store.hash_library(), store.hash_index())
+				print(f"Video rankings found in {time.time() - start_time_main:.2f} seconds")
+				
+				with span('localization'):
+					video_path, start_frame = adaptive_video_search(matching_videos, query, store,
+						start_time_main=start_time_main, frame_threshold=self.frame_threshold,
+						switch_to_parallel_threshold=self.sequential_prefix, scheduler=self.scheduler,
+						compact_tolerance=self.compact_tolerance)
+			if query is not None and not cached and self.cache is not None and video_path is not None and start_frame != -1:
+				self.cache.put(clip_key(query.packed_hashes, query.first_rgb_frame), video_path, start_frame, store.generation)
+		timings = {stage: trace.span_seconds(name) for stage, name in
+			(('audio', 'audio'), ('features', 'features'), ('cache', 'cache'), ('histogram_index', 'histogram_index'), ('ranking', 'rank'),
+			('localization', 'localization'))
+			if name in trace.spans}
+		timings['total'] = trace.seconds
+		result = self.result(video_path, start_frame, timings, store)
+		result['cached'] = cached
+		result['trace'] = trace.snapshot()
+		return result
+	
+	
+def main(clip_path, clip_rgb, clip_wav=None):
+	# A running query server already has the index loaded, so only ask it for the match
+	result = request_match(clip_path, clip_rgb, clip_wav=clip_wav)
+	if result is None:
+		matcher = VideoMatcher(cache_path=os.path.join(preprocessing_directory, 'query_cache.json'))
+		result = matcher.match(clip_path, clip_rgb, clip_wav)
+		matcher.close()
+	else:
+		print(f"Server matched in {result['timings']['total']:.2f} seconds")
 	print("\n")
 	
-	if video_path is not None and start_frame != -1:
-		# Call the function from the second script
-		play_video(video_path, start_frame)
+	if result['video'] is not None and result['start_frame'] != -1:
+		# The launch, from importing Qt to the matched frame on screen, is traced like a query
+		with Trace('gui'):
+			with span('gui_launch'):
+				# Call the function from the second script, importing Qt only when there is something to show
+				from gui import launch_player
+				app, player = launch_player(result['video'], result['start_frame'], os.path.join(preprocessing_directory, 'signatures'))
+		app.exec_()
 	
 	
 if __name__ == "__main__":
 	if len(sys.argv) > 2:
-		main(sys.argv[1], sys.argv[2])
+		main(sys.argv[1], sys.argv[2], sys.argv[3] if len(sys.argv) > 3 else None)
 	else:
-		print("This script requires at least 2 arguments (clip.mp4 clip.rgb).")
+		print("This script requires at least 2 arguments (clip.mp4 clip.rgb [clip.wav]).")
 		
\ No newline at end of file
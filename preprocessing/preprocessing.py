@@ -1,14 +1,29 @@
 import warnings
+import sys
 import os
+import argparse
+from collections import deque
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor
 import cv2
-import imagehash
 import numpy as np
-from PIL import Image
-import time
 import librosa
-import pickle
 import h5py
 
+current_directory = os.path.dirname(os.path.abspath(__file__))
+parent_directory = os.path.dirname(current_directory)
+sys.path.append(parent_directory)
+
+from audio_alignment import audio_envelope
+from audio_fingerprint import audio_path, landmark_hashes, load_audio, spectral_peaks
+from hash_index import pack_hashes
+from histogram_alignment import histogram_pyramid
+from instrumentation import Trace, count, merge_into_active, span
+from rgb_features import BLOCK_FRAMES, BlockSegmentHasher, color_histograms, gray_frames, stitch_segment_hashes
+from rgb_verification import FRAME_HEIGHT, FRAME_WIDTH, map_rgb_file
+from segment_hashing import SegmentHasher
+from signature_store import DEFAULT_COLUMNS, SignatureStore, SignatureWriter, file_fingerprint, store_exists
+
 warnings.filterwarnings("ignore")
 
 def calculate_histogram(frame):
@@ -21,99 +36,286 @@ def histogram_similarity(hist1, hist2):
 	"""Calculate similarity between two histograms."""
 	return cv2.compareHist(hist1, hist2, cv2.HISTCMP_CORREL)
 
-def get_video_segment_hashes(video_path, segment_length=3, overlap_fraction=0.3):
-	# profiler = cProfile.Profile()
-	# profiler.enable()
-	start_time = time.time()
-	cap = cv2.VideoCapture(video_path)
-	video_fps = cap.get(cv2.CAP_PROP_FPS)
-	segment_frames = int(video_fps * segment_length)
-	overlap_frames = int(segment_frames * overlap_fraction)  # Calculate the number of frames to overlap
-	hashes = []
-	
-	frame_count = 0
-	frames = []
-	
-	while True:
-		ret, frame = cap.read()
-		if not ret:
-			break
+def extract_video_features(video_path, segment_length=3, overlap_fraction=0.3, threshold=0.5):
+	"""
+	Computes a video's segment hashes, shot boundaries and frame histograms from a single decode.
+
+	Args:
+	video_path (str): Path to the video file.
+	segment_length (int): Length of a hashed segment in seconds.
+	overlap_fraction (float): Fraction of a segment carried over into the next one.
+	threshold (float): Histogram correlation below which a frame starts a new shot.
+
+	Returns:
+	Tuple: (segment hashes, shot boundaries, frame histograms, fps).
+	"""
+	with span('features') as timing:
+		cap = cv2.VideoCapture(video_path)
+		video_fps = cap.get(cv2.CAP_PROP_FPS)
+		segment_frames = int(video_fps * segment_length)
+		overlap_frames = int(segment_frames * overlap_fraction)  # Calculate the number of frames to overlap
+		hasher = SegmentHasher(segment_frames, overlap_frames)
+		shot_boundaries = []
+		frame_histograms = []
 		
-		frames.append(cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY))
+		frame_count = 0
+		prev_hist = None
 		
-		if frame_count % segment_frames == 0 and frame_count != 0:
-			# Process the segment
-			avg_frame = np.mean(np.array(frames), axis=0).astype(np.uint8)
-			frame_hash = imagehash.phash(Image.fromarray(avg_frame))
-			bin_str = format(int(str(frame_hash), 16), '064b')
-			hashes.append(bin_str)
+		while True:
+			with span('decode'):
+				ret, frame = cap.read()
+			if not ret:
+				break
+			count('frames_decoded')
 			
-			# Keep the last 'overlap_frames' for the next segment
-			frames = frames[-overlap_frames:]
+			with span('hash'):
+				hasher.add_frame(cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY))
 			
-		frame_count += 1
-		
-		# Process the last segment
-	if frames:
-		avg_frame = np.mean(np.array(frames), axis=0).astype(np.uint8)
-		frame_hash = imagehash.phash(Image.fromarray(avg_frame))
-		bin_str = format(int(str(frame_hash), 16), '064b')
-		hashes.append(bin_str)
-		
-	cap.release()
-	end_time = time.time()
-	computation_time = end_time - start_time  # Calculate the total time taken
-	print(f"Hashes for {video_path} calculated in {computation_time:.2f} seconds")
-	# profiler.disable()
-	# stats = pstats.Stats(profiler).sort_stats('cumtime')
-	# stats.print_stats()
-	return hashes
-
-
-def detect_shot_boundaries(video_path, threshold=0.5):
-	start_time = time.time()
-	video = cv2.VideoCapture(video_path)
-	shot_boundaries = []
-	frame_histograms = []
-	ret, prev_frame = video.read()
-	if not ret:
-		print("Failed to read the first frame.")
-		return shot_boundaries, frame_histograms
+			with span('histogram'):
+				frame_hist = calculate_histogram(frame)
+				frame_histograms.append(frame_hist)
+				if prev_hist is not None and histogram_similarity(prev_hist, frame_hist) < threshold:
+					shot_boundaries.append(frame_count)
+				prev_hist = frame_hist
+			
+			frame_count += 1
+			
+		hashes = hasher.finish()
+		cap.release()
+	#includes first frame if no shot boundaries found
+	if frame_count and not shot_boundaries:
+		print("No main video shot boundaries")
+		shot_boundaries.append(1)
+	print(f"Features for {video_path} calculated in {timing.seconds:.2f} seconds")
+	return hashes, shot_boundaries, frame_histograms, video_fps
+
+
+def extract_rgb_chunk(rgb_path, first_frame, last_frame, segment_frames, overlap_frames, threshold=0.5, block_frames=BLOCK_FRAMES):
+	"""
+	Features of frames [first_frame, last_frame] of a raw .rgb file, to be stitched with the other chunks'.
+
+	The frame before the chunk is read too, so the chunk's first frame is compared with it
+	for a shot boundary exactly as in a single pass over the video.
+
+	Returns:
+	Tuple: (BlockSegmentHasher results, shot boundaries inside the chunk, histograms of the chunk's frames).
+	"""
+	frames = map_rgb_file(rgb_path)
+	hasher = BlockSegmentHasher(len(frames), segment_frames, overlap_frames, first_frame, last_frame)
+	frame_histograms = np.empty((last_frame - first_frame + 1, 512), dtype=np.float32)
+	for block_start in range(first_frame, last_frame + 1, block_frames):
+		block = frames[block_start:min(block_start + block_frames, last_frame + 1)]
+		count('frames_decoded', len(block))
+		with span('hash'):
+			hasher.add_block(block_start, gray_frames(block))
+		with span('histogram'):
+			frame_histograms[block_start - first_frame:block_start - first_frame + len(block)] = color_histograms(block)
+	with span('histogram'):
+		prev_hist = color_histograms(frames[first_frame - 1:first_frame])[0] if first_frame > 0 else None
+		shot_boundaries = []
+		for frame_index, frame_hist in enumerate(frame_histograms, start=first_frame):
+			if prev_hist is not None and histogram_similarity(prev_hist, frame_hist) < threshold:
+				shot_boundaries.append(frame_index)
+			prev_hist = frame_hist
+	return hasher.finish(), shot_boundaries, frame_histograms
+
+
+def traced_rgb_chunk(*args):
+	"""extract_rgb_chunk in a worker process, with its trace sent back to be merged into the caller's."""
+	with Trace('chunk', record=False) as trace:
+		result = extract_rgb_chunk(*args)
+	return result, trace.snapshot()
+
+
+def extract_rgb_features(rgb_path, fps, segment_length=3, overlap_fraction=0.3, threshold=0.5, workers=1):
+	"""
+	extract_video_features for a raw .rgb file, read through a memory map instead of decoded.
+
+	Frames are processed BLOCK_FRAMES at a time: one grayscale conversion for the block
+	and one sum per segment the block overlaps. Given the same frames, the hashes and shot
+	boundaries are the same as extract_video_features'.
+
+	With workers > 1 the video is split into that many chunks of consecutive frames,
+	indexed in parallel and stitched: segments that cross a seam are summed from the
+	partial sums of both sides, so the result is identical to a single pass.
+
+	Returns:
+	Tuple: (segment hashes, shot boundaries, (frames, 512) frame histograms, fps).
+	"""
+	with span('features') as timing:
+		num_frames = len(map_rgb_file(rgb_path))
+		segment_frames = int(fps * segment_length)
+		overlap_frames = int(segment_frames * overlap_fraction)  # Calculate the number of frames to overlap
+		# Without overlap every segment starts at frame 0, so the video is not split
+		num_chunks = min(workers, num_frames) if overlap_frames > 0 else 1
+		bounds = np.linspace(0, num_frames, max(num_chunks, 1) + 1).round().astype(np.int64)
+		chunks = [(rgb_path, int(first), int(end) - 1, segment_frames, overlap_frames, threshold)
+			for first, end in zip(bounds[:-1], bounds[1:]) if end > first]
+		if len(chunks) > 1:
+			with ProcessPoolExecutor(max_workers=len(chunks), initializer=init_index_worker) as executor:
+				chunk_results = []
+				for result, snapshot in executor.map(traced_rgb_chunk, *zip(*chunks)):
+					merge_into_active(snapshot)
+					chunk_results.append(result)
+		else:
+			chunk_results = [extract_rgb_chunk(*chunk) for chunk in chunks]
+		hashes = stitch_segment_hashes([segments for segments, _, _ in chunk_results])
+		shot_boundaries = [boundary for _, boundaries, _ in chunk_results for boundary in boundaries]
+		frame_histograms = np.concatenate([histograms for _, _, histograms in chunk_results]) if chunk_results \
+			else np.empty((0, 512), dtype=np.float32)
+	#includes first frame if no shot boundaries found
+	if num_frames and not shot_boundaries:
+		print("No main video shot boundaries")
+		shot_boundaries.append(1)
+	print(f"Features for {rgb_path} calculated in {timing.seconds:.2f} seconds")
+	return hashes, shot_boundaries, frame_histograms, fps
+
+
+def index_video(video, from_rgb=False, chunk_workers=1):
+	"""
+	Index one video and its .wav, ready to send back from a worker process.
+
+	With from_rgb the frames are read from the video's raw .rgb file instead of decoded
+	from the video; only the video's fps is read from its header. The .rgb is then split
+	over chunk_workers processes. Decoded videos are always read in one pass, since
+	seeking in a compressed video is not guaranteed to land on the exact frame.
+
+	Returns:
+	Tuple: (video, fps, frame count, (width, height), dict of signature arrays keyed by store column).
+	"""
+	with Trace('index'):
+		# Only the header is read here, the frames come from the .rgb or the decode below
+		cap = cv2.VideoCapture(video)
+		fps = cap.get(cv2.CAP_PROP_FPS)
+		geometry = (FRAME_WIDTH, FRAME_HEIGHT) if from_rgb else (int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)), int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT)))
+		cap.release()
+		if from_rgb:
+			hashes, shot_boundaries, frame_histograms, fps = extract_rgb_features(f"{os.path.splitext(video)[0]}.rgb", fps, threshold=0.50,
+				workers=chunk_workers)
+		else:
+			hashes, shot_boundaries, frame_histograms, fps = extract_video_features(video, threshold=0.50)
+		frame_histograms = np.array(frame_histograms, dtype=np.float32).reshape(-1, 512)
+		with span('audio_fingerprint'):
+			wav = audio_path(video)
+			samples = load_audio(wav) if os.path.exists(wav) else np.empty(0, dtype=np.float32)
+			audio_hashes, audio_times = landmark_hashes(*spectral_peaks(samples))
+			envelope = audio_envelope(samples)
+		with span('pyramid'):
+			pyramid = histogram_pyramid(frame_histograms)
+	columns = {
+		'hashes': pack_hashes(hashes),
+		'shot_boundaries': np.array(shot_boundaries, dtype=np.int64),
+		'frame_histograms': frame_histograms,
+		'audio_hashes': audio_hashes,
+		'audio_times': audio_times,
+		'audio_envelope': envelope,
+		**{f'pyramid_{step}': level for step, level in pyramid.items()},
+	}
+	return video, fps, len(frame_histograms), geometry, columns
+
+
+def source_fingerprint(video, previous=None):
+	"""Manifest entry of a video, with the entry of its .wav under 'audio' (None without a .wav)."""
+	previous = previous or {}
+	fingerprint = dict(file_fingerprint(video, previous))
+	wav = audio_path(video)
+	fingerprint['audio'] = file_fingerprint(wav, previous.get('audio')) if os.path.exists(wav) else None
+	return fingerprint
+
+
+def same_contents(previous, fingerprint):
+	"""Whether two manifest entries describe the same video and audio contents."""
+	audio_hash = lambda entry: entry['audio']['sha1'] if entry.get('audio') else None
+	return previous['sha1'] == fingerprint['sha1'] and audio_hash(previous) == audio_hash(fingerprint)
+
+
+def init_index_worker():
+	# Each worker already gets its own core, so keep OpenCV from spawning threads on top of that
+	cv2.setNumThreads(1)
 	
-	prev_hist = calculate_histogram(prev_frame)
-	frame_histograms.append(prev_hist)
 	
-	while True:
-		ret, frame = video.read()
-		if not ret:
-			break
-		
-		frame_hist = calculate_histogram(frame)
-		frame_histograms.append(frame_hist)
-		similarity = histogram_similarity(prev_hist, frame_hist)
-		if similarity < threshold:
-			shot_boundary = int(video.get(cv2.CAP_PROP_POS_FRAMES) - 1)
-			shot_boundaries.append(shot_boundary)
+def indexed_videos(database, workers=1, from_rgb=False, chunk_workers=1):
+	"""
+	Yields index_video results in database order, indexing up to workers videos at once.
+	With from_rgb and chunk_workers > 1 the videos are indexed one at a time, each split over that many processes.
+
+	At most two results per worker are in flight, so finished signatures are written out
+	one video at a time instead of piling up in memory.
+	"""
+	index = partial(index_video, from_rgb=from_rgb, chunk_workers=chunk_workers)
+	if workers <= 1 or (from_rgb and chunk_workers > 1):
+		for video in database:
+			yield index(video)
+		return
+	
+	videos = iter(database)
+	with ProcessPoolExecutor(max_workers=workers, initializer=init_index_worker) as executor:
+		pending = deque(executor.submit(index, video) for _, video in zip(range(workers * 2), videos))
+		while pending:
+			result = pending.popleft().result()
+			for video in videos:
+				pending.append(executor.submit(index, video))
+				break
+			yield result
 			
-		prev_hist = frame_hist
-		#includes first frame if no shot boundaries found
-	video.release()
-	video = cv2.VideoCapture(video_path)
-	if not shot_boundaries:
-		print("No main video shot boundaries")
-		video.set(cv2.CAP_PROP_POS_FRAMES, 0)
-		ret, first_frame = video.read()
-		if ret:
-			shot_boundary = round(video.get(cv2.CAP_PROP_POS_FRAMES))
-			shot_boundaries.append(shot_boundary)
-	video.release()
-	end_time = time.time()
-	computation_time = end_time - start_time  # Calculate the total time taken
-	print(f"Boundaries for {video_path} calculated in {computation_time:.2f} seconds")
-	return shot_boundaries, frame_histograms
-
-
-def main():
+			
+def build_signature_store(database, directory, workers=1, from_rgb=False, chunk_workers=1):
+	"""Index every database video and write its signatures to the store at directory."""
+	writer = SignatureWriter(directory, frame_source='rgb' if from_rgb else 'video')
+	for video, fps, frame_count, geometry, columns in indexed_videos(database, workers, from_rgb, chunk_workers):
+		writer.add_video(video, fps, frame_count, source=source_fingerprint(video), geometry=geometry, **columns)
+	writer.close()
+	
+	
+def update_signature_store(database, directory, workers=1, from_rgb=False, chunk_workers=1):
+	"""
+	Brings the store at directory up to date with database, indexing only new or changed videos.
+
+	A video is reused when its manifest entry (size, mtime and content hash of the video
+	and its .wav) still matches the files. Videos that left the database or no longer exist are dropped. Reused
+	signatures are copied straight from the old store's memory maps.
+	"""
+	if not store_exists(directory):
+		build_signature_store(database, directory, workers, from_rgb, chunk_workers)
+		return
+	
+	old_store = SignatureStore(directory)
+	# Signatures of frames read another way are not comparable, so a switch re-indexes everything
+	reusable = all(old_store.has_column(name) for name in DEFAULT_COLUMNS) and old_store.frame_source == ('rgb' if from_rgb else 'video')
+	fingerprints = {}
+	changed = []
+	for video in database:
+		if not os.path.exists(video):
+			print(f"{video} no longer exists, removing it from the index")
+			continue
+		previous = old_store.source(video) if video in old_store.video_indices else None
+		fingerprints[video] = source_fingerprint(video, previous)
+		if not reusable or previous is None or not same_contents(previous, fingerprints[video]):
+			changed.append(video)
+			
+	removed = [video for video in old_store.video_paths if video not in fingerprints]
+	order_changed = [video for video in old_store.video_paths if video in fingerprints] != list(fingerprints)
+	# Files that were touched without changing still need their manifest entry refreshed
+	touched = [video for video in fingerprints if video not in changed and fingerprints[video] != old_store.source(video)]
+	if not changed and not removed and not order_changed and not touched:
+		print("Signature store is up to date")
+		return
+	print(f"Indexing {len(changed)} new or changed videos, reusing {len(fingerprints) - len(changed)}, removing {len(removed)}")
+	
+	writer = SignatureWriter(directory, frame_source='rgb' if from_rgb else 'video')
+	indexed = indexed_videos(changed, workers, from_rgb, chunk_workers)
+	for video, fingerprint in fingerprints.items():
+		if video in changed:
+			_, fps, frame_count, geometry, columns = next(indexed)
+			writer.add_video(video, fps, frame_count, source=fingerprint, geometry=geometry, **columns)
+		else:
+			columns = {name: old_store.column(name, video) for name in DEFAULT_COLUMNS}
+			writer.add_video(video, old_store.fps(video), old_store.frame_count(video), source=fingerprint,
+				geometry=old_store.geometry(video), **columns)
+	writer.close()
+	
+	
+def main(workers=1, rebuild=False, from_rgb=False, chunk_workers=1):
 	database = ['/Users/arshiabehzad/Downloads/Videos/video1.mp4',
 		'/Users/arshiabehzad/Downloads/Videos/video2.mp4',
 		'/Users/arshiabehzad/Downloads/Videos/video3.mp4',
@@ -134,26 +336,22 @@ def main():
 		'/Users/arshiabehzad/Downloads/Videos/video18.mp4',
 		'/Users/arshiabehzad/Downloads/Videos/video19.mp4',
 		'/Users/arshiabehzad/Downloads/Videos/video20.mp4']
-	video_hashes = {video_path: get_video_segment_hashes(video_path) for video_path in database}
-	shot_boundaries_dict = {}
-	frame_histograms_dict = {}
-	for video in database:
-		shot_boundaries, frame_histograms = detect_shot_boundaries(video, threshold=0.50)
-		shot_boundaries_dict[video] = shot_boundaries
-		frame_histograms_dict[video] = frame_histograms
-		
-		# Saving video hashes using Pickle
-	with open('video_hashes.pkl', 'wb') as file:
-		pickle.dump(video_hashes, file)
-		
-		# Saving shot boundaries and frame histograms using HDF5
-	with open('shot_boundaries_dict.pkl', 'wb') as file:
-		pickle.dump(shot_boundaries_dict, file)
-		
-		# Saving frame_histograms_dict
-	with open('frame_histograms_dict.pkl', 'wb') as file:
-		pickle.dump(frame_histograms_dict, file)
-		
-		
+	# Signatures go into one memory-mapped columnar store next to this script
+	signature_directory = os.path.join(current_directory, 'signatures')
+	if rebuild:
+		build_signature_store(database, signature_directory, workers=workers, from_rgb=from_rgb, chunk_workers=chunk_workers)
+	else:
+		update_signature_store(database, signature_directory, workers=workers, from_rgb=from_rgb, chunk_workers=chunk_workers)
+	
+	
 if __name__ == "__main__":
-	main()
\ No newline at end of file
+	parser = argparse.ArgumentParser(description="Build the signature store for the video database.")
+	parser.add_argument('--workers', type=int, default=1, help="number of videos indexed in parallel")
+	parser.add_argument('--rebuild', action='store_true', help="re-index every video instead of only new or changed ones")
+	parser.add_argument('--from-rgb', action='store_true', help="read frames from each video's raw .rgb file instead of decoding it")
+	parser.add_argument('--chunk-workers', type=int, default=1,
+		help="with --from-rgb, split every video over this many processes instead of indexing several videos at once")
+	args = parser.parse_args()
+	if args.chunk_workers > 1 and not args.from_rgb:
+		parser.error("--chunk-workers only applies with --from-rgb")
+	main(workers=args.workers, rebuild=args.rebuild, from_rgb=args.from_rgb, chunk_workers=args.chunk_workers)
\ No newline at end of file
@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+
+import argparse
+import http.client
+import json
+import os
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from instrumentation import configure, prometheus_text
+
+DEFAULT_ADDRESS = ('127.0.0.1', 8576)
+
+def server_address():
+	"""Address of the query server, from $VIDEO_SEARCH_SERVER (host:port) or the default."""
+	value = os.environ.get('VIDEO_SEARCH_SERVER')
+	if not value:
+		return DEFAULT_ADDRESS
+	host, _, port = value.rpartition(':')
+	return host or DEFAULT_ADDRESS[0], int(port)
+
+def request_match(clip_path, clip_rgb, address=None, timeout=600, clip_wav=None):
+	"""
+	Asks a running query server to match a clip.
+
+	Returns:
+	dict: The server's match result, or None if no server is listening.
+	"""
+	host, port = address or server_address()
+	connection = http.client.HTTPConnection(host, port, timeout=1)
+	try:
+		connection.connect()
+	except OSError:
+		return None
+	try:
+		connection.sock.settimeout(timeout)
+		request = {'clip_path': os.path.abspath(clip_path), 'clip_rgb': os.path.abspath(clip_rgb)}
+		if clip_wav:
+			request['clip_wav'] = os.path.abspath(clip_wav)
+		body = json.dumps(request)
+		connection.request('POST', '/match', body=body, headers={'Content-Type': 'application/json'})
+		response = connection.getresponse()
+		result = json.loads(response.read())
+	finally:
+		connection.close()
+	if response.status != 200:
+		raise RuntimeError(f"Query server failed: {result.get('error')}")
+	return result
+
+class QueryRequestHandler(BaseHTTPRequestHandler):
+	"""
+	POST /match answers {"clip_path", "clip_rgb"[, "clip_wav"]}; GET /health reports the loaded
+	index and GET /metrics the per-stage totals in the Prometheus text format.
+	"""
+
+	def _reply(self, status, payload):
+		body = json.dumps(payload).encode()
+		self.send_response(status)
+		self.send_header('Content-Type', 'application/json')
+		self.send_header('Content-Length', str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+	def do_GET(self):
+		if self.path == '/metrics':
+			body = prometheus_text().encode()
+			self.send_response(200)
+			self.send_header('Content-Type', 'text/plain; version=0.0.4')
+			self.send_header('Content-Length', str(len(body)))
+			self.end_headers()
+			self.wfile.write(body)
+			return
+		if self.path != '/health':
+			self._reply(404, {'error': f"Unknown path {self.path}"})
+			return
+		self._reply(200, {'status': 'ok', 'videos': len(self.server.matcher.store.video_paths)})
+
+	def do_POST(self):
+		if self.path != '/match':
+			self._reply(404, {'error': f"Unknown path {self.path}"})
+			return
+		start_time = time.time()
+		try:
+			request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+			result = self.server.matcher.match(request['clip_path'], request['clip_rgb'], request.get('clip_wav'))
+		except Exception as error:
+			self._reply(500, {'error': repr(error)})
+			return
+		result['timings']['request'] = time.time() - start_time
+		self._reply(200, result)
+
+def serve(address=None, signature_directory=None, workers=None, sequential_prefix=2, cache_size=None, cache_path=None,
+	rgb_check_frames=1, compact_tolerance=None):
+	"""
+	Loads the signature index once and answers match requests until interrupted.
+
+	The result cache is kept in cache_path, if given, when the server stops.
+	"""
+	# Imported here so that clients only pay for the standard library
+	from main_algorithim import VideoMatcher
+	from histogram_alignment import COMPACT_TOLERANCE
+	from result_cache import CACHE_SIZE
+
+	matcher = VideoMatcher(signature_directory, workers=workers, sequential_prefix=sequential_prefix,
+		cache_size=CACHE_SIZE if cache_size is None else cache_size, cache_path=cache_path, rgb_check_frames=rgb_check_frames,
+		compact_tolerance=COMPACT_TOLERANCE if compact_tolerance is None else compact_tolerance)
+	server = ThreadingHTTPServer(address or server_address(), QueryRequestHandler)
+	server.daemon_threads = True
+	server.matcher = matcher
+	host, port = server.server_address[:2]
+	print(f"Serving matches for {len(matcher.store.video_paths)} videos on http://{host}:{port}")
+	try:
+		server.serve_forever()
+	except KeyboardInterrupt:
+		pass
+	finally:
+		server.server_close()
+		matcher.close()
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="Keep the signature index loaded and answer match requests over HTTP.")
+	parser.add_argument('--host', default=None, help="address to listen on")
+	parser.add_argument('--port', type=int, default=None, help="port to listen on")
+	parser.add_argument('--signatures', default=None, help="signature store directory")
+	parser.add_argument('--workers', type=int, default=None, help="localization worker processes, defaults to the number of cores")
+	parser.add_argument('--sequential-prefix', type=int, default=2, help="best ranked videos searched before using the workers")
+	parser.add_argument('--trace', default=None, help="append every query's trace to this file as JSON lines")
+	parser.add_argument('--profile', action='store_true', help="run cProfile and tracemalloc on every query, stored in its trace")
+	parser.add_argument('--rgb-check-frames', type=int, default=1, help="clip frames, spread over the clip, a match must equal exactly")
+	parser.add_argument('--compact-tolerance', type=float, default=None,
+		help="how far below the frame threshold a compact histogram bound may be and still be rescored")
+	parser.add_argument('--cache-size', type=int, default=None, help="query results remembered, 0 to turn the cache off")
+	parser.add_argument('--cache-file', default=None, help="keep the query result cache in this file between runs")
+	args = parser.parse_args()
+	configure(args.trace, args.profile or None)
+	host, port = server_address()
+	serve((args.host or host, args.port or port), args.signatures, args.workers, args.sequential_prefix,
+		args.cache_size, args.cache_file, args.rgb_check_frames,
+		args.compact_tolerance)
@@ -0,0 +1,95 @@
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+# Results kept before the least recently used one is evicted
+CACHE_SIZE = 1024
+
+def clip_key(packed_hashes, first_rgb_frame):
+	"""
+	Content fingerprint of a query clip: a digest of its phash sequence and one of its first raw frame.
+
+	Two clips with the same key have the same segment hashes and the same first frame, so
+	they match the same video at the same start frame.
+	"""
+	hash_digest = hashlib.sha1(np.ascontiguousarray(packed_hashes, dtype=np.uint64).tobytes()).hexdigest()
+	frame_digest = hashlib.sha1(b'' if first_rgb_frame is None else np.ascontiguousarray(first_rgb_frame).tobytes()).hexdigest()
+	return f"{hash_digest}:{frame_digest}"
+
+class QueryResultCache:
+	"""
+	Bounded LRU map from clip_key to the (video path, start frame) the clip matched.
+
+	Results are only valid for the signature store they were found in, so the cache is
+	tied to the store's generation: entries saved for another generation are dropped when
+	the file is loaded. With a path the entries are read at start-up and written back by
+	save(), replacing the file in one rename.
+	"""
+
+	def __init__(self, generation, capacity=CACHE_SIZE, path=None):
+		self.generation = generation
+		self.capacity = capacity
+		self.path = path
+		self.entries = OrderedDict()
+		# The query server matches clips from several threads at once
+		self.lock = threading.Lock()
+		if path is not None and os.path.exists(path):
+			self.load()
+
+	def __len__(self):
+		return len(self.entries)
+
+	def load(self):
+		try:
+			with open(self.path) as file:
+				saved = json.load(file)
+		except (OSError, ValueError):
+			print(f"Ignoring unreadable query cache {self.path}")
+			return
+		if saved.get('generation') != self.generation:
+			print("Signature store changed since the query cache was saved, starting with an empty cache")
+			return
+		with self.lock:
+			for key, video_path, start_frame in saved['entries'][-self.capacity:]:
+				self.entries[key] = (video_path, start_frame)
+
+	def save(self):
+		if self.path is None:
+			return
+		with self.lock:
+			saved = {
+				'generation': self.generation,
+				'entries': [[key, video_path, start_frame] for key, (video_path, start_frame) in self.entries.items()],
+			}
+		temp_path = f"{self.path}.tmp"
+		with open(temp_path, 'w') as file:
+			json.dump(saved, file)
+		os.replace(temp_path, self.path)
+
+	def get(self, key):
+		"""The cached (video path, start frame) for key, or None; a hit becomes the most recently used entry."""
+		with self.lock:
+			if key not in self.entries:
+				return None
+			self.entries.move_to_end(key)
+			return self.entries[key]
+
+	def reset(self, generation):
+		"""Drop every entry, for results of the store generation replacing the cache's."""
+		with self.lock:
+			self.generation = generation
+			self.entries.clear()
+
+	def put(self, key, video_path, start_frame, generation=None):
+		"""Remember a match, unless it was found in another generation of the store than the cache's."""
+		with self.lock:
+			if generation is not None and generation != self.generation:
+				return
+			self.entries[key] = (video_path, int(start_frame))
+			self.entries.move_to_end(key)
+			while len(self.entries) > self.capacity:
+				self.entries.popitem(last=False)
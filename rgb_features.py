@@ -0,0 +1,137 @@
+import cv2
+import numpy as np
+
+from segment_hashing import phash_bits
+
+# Frames read from the memory map and converted at once
+BLOCK_FRAMES = 64
+
+def gray_frames(frames):
+	"""
+	Grayscale of a (frames, height, width, 3) block of RGB frames.
+
+	The block is converted by one cvtColor call, as a single image of stacked frames, so the
+	result is bit-identical to converting every frame on its own.
+	"""
+	count, height, width, _ = frames.shape
+	return cv2.cvtColor(np.ascontiguousarray(frames).reshape(count * height, width, 3), cv2.COLOR_RGB2GRAY).reshape(count, height, width)
+
+def color_histograms(frames):
+	"""
+	calculate_histogram of every frame of a block of RGB frames.
+
+	The channels are passed to calcHist in BGR order, so every histogram is identical to
+	calculate_histogram of the decoded BGR frame.
+
+	Returns:
+	ndarray: (frames, 512) float32 histograms.
+	"""
+	histograms = np.empty((len(frames), 512), dtype=np.float32)
+	for i, frame in enumerate(frames):
+		histogram = cv2.calcHist([frame], [2, 1, 0], None, [8, 8, 8], [0, 256, 0, 256, 0, 256])
+		histograms[i] = cv2.normalize(histogram, histogram).ravel()
+	return histograms
+
+def segment_ranges(num_frames, segment_frames, overlap_frames):
+	"""
+	First and last frame (inclusive) of every segment SegmentHasher hashes for num_frames frames.
+
+	A segment closes on every frame k > 0 with k % segment_frames == 0, including that frame,
+	and the next one starts with its last overlap_frames frames; with no overlap, the sum is
+	never reset, so every segment starts at frame 0. The frames after the last close form
+	one more, partial segment.
+	"""
+	ranges = []
+	start = 0
+	for close in range(segment_frames, num_frames, segment_frames):
+		ranges.append((start, close))
+		if overlap_frames > 0:
+			start = max(close - overlap_frames + 1, 0)
+	if num_frames:
+		ranges.append((start, num_frames - 1))
+	return ranges
+
+class BlockSegmentHasher:
+	"""
+	SegmentHasher for frames that arrive in blocks, over a whole video of known length
+	or over one chunk [first_frame, last_frame] of it.
+
+	Each open segment keeps an integer sum of its grayscale frames, and a block adds
+	its slice of frames to every segment it overlaps with one sum over the frame axis.
+	A segment is hashed as soon as its last frame has been added, unless it starts
+	before the chunk: that one, like any segment still open when the chunk ends, is
+	kept as a partial sum for stitch_segment_hashes to complete with the neighbouring
+	chunks' sums. Without overlap every segment starts at frame 0, so their sums are
+	taken from one running total and only whole videos can be hashed.
+	"""
+
+	def __init__(self, num_frames, segment_frames, overlap_frames, first_frame=0, last_frame=None):
+		if overlap_frames <= 0 and first_frame > 0:
+			raise ValueError("Segments without overlap all start at frame 0 and cannot be hashed in chunks")
+		self.ranges = segment_ranges(num_frames, segment_frames, overlap_frames)
+		self.cumulative = overlap_frames <= 0
+		self.first_frame = first_frame
+		self.last_frame = num_frames - 1 if last_frame is None else last_frame
+		self.totals = {}
+		self.running_total = None
+		# Segments end in order, so the first one still open is found once and then advanced
+		self.next_segment = next((segment for segment, (_, last) in enumerate(self.ranges) if last >= first_frame), len(self.ranges))
+		self.results = {}
+
+	def _add_cumulative(self, block_start, gray_block):
+		block_end = block_start + len(gray_block) - 1
+		position = block_start
+		while self.next_segment < len(self.ranges) and self.ranges[self.next_segment][1] <= block_end:
+			last = self.ranges[self.next_segment][1]
+			part = gray_block[position - block_start:last - block_start + 1].sum(axis=0, dtype=np.uint32)
+			self.running_total = part if self.running_total is None else self.running_total + part
+			self.results[self.next_segment] = phash_bits((self.running_total / (last + 1)).astype(np.uint8))
+			position = last + 1
+			self.next_segment += 1
+		if position <= block_end:
+			part = gray_block[position - block_start:].sum(axis=0, dtype=np.uint32)
+			self.running_total = part if self.running_total is None else self.running_total + part
+
+	def add_block(self, block_start, gray_block):
+		if self.cumulative:
+			self._add_cumulative(block_start, gray_block)
+			return
+		block_end = block_start + len(gray_block) - 1
+		for segment in range(self.next_segment, len(self.ranges)):
+			first, last = self.ranges[segment]
+			if first > block_end:
+				break
+			low, high = max(first, block_start), min(last, block_end)
+			if low <= high:
+				part = gray_block[low - block_start:high - block_start + 1].sum(axis=0, dtype=np.uint32)
+				self.totals[segment] = self.totals[segment] + part if segment in self.totals else part
+			if last <= block_end:
+				total = self.totals.pop(segment)
+				if first >= self.first_frame:
+					self.results[segment] = phash_bits((total / (last - first + 1)).astype(np.uint8))
+				else:
+					self.results[segment] = (total, last - self.first_frame + 1)
+				self.next_segment = segment + 1
+
+	def finish(self):
+		"""
+		Results by segment number: the hash bits of every segment wholly inside the chunk
+		and a (sum, frames) partial of every other segment it overlaps.
+		"""
+		for segment, total in self.totals.items():
+			first, last = self.ranges[segment]
+			self.results[segment] = (total, min(last, self.last_frame) - max(first, self.first_frame) + 1)
+		self.totals = {}
+		return self.results
+
+def stitch_segment_hashes(chunk_results):
+	"""Segment hashes of a whole video, in order, from the BlockSegmentHasher results of all its chunks."""
+	merged = {}
+	for results in chunk_results:
+		for segment, result in results.items():
+			if segment in merged and not isinstance(result, str):
+				total, frames = merged[segment]
+				result = (total + result[0], frames + result[1])
+			merged[segment] = result
+	return [result if isinstance(result, str) else phash_bits((result[0] / result[1]).astype(np.uint8))
+		for _, result in sorted(merged.items())]
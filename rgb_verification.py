@@ -0,0 +1,83 @@
+import os
+
+import numpy as np
+
+from instrumentation import count, span
+
+FRAME_WIDTH = 352
+FRAME_HEIGHT = 288
+
+def map_rgb_file(rgb_path, frame_width=FRAME_WIDTH, frame_height=FRAME_HEIGHT):
+	"""Memory-map a raw .rgb file as a (frames, height, width, 3) uint8 array without reading it."""
+	bytes_per_frame = frame_width * frame_height * 3
+	num_frames = os.path.getsize(rgb_path) // bytes_per_frame
+	if num_frames == 0:
+		return np.empty((0, frame_height, frame_width, 3), dtype=np.uint8)
+	return np.memmap(rgb_path, dtype=np.uint8, mode='r', shape=(num_frames, frame_height, frame_width, 3))
+
+def spread_offsets(num_frames, check_frames):
+	"""check_frames frame offsets spread evenly over a clip, always starting with frame 0."""
+	if num_frames == 0:
+		return np.zeros(1, dtype=np.int64)
+	return np.unique(np.linspace(0, num_frames - 1, max(check_frames, 1)).round().astype(np.int64))
+
+class RgbVerifier:
+	"""
+	Confirms candidate start frames by exact comparison of raw .rgb frames.
+
+	The clip frames used for the check are read once when the verifier is built. The
+	database .rgb files are memory-mapped on first use, and all candidates of a video are
+	compared in one vectorized pass per checked frame, so only the compared frames are paged in.
+	With check_frames > 1 a candidate must also match frames spread over the rest of the clip.
+	"""
+
+	def __init__(self, clip_rgb, check_frames=1, chunk_size=64):
+		clip_frames = map_rgb_file(clip_rgb)
+		self.check_offsets = spread_offsets(len(clip_frames), check_frames)
+		self.check_offsets = self.check_offsets[self.check_offsets < len(clip_frames)]
+		self.clip_frames = np.array(clip_frames[self.check_offsets])
+		self.chunk_size = chunk_size
+		self._maps = {}
+
+	def __getstate__(self):
+		# Memory maps are reopened by whichever process uses the verifier
+		state = self.__dict__.copy()
+		state['_maps'] = {}
+		return state
+
+	@property
+	def first_frame(self):
+		return self.clip_frames[0] if len(self.clip_frames) else None
+
+	def video_frames(self, rgb_path):
+		if rgb_path not in self._maps:
+			self._maps[rgb_path] = map_rgb_file(rgb_path)
+		return self._maps[rgb_path]
+
+	def matches(self, rgb_path, candidate_indices, found_match=None):
+		"""
+		Boolean mask of the candidate start frames whose checked frames all equal the clip's.
+
+		found_match is checked before every chunk; once it is set no candidate matches.
+		"""
+		candidate_indices = np.asarray(candidate_indices, dtype=np.int64)
+		count('candidates_verified', len(candidate_indices))
+		with span('rgb_verify'):
+			matched = np.full(len(candidate_indices), len(self.clip_frames) > 0)
+			video_frames = self.video_frames(rgb_path)
+			for offset, clip_frame in zip(self.check_offsets, self.clip_frames):
+				frame_indices = candidate_indices + offset
+				matched &= frame_indices < len(video_frames)
+				remaining = np.flatnonzero(matched)
+				for start in range(0, len(remaining), self.chunk_size):
+					if found_match is not None and found_match.is_set():
+						matched[:] = False
+						return matched
+					chunk = remaining[start:start + self.chunk_size]
+					matched[chunk] = (video_frames[frame_indices[chunk]] == clip_frame).all(axis=(1, 2, 3))
+			return matched
+
+	def first_match(self, rgb_path, candidate_indices, found_match=None):
+		"""The first candidate, in the given order, that passes the check, or -1."""
+		matched = np.flatnonzero(self.matches(rgb_path, candidate_indices, found_match))
+		return int(candidate_indices[matched[0]]) if len(matched) else -1
@@ -0,0 +1,77 @@
+import imagehash
+import numpy as np
+from PIL import Image
+
+def phash_bits(avg_frame):
+	"""Perceptual hash of a grayscale frame, as a 64-character binary string."""
+	frame_hash = imagehash.phash(Image.fromarray(avg_frame))
+	return format(int(str(frame_hash), 16), '064b')
+
+class SegmentHasher:
+	"""
+	Streaming segment hashing with memory bounded by the overlap.
+
+	Produces exactly the hashes of the original list-based loop: a segment is closed every
+	segment_frames frames, hashed from the mean of its grayscale frames, and its last
+	overlap_frames frames start the next segment. Instead of keeping the segment's frames,
+	it keeps a running integer sum of them plus a ring buffer of the last overlap_frames
+	frames and their sum, so closing a segment never restacks a 3-D array.
+	"""
+
+	def __init__(self, segment_frames, overlap_frames):
+		self.segment_frames = segment_frames
+		self.overlap_frames = overlap_frames
+		self.hashes = []
+		self.frame_count = 0
+		self.total = None
+		self.count = 0
+		self.ring = None
+		self.ring_total = None
+		self.ring_size = 0
+		self.ring_position = 0
+
+	def _allocate(self, shape):
+		# Integer sums are exact, so total / count is bit-identical to np.mean over the frames
+		self.total = np.zeros(shape, dtype=np.uint32)
+		if self.overlap_frames > 0:
+			self.ring = np.empty((self.overlap_frames,) + shape, dtype=np.uint8)
+			self.ring_total = np.zeros(shape, dtype=np.uint32)
+
+	def _remember(self, gray_frame):
+		"""Keep gray_frame in the ring of the last overlap_frames frames."""
+		if self.ring_size == self.overlap_frames:
+			self.ring_total -= self.ring[self.ring_position]
+		else:
+			self.ring_size += 1
+		self.ring[self.ring_position] = gray_frame
+		self.ring_total += gray_frame
+		self.ring_position = (self.ring_position + 1) % self.overlap_frames
+
+	def _hash_segment(self):
+		avg_frame = (self.total / self.count).astype(np.uint8)
+		self.hashes.append(phash_bits(avg_frame))
+
+	def add_frame(self, gray_frame):
+		if self.total is None:
+			self._allocate(gray_frame.shape)
+		self.total += gray_frame
+		self.count += 1
+		if self.overlap_frames > 0:
+			self._remember(gray_frame)
+
+		if self.frame_count % self.segment_frames == 0 and self.frame_count != 0:
+			self._hash_segment()
+			# Carry the overlap into the next segment; with no overlap the original
+			# frames[-0:] kept the whole segment, so the sum is left as it is
+			if self.overlap_frames > 0:
+				self.total[...] = self.ring_total
+				self.count = self.ring_size
+
+		self.frame_count += 1
+
+	def finish(self):
+		"""Hash the last, partial segment and return all hashes."""
+		if self.count:
+			self._hash_segment()
+			self.count = 0
+		return self.hashes
@@ -0,0 +1,113 @@
+import itertools
+import os
+
+import numpy as np
+
+from hash_index import bucket_positions
+
+NGRAM_LENGTH = 2
+# Shot lengths are bucketed to this many frames, and a query also probes the neighbouring
+# buckets, so cuts detected a frame or two apart still produce the same key
+SHOT_QUANTUM = 2
+QUANTIZED_BITS = 16
+MAX_CANDIDATES = 8
+
+def quantized_shot_lengths(shot_boundaries):
+	"""Lengths of the shots between consecutive cuts, in SHOT_QUANTUM buckets."""
+	lengths = np.diff(np.asarray(shot_boundaries, dtype=np.int64)) // SHOT_QUANTUM
+	return np.clip(lengths, 0, (1 << QUANTIZED_BITS) - 1).astype(np.uint64)
+
+def pack_ngrams(quantized_lengths, ngram_length=NGRAM_LENGTH):
+	"""One uint64 key for every run of ngram_length consecutive quantized shot lengths."""
+	count = len(quantized_lengths) - ngram_length + 1
+	keys = np.zeros(max(count, 0), dtype=np.uint64)
+	for position in range(ngram_length):
+		keys = (keys << np.uint64(QUANTIZED_BITS)) | quantized_lengths[position:position + count]
+	return keys
+
+class ShotLengthIndex:
+	"""
+	Index from n-grams of consecutive shot lengths to the cut each n-gram starts at.
+
+	Built from the store's shot_boundaries column: entry i of rows is the row of that column
+	holding the first cut of the n-gram with key sorted_keys[i]. A clip with cuts at the same
+	spacing is then placed by binary search, without comparing any frames.
+	"""
+
+	def __init__(self, sorted_keys, rows, boundary_offsets=None, boundaries=None, ngram_length=NGRAM_LENGTH):
+		self.sorted_keys = sorted_keys
+		self.rows = rows
+		self.boundary_offsets = None if boundary_offsets is None else np.asarray(boundary_offsets)
+		self.boundaries = boundaries
+		self.ngram_length = ngram_length
+
+	@classmethod
+	def build(cls, boundaries, boundary_offsets, ngram_length=NGRAM_LENGTH):
+		keys = []
+		rows = []
+		for start, end in zip(boundary_offsets[:-1], boundary_offsets[1:]):
+			video_keys = pack_ngrams(quantized_shot_lengths(boundaries[start:end]), ngram_length)
+			keys.append(video_keys)
+			rows.append(np.arange(start, start + len(video_keys), dtype=np.int64))
+		keys = np.concatenate(keys) if keys else np.empty(0, dtype=np.uint64)
+		rows = np.concatenate(rows) if rows else np.empty(0, dtype=np.int64)
+		order = np.argsort(keys, kind='stable')
+		return cls(keys[order], rows[order], boundary_offsets, boundaries, ngram_length)
+
+	@staticmethod
+	def exists(directory):
+		return os.path.exists(os.path.join(directory, 'shot_index_keys.npy'))
+
+	@classmethod
+	def load(cls, directory, boundary_offsets, boundaries):
+		"""Memory-map a saved index; boundary_offsets and boundaries are the store's shot_boundaries column."""
+		sorted_keys = np.load(os.path.join(directory, 'shot_index_keys.npy'), mmap_mode='r')
+		rows = np.load(os.path.join(directory, 'shot_index_rows.npy'), mmap_mode='r')
+		return cls(sorted_keys, rows, boundary_offsets, boundaries)
+
+	def save(self, directory):
+		np.save(os.path.join(directory, 'shot_index_keys.npy'), self.sorted_keys)
+		np.save(os.path.join(directory, 'shot_index_rows.npy'), self.rows)
+
+	def candidate_starts(self, clip_cuts, video_index=None, max_candidates=MAX_CANDIDATES):
+		"""
+		Start frames implied by the library cuts whose shot lengths match the clip's.
+
+		Every n-gram of the clip is looked up with each of its lengths also moved to the
+		neighbouring buckets; a match of the clip's cut k with library cut b votes for the
+		clip starting at frame b - clip_cuts[k] of that video.
+
+		Returns:
+		list: Up to max_candidates (video index, start frame, votes), most votes first, only
+		for video_index when it is given.
+		"""
+		lengths = quantized_shot_lengths(clip_cuts).astype(np.int64)
+		count = len(lengths) - self.ngram_length + 1
+		if count <= 0 or not len(self.sorted_keys):
+			return []
+		windows = np.stack([lengths[position:position + count] for position in range(self.ngram_length)], axis=1)
+		shifts = np.array(list(itertools.product((-1, 0, 1), repeat=self.ngram_length)), dtype=np.int64)
+		probes = windows[:, None, :] + shifts[None, :, :]
+		valid = (probes >= 0).all(axis=2)
+		probe_cuts = np.nonzero(valid)[0]
+		probe_keys = np.zeros(len(probe_cuts), dtype=np.uint64)
+		for position in range(self.ngram_length):
+			probe_keys = (probe_keys << np.uint64(QUANTIZED_BITS)) | probes[valid][:, position].astype(np.uint64)
+
+		low = np.searchsorted(self.sorted_keys, probe_keys, side='left')
+		high = np.searchsorted(self.sorted_keys, probe_keys, side='right')
+		counts = high - low
+		if not counts.sum():
+			return []
+		positions = bucket_positions(low, counts)
+		rows = np.asarray(self.rows[positions]).astype(np.int64)
+		videos = np.searchsorted(self.boundary_offsets, rows, side='right') - 1
+		starts = np.asarray(self.boundaries[rows]).astype(np.int64) - np.asarray(clip_cuts, dtype=np.int64)[np.repeat(probe_cuts, counts)]
+		if video_index is not None:
+			videos, starts = videos[videos == video_index], starts[videos == video_index]
+			if not len(videos):
+				return []
+
+		keys, votes = np.unique(np.stack([videos, starts]), axis=1, return_counts=True)
+		order = np.argsort(-votes, kind='stable')[:max_candidates]
+		return [(int(keys[0, i]), int(keys[1, i]), int(votes[i])) for i in order]
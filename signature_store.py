@@ -0,0 +1,309 @@
+import hashlib
+import json
+import os
+import shutil
+import uuid
+
+import numpy as np
+
+from audio_fingerprint import AudioFingerprintIndex
+from frame_histogram_index import FrameHistogramIndex
+from hash_index import HashLibrary, MultiIndexHashTable
+from histogram_alignment import COMPACT_SCALE, PYRAMID_BINS, PYRAMID_STEPS, HistogramProjection
+from rgb_verification import FRAME_HEIGHT, FRAME_WIDTH
+from shot_fingerprint import ShotLengthIndex
+
+STORE_VERSION = 1
+INDEX_FILE = 'index.json'
+OFFSETS_FILE = 'offsets.npy'
+
+# Column name -> (dtype, shape of one row)
+DEFAULT_COLUMNS = {
+	'hashes': ('uint64', ()),
+	'shot_boundaries': ('int64', ()),
+	'frame_histograms': ('float32', (512,)),
+	'audio_hashes': ('uint32', ()),
+	'audio_times': ('int32', ()),
+	'audio_envelope': ('float32', ()),
+	**{f'pyramid_{step}': ('float32', (PYRAMID_BINS,)) for step in PYRAMID_STEPS},
+}
+
+def column_file(directory, name):
+	return os.path.join(directory, f"{name}.bin")
+
+def store_exists(directory):
+	return os.path.exists(os.path.join(directory, INDEX_FILE))
+
+def index_file_stat(directory):
+	"""(inode, mtime) of a store's index file, which changes whenever the store is rebuilt or updated, or None without one."""
+	try:
+		stat = os.stat(os.path.join(directory, INDEX_FILE))
+	except FileNotFoundError:
+		return None
+	return stat.st_ino, stat.st_mtime_ns
+
+def content_hash(path, chunk_size=1 << 20):
+	"""SHA-1 of a file's contents, read in chunks."""
+	digest = hashlib.sha1()
+	with open(path, 'rb') as file:
+		for chunk in iter(lambda: file.read(chunk_size), b''):
+			digest.update(chunk)
+	return digest.hexdigest()
+
+def file_fingerprint(path, previous=None):
+	"""
+	Manifest entry identifying the contents of a source file.
+
+	The content hash is only recomputed when the size or mtime differ from the
+	previous entry, so unchanged files cost a single stat().
+	"""
+	stat = os.stat(path)
+	if previous and previous['size'] == stat.st_size and previous['mtime_ns'] == stat.st_mtime_ns:
+		return previous
+	return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'sha1': content_hash(path)}
+
+class SignatureWriter:
+	"""
+	Writes per-video signatures into one contiguous raw file per column.
+
+	Every video's rows are appended to the column files as soon as it is added, and
+	close() writes the offset table and metadata. The store is built next to the target
+	directory and swapped in at the end, so readers never see a half-written store: the
+	target is a symlink to the current version, replaced in one rename.
+	"""
+
+	def __init__(self, directory, columns=None, frame_source='video'):
+		self.directory = directory
+		self.columns = dict(DEFAULT_COLUMNS if columns is None else columns)
+		# 'video' when the frames were decoded from the videos, 'rgb' when read from their .rgb files
+		self.frame_source = frame_source
+		self.temp_directory = f"{directory}.tmp"
+		if os.path.exists(self.temp_directory):
+			shutil.rmtree(self.temp_directory)
+		os.makedirs(self.temp_directory)
+		self.files = {name: open(column_file(self.temp_directory, name), 'wb') for name in self.columns}
+		self.videos = []
+		self.offsets = [[0] * len(self.columns)]
+
+	def add_video(self, video_path, fps, frame_count, source=None, geometry=None, **arrays):
+		"""
+		Append one video's signature, given as one array per column.
+
+		source is the file_fingerprint of the indexed file, kept as the video's manifest entry,
+		and geometry its (width, height).
+		"""
+		row_counts = []
+		for name, (dtype, row_shape) in self.columns.items():
+			array = np.ascontiguousarray(arrays[name], dtype=dtype).reshape((-1,) + tuple(row_shape))
+			array.tofile(self.files[name])
+			row_counts.append(len(array))
+		self.offsets.append([offset + count for offset, count in zip(self.offsets[-1], row_counts)])
+		video = {'path': video_path, 'fps': fps, 'frame_count': int(frame_count), 'source': source}
+		if geometry is not None:
+			video['width'], video['height'] = (int(size) for size in geometry)
+		self.videos.append(video)
+
+	def close(self):
+		for file in self.files.values():
+			file.close()
+		np.save(os.path.join(self.temp_directory, OFFSETS_FILE), np.array(self.offsets, dtype=np.int64))
+		index = {
+			'version': STORE_VERSION,
+			'columns': {name: {'dtype': dtype, 'row_shape': list(row_shape)} for name, (dtype, row_shape) in self.columns.items()},
+			'videos': self.videos,
+			'frame_source': self.frame_source,
+			# New for every build or update, so anything derived from one store can tell it was replaced
+			'generation': uuid.uuid4().hex,
+		}
+		with open(os.path.join(self.temp_directory, INDEX_FILE), 'w') as file:
+			json.dump(index, file)
+		self.generation = index['generation']
+
+		if 'hashes' in self.columns:
+			hashes = np.fromfile(column_file(self.temp_directory, 'hashes'), dtype=np.uint64)
+			MultiIndexHashTable.build(hashes).save(self.temp_directory)
+		if 'audio_hashes' in self.columns:
+			audio_hashes = np.fromfile(column_file(self.temp_directory, 'audio_hashes'), dtype=np.uint32)
+			AudioFingerprintIndex.build(audio_hashes).save(self.temp_directory)
+		if 'shot_boundaries' in self.columns:
+			boundaries = np.fromfile(column_file(self.temp_directory, 'shot_boundaries'), dtype=np.int64)
+			boundary_offsets = [offsets[list(self.columns).index('shot_boundaries')] for offsets in self.offsets]
+			ShotLengthIndex.build(boundaries, boundary_offsets).save(self.temp_directory)
+		if 'frame_histograms' in self.columns:
+			dtype, row_shape = self.columns['frame_histograms']
+			rows = self.offsets[-1][list(self.columns).index('frame_histograms')]
+			# Memory-mapped, the projection reads the column a block at a time
+			frame_histograms = np.empty((0,) + tuple(row_shape), dtype=dtype) if rows == 0 else np.memmap(
+				column_file(self.temp_directory, 'frame_histograms'), dtype=dtype, mode='r', shape=(rows,) + tuple(row_shape))
+			projection = HistogramProjection.fit(frame_histograms)
+			compact, residuals = projection.compact(frame_histograms)
+			projection.save(self.temp_directory, compact, residuals)
+			FrameHistogramIndex.build(compact.astype(np.float32) / COMPACT_SCALE).save(self.temp_directory)
+
+		self.swap_in()
+
+	def swap_in(self):
+		"""
+		Point the target directory at the finished store and remove the one it replaces.
+
+		Each version lives in its own <directory>.<generation> and the target is a symlink to
+		it, so replacing the link is a single rename and the target never goes missing. A
+		store written before the target was a link is moved aside to <directory>.old first,
+		which leaves it missing only between two renames, once.
+		"""
+		old_directory = f"{self.directory}.old"
+		# Left behind by an update that was interrupted after moving the old store aside
+		if os.path.exists(old_directory):
+			shutil.rmtree(old_directory)
+		version_directory = f"{self.directory}.{self.generation}"
+		os.rename(self.temp_directory, version_directory)
+		link = f"{self.directory}.link"
+		if os.path.lexists(link):
+			os.remove(link)
+		os.symlink(os.path.basename(version_directory), link)
+
+		previous_directory = None
+		if os.path.islink(self.directory):
+			previous_directory = os.path.join(os.path.dirname(self.directory), os.readlink(self.directory))
+		elif os.path.exists(self.directory):
+			previous_directory = old_directory
+			os.rename(self.directory, previous_directory)
+		os.replace(link, self.directory)
+		# Open stores keep reading the previous version's files through their memory maps
+		if previous_directory is not None and os.path.isdir(previous_directory):
+			shutil.rmtree(previous_directory)
+
+class SignatureStore:
+	"""
+	Read-only view of a signature store.
+
+	Columns are opened with np.memmap when the store is opened and per-video accessors
+	return slices of those maps, so only the pages of the videos actually looked at are read.
+	"""
+
+	def __init__(self, directory):
+		self.directory = directory
+		# Every file is read from the version the link points at now, even if an update replaces it meanwhile
+		directory = os.path.realpath(directory)
+		self.version_directory = directory
+		with open(os.path.join(directory, INDEX_FILE)) as file:
+			index = json.load(file)
+		if index['version'] != STORE_VERSION:
+			raise ValueError(f"Unsupported signature store version {index['version']}")
+		self.columns = index['columns']
+		self.frame_source = index.get('frame_source', 'video')
+		# Stores written before generations were recorded are identified by their index file
+		self.generation = index.get('generation') or content_hash(os.path.join(directory, INDEX_FILE))
+		self.column_names = list(self.columns)
+		self.videos = index['videos']
+		self.video_paths = [video['path'] for video in self.videos]
+		self.video_indices = {video_path: i for i, video_path in enumerate(self.video_paths)}
+		self.offsets = np.load(os.path.join(directory, OFFSETS_FILE), mmap_mode='r')
+		# Every column and index is mapped here rather than on first use. A map reads nothing until
+		# it is accessed and keeps the file it was opened with, so an update swapping the directory
+		# under an open store cannot pair these offsets with the new store's columns.
+		self._maps = {name: self._map_column(name) for name in self.column_names}
+		self._hash_index = MultiIndexHashTable.load(directory) if MultiIndexHashTable.exists(directory) else None
+		self._audio_index = AudioFingerprintIndex.load(directory, self.column_offsets('audio_hashes'), self._column('audio_times')) \
+			if self.has_column('audio_hashes') and AudioFingerprintIndex.exists(directory) else None
+		self._shot_index = ShotLengthIndex.load(directory, self.column_offsets('shot_boundaries'), self._column('shot_boundaries')) \
+			if ShotLengthIndex.exists(directory) else None
+		self._compact_histograms = HistogramProjection.load(directory) if HistogramProjection.exists(directory) else None
+		self._histogram_index = FrameHistogramIndex.load(directory, self.column_offsets('frame_histograms')) \
+			if FrameHistogramIndex.exists(directory) else None
+
+	def _map_column(self, name):
+		dtype = np.dtype(self.columns[name]['dtype'])
+		row_shape = tuple(self.columns[name]['row_shape'])
+		rows = int(self.offsets[-1, self.column_names.index(name)])
+		if rows == 0:
+			return np.empty((0,) + row_shape, dtype=dtype)
+		return np.memmap(column_file(self.version_directory, name), dtype=dtype, mode='r', shape=(rows,) + row_shape)
+
+	def _column(self, name):
+		return self._maps[name]
+
+	def has_column(self, name):
+		return name in self.columns
+
+	def column_offsets(self, name):
+		return np.asarray(self.offsets[:, self.column_names.index(name)])
+
+	def column(self, name, video_path):
+		"""Rows of one column belonging to a video, as a view into the memory map."""
+		video_index = self.video_indices[video_path]
+		column_index = self.column_names.index(name)
+		start, end = self.offsets[video_index, column_index], self.offsets[video_index + 1, column_index]
+		return self._column(name)[start:end]
+
+	def fps(self, video_path):
+		return self.videos[self.video_indices[video_path]]['fps']
+
+	def frame_count(self, video_path):
+		return self.videos[self.video_indices[video_path]]['frame_count']
+
+	def geometry(self, video_path):
+		"""(width, height) of a video's frames; stores written without it get the .rgb frame size."""
+		video = self.videos[self.video_indices[video_path]]
+		return video.get('width', FRAME_WIDTH), video.get('height', FRAME_HEIGHT)
+
+	def source(self, video_path):
+		"""Manifest entry of the file a video was indexed from, or None."""
+		return self.videos[self.video_indices[video_path]].get('source')
+
+	def shot_boundaries(self, video_path):
+		return self.column('shot_boundaries', video_path).tolist()
+
+	def frame_histograms(self, video_path):
+		return self.column('frame_histograms', video_path)
+
+	def audio_envelope(self, video_path):
+		if not self.has_column('audio_envelope'):
+			return None
+		return self.column('audio_envelope', video_path)
+
+	def histogram_projection(self):
+		"""The projection the compact histograms were made with, or None if the store has none."""
+		if self._compact_histograms is None:
+			return None
+		return self._compact_histograms[0]
+
+	def compact_histograms(self, video_path):
+		"""
+		The video's compact histograms and the projection they were made with.
+
+		Returns:
+		Tuple: (HistogramProjection, int8 projections, uint8 residual norms), rows aligned with
+		frame_histograms, or None if the store has none.
+		"""
+		if self.histogram_projection() is None:
+			return None
+		projection, compact, residuals = self._compact_histograms
+		video_index = self.video_indices[video_path]
+		offsets = self.column_offsets('frame_histograms')
+		rows = slice(offsets[video_index], offsets[video_index + 1])
+		return projection, compact[rows], residuals[rows]
+
+	def histogram_pyramid(self, video_path):
+		"""The video's temporal histogram pyramid as {step: level}, or None if the store has none."""
+		steps = [int(name[len('pyramid_'):]) for name in self.column_names if name.startswith('pyramid_')]
+		if not steps:
+			return None
+		return {step: self.column(f'pyramid_{step}', video_path) for step in steps}
+
+	def hash_library(self):
+		return HashLibrary(self.video_paths, self._column('hashes'), self.column_offsets('hashes'))
+
+	def hash_index(self):
+		return self._hash_index
+
+	def audio_index(self):
+		return self._audio_index
+
+	def shot_index(self):
+		"""The shot-length n-gram index, or None if the store has none."""
+		return self._shot_index
+
+	def histogram_index(self):
+		"""The library-wide frame histogram index, or None if the store has none."""
+		return self._histogram_index
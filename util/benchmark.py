@@ -0,0 +1,240 @@
+#!/usr/bin/env python3
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import wave
+
+import cv2
+import numpy as np
+
+current_directory = os.path.dirname(os.path.abspath(__file__))
+parent_directory = os.path.dirname(current_directory)
+sys.path.append(parent_directory)
+sys.path.append(os.path.join(parent_directory, 'preprocessing'))
+
+from main_algorithim import VideoMatcher
+from preprocessing import build_signature_store
+from rgb_verification import FRAME_HEIGHT, FRAME_WIDTH
+
+FPS = 30
+SAMPLE_RATE = 22050
+
+def write_wav(path, samples):
+	"""Write mono float samples in [-1, 1] as 16-bit PCM."""
+	pcm = (np.clip(samples, -1, 1) * 32000).astype(np.int16)
+	with wave.open(path, 'wb') as file:
+		file.setnchannels(1)
+		file.setsampwidth(2)
+		file.setframerate(SAMPLE_RATE)
+		file.writeframes(pcm.tobytes())
+
+def synthetic_frames(num_frames, rng):
+	"""
+	Yields RGB frames made of shots of random length, each with its own colours and motion.
+
+	Every shot has a base colour, a fixed texture, a brightness ramp over the shot and a
+	square moving at a constant velocity, so consecutive shots differ in colour and frames
+	within a shot differ by motion.
+	"""
+	gradient = np.linspace(0, 80, FRAME_WIDTH)[None, :, None]
+	frame_index = 0
+	while frame_index < num_frames:
+		shot_length = int(rng.integers(40, 160))
+		base = rng.integers(0, 256, 3)
+		texture = rng.integers(0, 60, (FRAME_HEIGHT, FRAME_WIDTH, 1))
+		x, y = rng.integers(0, FRAME_WIDTH - 60), rng.integers(0, FRAME_HEIGHT - 60)
+		velocity_x, velocity_y = rng.integers(-4, 5, 2)
+		square_colour = rng.integers(0, 256, 3)
+		for i in range(min(shot_length, num_frames - frame_index)):
+			frame = np.clip(base[None, None, :] + texture + gradient * (i / shot_length), 0, 255).astype(np.uint8)
+			square_x = int((x + velocity_x * i) % (FRAME_WIDTH - 60))
+			square_y = int((y + velocity_y * i) % (FRAME_HEIGHT - 60))
+			frame[square_y:square_y + 60, square_x:square_x + 60] = square_colour
+			yield frame
+			frame_index += 1
+
+def synthetic_audio(num_samples, rng):
+	"""Random windowed tones over low noise, about eight per second."""
+	samples = 0.02 * rng.standard_normal(num_samples)
+	tone = np.arange(2000) / SAMPLE_RATE
+	for _ in range(num_samples * 8 // SAMPLE_RATE):
+		start = int(rng.integers(0, max(num_samples - 2000, 1)))
+		burst = np.sin(2 * np.pi * rng.uniform(200, 3000) * tone) * np.hanning(2000)
+		samples[start:start + 2000] += burst[:num_samples - start]
+	return samples / (np.abs(samples).max() + 1e-9)
+
+def write_video(base_path, frames):
+	"""Write frames as base_path.mp4 and as the raw base_path.rgb the matcher verifies against."""
+	writer = cv2.VideoWriter(f"{base_path}.mp4", cv2.VideoWriter_fourcc(*'mp4v'), FPS, (FRAME_WIDTH, FRAME_HEIGHT))
+	num_frames = 0
+	with open(f"{base_path}.rgb", 'wb') as rgb_file:
+		for frame in frames:
+			rgb_file.write(frame.tobytes())
+			writer.write(cv2.cvtColor(frame, cv2.COLOR_RGB2BGR))
+			num_frames += 1
+	writer.release()
+	return num_frames
+
+def generate_library(directory, num_videos, video_seconds, with_audio=True, seed=0):
+	"""
+	Write a synthetic database of num_videos videos of video_seconds each.
+
+	Returns:
+	list: Paths of the generated .mp4 files.
+	"""
+	rng = np.random.default_rng(seed)
+	videos = []
+	for i in range(1, num_videos + 1):
+		base_path = os.path.join(directory, f"video{i}")
+		write_video(base_path, synthetic_frames(int(video_seconds * FPS), rng))
+		if with_audio:
+			write_wav(f"{base_path}.wav", synthetic_audio(int(video_seconds * SAMPLE_RATE), rng))
+		videos.append(f"{base_path}.mp4")
+	return videos
+
+def cut_clips(directory, videos, num_clips, clip_seconds, seed=0):
+	"""
+	Cut num_clips query clips of clip_seconds at random offsets of random library videos.
+
+	Each clip gets an .mp4, an .rgb and, when its video has one, a .wav.
+
+	Returns:
+	list: One dict per clip with its paths and the video and start frame it was cut from.
+	"""
+	rng = np.random.default_rng(seed + 1)
+	clip_frames = int(clip_seconds * FPS)
+	clips = []
+	for i in range(num_clips):
+		video = videos[int(rng.integers(len(videos)))]
+		base_path = os.path.splitext(video)[0]
+		frames = np.fromfile(f"{base_path}.rgb", dtype=np.uint8).reshape(-1, FRAME_HEIGHT, FRAME_WIDTH, 3)
+		start_frame = int(rng.integers(0, max(len(frames) - clip_frames, 1)))
+		clip_base = os.path.join(directory, f"clip{i + 1}")
+		write_video(clip_base, frames[start_frame:start_frame + clip_frames])
+		if os.path.exists(f"{base_path}.wav"):
+			with wave.open(f"{base_path}.wav") as file:
+				pcm = np.frombuffer(file.readframes(file.getnframes()), dtype=np.int16)
+			start_sample = int(round(start_frame / FPS * SAMPLE_RATE))
+			write_wav(f"{clip_base}.wav", pcm[start_sample:start_sample + int(clip_seconds * SAMPLE_RATE)] / 32000)
+		clips.append({'clip': f"{clip_base}.mp4", 'clip_rgb': f"{clip_base}.rgb", 'video': video, 'start_frame': start_frame})
+	return clips
+
+def peak_rss_mb():
+	"""Peak resident set size of this process and of its finished children, in MB."""
+	scale = 1 if sys.platform == 'darwin' else 1024  # ru_maxrss is in bytes on macOS, kilobytes elsewhere
+	return {
+		'self': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale / 2**20,
+		'children': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale / 2**20,
+	}
+
+def git_commit():
+	try:
+		return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=parent_directory, capture_output=True, text=True,
+			check=True).stdout.strip()
+	except (OSError, subprocess.CalledProcessError):
+		return None
+
+def run_benchmark(directory, num_videos=6, video_seconds=60, num_clips=20, clip_seconds=10, with_audio=True,
+	index_workers=1, query_workers=1, seed=0, verbose=False, index_from_rgb=False,
+	index_chunk_workers=1):
+	"""
+	Generate a library, index it, query every clip and measure each stage.
+
+	Returns:
+	dict: Configuration, indexing throughput, query latency percentiles, accuracy and peak RSS.
+	"""
+	output = contextlib.nullcontext() if verbose else contextlib.redirect_stdout(io.StringIO())
+	videos = generate_library(directory, num_videos, video_seconds, with_audio, seed)
+	clips = cut_clips(directory, videos, num_clips, clip_seconds, seed)
+	total_frames = sum(os.path.getsize(os.path.splitext(video)[0] + '.rgb') // (FRAME_WIDTH * FRAME_HEIGHT * 3) for video in videos)
+
+	signature_directory = os.path.join(directory, 'signatures')
+	start_time = time.time()
+	with output:
+		build_signature_store(videos, signature_directory, workers=index_workers, from_rgb=index_from_rgb,
+			chunk_workers=index_chunk_workers)
+	indexing_time = time.time() - start_time
+	indexing_rss = peak_rss_mb()
+
+	latencies = []
+	found_video = 0
+	found_exact = 0
+	with output:
+		matcher = VideoMatcher(signature_directory, workers=query_workers)
+		for clip in clips:
+			start_time = time.time()
+			result = matcher.match(clip['clip'], clip['clip_rgb'])
+			latencies.append(time.time() - start_time)
+			found_video += result['video'] == clip['video']
+			found_exact += result['video'] == clip['video'] and result['start_frame'] == clip['start_frame']
+		matcher.close()
+
+	return {
+		'commit': git_commit(),
+		'platform': platform.platform(),
+		'cpu_count': os.cpu_count(),
+		'config': {
+			'videos': num_videos, 'video_seconds': video_seconds, 'clips': num_clips, 'clip_seconds': clip_seconds,
+			'audio': with_audio, 'index_workers': index_workers, 'query_workers': query_workers, 'seed': seed,
+			'index_from_rgb': index_from_rgb, 'index_chunk_workers': index_chunk_workers,
+		},
+		'indexing': {
+			'frames': int(total_frames),
+			'seconds': indexing_time,
+			'frames_per_second': total_frames / indexing_time,
+			'peak_rss_mb': indexing_rss,
+		},
+		'queries': {
+			'count': len(latencies),
+			'mean': float(np.mean(latencies)) if latencies else None,
+			**{f'p{q}': float(np.percentile(latencies, q)) if latencies else None for q in (50, 95, 99)},
+		},
+		'accuracy': {
+			'video': found_video / len(clips) if clips else None,
+			'exact': found_exact / len(clips) if clips else None,
+		},
+		'peak_rss_mb': peak_rss_mb(),
+	}
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="Benchmark indexing and query latency on a synthetic library.")
+	parser.add_argument('--videos', type=int, default=6, help="number of library videos")
+	parser.add_argument('--video-seconds', type=float, default=60, help="length of every library video")
+	parser.add_argument('--clips', type=int, default=20, help="number of query clips")
+	parser.add_argument('--clip-seconds', type=float, default=10, help="length of every query clip")
+	parser.add_argument('--no-audio', action='store_true', help="generate no .wav files, so queries use the video path only")
+	parser.add_argument('--index-workers', type=int, default=1)
+	parser.add_argument('--query-workers', type=int, default=1)
+	parser.add_argument('--index-from-rgb', action='store_true', help="index the raw .rgb files instead of decoding the videos")
+	parser.add_argument('--index-chunk-workers', type=int, default=1, help="with --index-from-rgb, processes every video is split over")
+	parser.add_argument('--seed', type=int, default=0)
+	parser.add_argument('--directory', default=None, help="where to generate the library, kept afterwards; a temporary directory otherwise")
+	parser.add_argument('--output', default='benchmark.json', help="results file")
+	parser.add_argument('--verbose', action='store_true', help="show the matcher's progress output")
+	args = parser.parse_args()
+
+	directory = args.directory or tempfile.mkdtemp(prefix='video-benchmark-')
+	os.makedirs(directory, exist_ok=True)
+	try:
+		results = run_benchmark(directory, args.videos, args.video_seconds, args.clips, args.clip_seconds, not args.no_audio,
+			args.index_workers, args.query_workers, args.seed, args.verbose, args.index_from_rgb,
+			args.index_chunk_workers)
+	finally:
+		if args.directory is None:
+			shutil.rmtree(directory)
+	with open(args.output, 'w') as file:
+		json.dump(results, file, indent=2)
+	queries = results['queries']
+	print(f"Indexing: {results['indexing']['frames_per_second']:.0f} frames/s")
+	print(f"Queries: p50 {queries['p50']:.3f}s, p95 {queries['p95']:.3f}s, p99 {queries['p99']:.3f}s")
+	print(f"Accuracy: {results['accuracy']['exact']:.0%} exact, {results['accuracy']['video']:.0%} right video")
+	print(f"Results written to {args.output}")
@@ -0,0 +1,210 @@
+#!/usr/bin/env python3
+import argparse
+import contextlib
+import io
+import os
+import shutil
+import sys
+import tempfile
+
+import cv2
+import numpy as np
+
+current_directory = os.path.dirname(os.path.abspath(__file__))
+parent_directory = os.path.dirname(current_directory)
+sys.path.append(parent_directory)
+sys.path.append(os.path.join(parent_directory, 'preprocessing'))
+
+from benchmark import FPS, synthetic_frames, write_video
+from hash_index import EARLY_STOP_DISTANCE, HashLibrary, rank_videos, rank_videos_batch
+from preprocessing import calculate_histogram, extract_rgb_features, extract_video_features, histogram_similarity
+from rgb_features import BlockSegmentHasher, gray_frames, stitch_segment_hashes
+from rgb_verification import map_rgb_file
+from segment_hashing import SegmentHasher, phash_bits
+
+# (segment frames, overlap frames) of 3 second segments at 30 fps, a short odd segment, and no overlap
+SEGMENT_SHAPES = [(90, 27), (13, 4), (30, 0)]
+
+def original_segment_hashes(gray_frames, segment_frames, overlap_frames):
+	"""The original list-based segment hashing: the mean of a stacked segment, with frames[-overlap_frames:] carried over."""
+	hashes = []
+	frames = []
+	for frame_count, gray_frame in enumerate(gray_frames):
+		frames.append(gray_frame)
+		if frame_count % segment_frames == 0 and frame_count != 0:
+			hashes.append(phash_bits(np.mean(np.array(frames), axis=0).astype(np.uint8)))
+			frames = frames[-overlap_frames:]
+	if frames:
+		hashes.append(phash_bits(np.mean(np.array(frames), axis=0).astype(np.uint8)))
+	return hashes
+
+def original_shot_boundaries(bgr_frames, threshold=0.5):
+	"""The original separate shot detection pass: (shot boundaries, frame histograms)."""
+	shot_boundaries = []
+	frame_histograms = []
+	prev_hist = None
+	for frame_index, frame in enumerate(bgr_frames):
+		frame_hist = calculate_histogram(frame)
+		frame_histograms.append(frame_hist)
+		if prev_hist is not None and histogram_similarity(prev_hist, frame_hist) < threshold:
+			shot_boundaries.append(frame_index)
+		prev_hist = frame_hist
+	if frame_histograms and not shot_boundaries:
+		shot_boundaries.append(1)
+	return shot_boundaries, frame_histograms
+
+def original_ranking(clip_hashes, video_hashes):
+	"""The original ranking scan over binary hash strings, stopping at the first segment closer than EARLY_STOP_DISTANCE."""
+	best_matches = []
+	for video_path, segment_hashes in video_hashes.items():
+		min_distance = float('inf')
+		for clip_hash in clip_hashes:
+			for segment_hash in segment_hashes:
+				distance = bin(int(clip_hash, 2) ^ int(segment_hash, 2)).count('1')
+				if distance < min_distance:
+					min_distance = distance
+				if distance < EARLY_STOP_DISTANCE:
+					break
+		best_matches.append((video_path, min_distance))
+	return sorted(best_matches, key=lambda x: x[1])
+
+def synthetic_gray_frames(num_frames, seed):
+	return gray_frames(np.array(list(synthetic_frames(num_frames, np.random.default_rng(seed)))))
+
+def check_segment_hasher():
+	"""SegmentHasher gives the original loop's hashes, for clips shorter than, equal to and longer than a segment."""
+	frames = synthetic_gray_frames(200, seed=1)
+	for segment_frames, overlap_frames in SEGMENT_SHAPES:
+		for num_frames in (1, segment_frames, segment_frames + 1, len(frames)):
+			hasher = SegmentHasher(segment_frames, overlap_frames)
+			for gray_frame in frames[:num_frames]:
+				hasher.add_frame(gray_frame)
+			expected = original_segment_hashes(frames[:num_frames], segment_frames, overlap_frames)
+			assert hasher.finish() == expected, f"SegmentHasher({segment_frames}, {overlap_frames}) differs on {num_frames} frames"
+
+def check_chunk_stitching():
+	"""BlockSegmentHasher over any chunking and block size, stitched, gives SegmentHasher's hashes."""
+	frames = synthetic_gray_frames(200, seed=2)
+	for segment_frames, overlap_frames in SEGMENT_SHAPES:
+		hasher = SegmentHasher(segment_frames, overlap_frames)
+		for gray_frame in frames:
+			hasher.add_frame(gray_frame)
+		expected = hasher.finish()
+		# Without overlap every segment starts at frame 0, so only whole videos are hashed
+		for num_chunks in ((1, 2, 3, 7) if overlap_frames > 0 else (1,)):
+			for block_frames in (1, 7, 64):
+				bounds = np.linspace(0, len(frames), num_chunks + 1).round().astype(np.int64)
+				chunk_results = []
+				for first, end in zip(bounds[:-1], bounds[1:]):
+					chunk = BlockSegmentHasher(len(frames), segment_frames, overlap_frames, int(first), int(end) - 1)
+					for block_start in range(first, end, block_frames):
+						chunk.add_block(int(block_start), frames[block_start:min(block_start + block_frames, end)])
+					chunk_results.append(chunk.finish())
+				assert stitch_segment_hashes(chunk_results) == expected, \
+					f"{num_chunks} chunks of ({segment_frames}, {overlap_frames}) segments in blocks of {block_frames} differ"
+
+def check_ranking():
+	"""rank_videos and rank_videos_batch order the videos exactly as the original early-stopping scan."""
+	rng = np.random.default_rng(3)
+	lengths = [0, 1, 5, 40, 17, 0, 60]
+	bases = rng.integers(0, 2**63, 6, dtype=np.uint64)
+
+	def near(hashes, max_flips):
+		# Every hash with up to max_flips random bits flipped
+		flipped = np.array(hashes, dtype=np.uint64)
+		for _ in range(max_flips):
+			flipped ^= np.where(rng.random(len(flipped)) < 0.7, np.uint64(1), np.uint64(0)) << rng.integers(0, 64, len(flipped)).astype(np.uint64)
+		return flipped
+
+	# Segments near a few shared hashes, in random order, so a video often holds a segment just
+	# under EARLY_STOP_DISTANCE from a clip hash before a closer one the original scan never reached
+	video_hashes = {f"video{i}.mp4": near(bases[rng.integers(0, len(bases), length)], 8) for i, length in enumerate(lengths)}
+	video_paths = list(video_hashes)
+	offsets = np.concatenate([[0], np.cumsum(lengths)])
+	library = HashLibrary(video_paths, np.concatenate(list(video_hashes.values())), offsets)
+	as_strings = {video_path: [format(int(segment_hash), '064b') for segment_hash in hashes]
+		for video_path, hashes in video_hashes.items()}
+
+	queries = [near(bases[rng.integers(0, len(bases), int(rng.integers(1, 8)))], 3) for _ in range(12)]
+	queries.append(rng.integers(0, 2**63, 4, dtype=np.uint64))
+	queries.append(np.empty(0, dtype=np.uint64))
+
+	expected = [original_ranking([format(int(clip_hash), '064b') for clip_hash in clip_hashes], as_strings) for clip_hashes in queries]
+	for clip_hashes, ranking in zip(queries, expected):
+		assert rank_videos(clip_hashes, library) == ranking, "rank_videos differs from the original scan"
+	# A small max_cells splits the library into blocks of a few videos
+	for max_cells in (1 << 22, 64):
+		assert rank_videos_batch(queries, library, max_cells) == expected, f"rank_videos_batch differs with max_cells={max_cells}"
+
+def check_fused_extractor(directory):
+	"""
+	The single-decode extractors give the original separate passes' hashes, shot boundaries
+	and histograms, bit for bit: extract_video_features for the decoded video, and
+	extract_rgb_features, in one pass and in chunks, for its .rgb file.
+	"""
+	base_path = os.path.join(directory, 'regression')
+	write_video(base_path, synthetic_frames(400, np.random.default_rng(4)))
+	segment_frames = int(FPS * 3)
+	overlap_frames = int(segment_frames * 0.3)
+
+	cap = cv2.VideoCapture(f"{base_path}.mp4")
+	decoded = []
+	while True:
+		ret, frame = cap.read()
+		if not ret:
+			break
+		decoded.append(frame)
+	cap.release()
+	# The .rgb frames flipped to BGR, as a decoded frame would be
+	raw = [cv2.cvtColor(frame, cv2.COLOR_RGB2BGR) for frame in map_rgb_file(f"{base_path}.rgb")]
+
+	cases = [('extract_video_features', decoded, lambda: extract_video_features(f"{base_path}.mp4"))]
+	for workers in (1, 3):
+		cases.append((f'extract_rgb_features with {workers} workers', raw,
+			lambda workers=workers: extract_rgb_features(f"{base_path}.rgb", FPS, workers=workers)))
+	for name, bgr_frames, extract in cases:
+		expected_hashes = original_segment_hashes([cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY) for frame in bgr_frames],
+			segment_frames, overlap_frames)
+		expected_boundaries, expected_histograms = original_shot_boundaries(bgr_frames)
+		with contextlib.redirect_stdout(io.StringIO()):
+			hashes, shot_boundaries, frame_histograms, _ = extract()
+		assert hashes == expected_hashes, f"{name} hashes differ"
+		assert shot_boundaries == expected_boundaries, f"{name} shot boundaries differ"
+		assert np.array_equal(np.asarray(frame_histograms), np.array(expected_histograms)), f"{name} histograms differ"
+
+def run_checks(directory):
+	"""
+	Run every check, printing one line each.
+
+	Returns:
+	int: Number of failed checks.
+	"""
+	checks = [
+		('segment hasher', check_segment_hasher),
+		('chunk stitching', check_chunk_stitching),
+		('ranking', check_ranking),
+		('fused extractor', lambda: check_fused_extractor(directory)),
+	]
+	failures = 0
+	for name, check in checks:
+		try:
+			check()
+			print(f"{name}: ok")
+		except AssertionError as error:
+			failures += 1
+			print(f"{name}: FAILED, {error}")
+	return failures
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="Check the optimized hashing, ranking and feature extraction against the original algorithms.")
+	parser.add_argument('--directory', default=None, help="where to write the test video, kept afterwards; a temporary directory otherwise")
+	args = parser.parse_args()
+
+	directory = args.directory or tempfile.mkdtemp(prefix='video-regression-')
+	os.makedirs(directory, exist_ok=True)
+	try:
+		failures = run_checks(directory)
+	finally:
+		if args.directory is None:
+			shutil.rmtree(directory)
+	sys.exit(1 if failures else 0)